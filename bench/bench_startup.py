@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+#
+""" bench_startup
+Time how long update_host.py takes to start, up to the point it would connect to route 53, and fail when that
+goes over a budget. Each run is a fresh interpreter, the time reported is what update_host.py adds on top of
+starting python, the median of several runs.
+"""
+
+import json
+from optparse import OptionParser
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+#Run in a fresh interpreter, loads update_host.py as a module and the connection it would use then prints
+#the modules loaded
+STARTUP = """
+import imp, json, sys
+sys.path.insert(0, %(root)r)
+imp.load_source('update_host', %(script)r)
+%(connect)s
+print json.dumps(sorted(sys.modules))
+"""
+
+PATHS = [('interpreter', None), \
+    ('update_host', 'from cirrus.connection import Route53Connection'), \
+    ('update_host --boto', 'from boto.route53.connection import Route53Connection')]
+
+#Modules which the default update_host path must never load
+HEAVY_MODULES = ['boto', 'dns']
+
+#The most milliseconds update_host.py may add to interpreter start by default
+BUDGET_MS = 60
+
+def get_args():
+    """Sets up Option parser and then resturns the parsed options and args."""
+    usage = "usage: %prog [options]"
+    parser = OptionParser(usage=usage)
+    parser.add_option('-r', '--runs', dest='runs', type='int', default=15, \
+        help="The number of times each path is started, the median is reported.")
+    parser.add_option('-b', '--budget', dest='budget', type='float', default=BUDGET_MS, \
+        help="The most milliseconds update_host.py may add to interpreter start before this fails.")
+    parser.add_option('--json', dest='json', help="Also write the results as json to this file.")
+
+    return parser.parse_args()
+
+def time_path(connect, runs):
+    """ Start an interpreter runs times, returns (median seconds, modules loaded).
+    Raises RuntimeError with the last line the interpreter wrote to stderr if a run fails.
+    """
+    if connect is None:
+        code = 'pass'
+    else:
+        code = STARTUP % {'root': ROOT, 'script': os.path.join(ROOT, 'bin', 'update_host.py'), 'connect': connect}
+    times = []
+    modules = []
+    for n in range(runs):
+        start = time.time()
+        process = subprocess.Popen([sys.executable, '-c', code], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output, errors = process.communicate()
+        times.append(time.time() - start)
+        if process.returncode != 0:
+            lines = errors.strip().splitlines() or ['exit status %d' % process.returncode]
+            raise RuntimeError(lines[-1])
+        if output:
+            modules = json.loads(output)
+    times.sort()
+    return times[len(times) // 2], modules
+
+def main():
+    options, args = get_args()
+
+    results = []
+    baseline = None
+    status = None
+    loaded = {}
+    print "%-20s %10s %8s" % ('path', 'ms', 'modules')
+    for name, connect in PATHS:
+        try:
+            seconds, modules = time_path(connect, options.runs)
+        except RuntimeError as e:
+            #A failed interpreter isn't timed, only the optional boto path may fail without failing the run
+            results.append({'path': name, 'error': str(e)})
+            print "%-20s %10s %8s %s" % (name, 'failed', '-', e)
+            if name != PATHS[-1][0]:
+                status = 1
+            continue
+        if baseline is None:
+            baseline = seconds
+        added = (seconds - baseline) * 1000
+        loaded[name] = modules
+        results.append({'path': name, 'ms': added, 'modules': len(modules)})
+        print "%-20s %10.1f %8d" % (name, added, len(modules))
+
+    lean = results[1]
+    heavy = [module for module in loaded.get(lean['path'], []) if module.split('.')[0] in HEAVY_MODULES]
+    if heavy:
+        print "update_host loaded %s" % ', '.join(heavy)
+        status = 1
+    if 'ms' in lean and lean['ms'] > options.budget:
+        print "update_host took %.1fms over the budget of %.1fms" % (lean['ms'] - options.budget, options.budget)
+        status = 1
+
+    if options.json is not None:
+        json_file = open(options.json, 'w')
+        json.dump(results, json_file, indent=1)
+        json_file.close()
+
+    return status
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+#
+""" bench_zone
+Time the cirrus.r53.Zone code paths against an in memory route 53 for generated zones of several sizes.
+Each case runs in its own forked process and reports seconds taken, route 53 calls made and how much the
+peak memory of the process grew, so regressions and improvements show up as numbers.
+"""
+
+import json
+import logging
+from optparse import OptionParser
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import dns.zone
+
+from cirrus.client import RateLimiter, Route53Client
+from cirrus.export import Exporter
+from cirrus.fake import FakeRoute53Connection
+from cirrus.r53 import Zone
+
+log = logging.getLogger('cirrus')
+log.addHandler(logging.StreamHandler())
+
+ZONE_NAME = 'bench.example.com'
+CASES = ['parse', 'fetch', 'to_dnszone', 'export', 'compare', 'changeset', 'get_host', 'create', 'update', 'update_stream', \
+    'remove']
+
+def get_args():
+    """Sets up Option parser and then resturns the parsed options and args."""
+    usage = "usage: %prog [options]"
+    parser = OptionParser(usage=usage)
+    parser.add_option('-s', '--sizes', dest='sizes', default='1000,10000', \
+        help="Comma separated number of records in each generated zone, ie 1000,10000,100000")
+    parser.add_option('-c', '--cases', dest='cases', default=','.join(CASES), \
+        help="Comma separated cases to run, from %s" % ','.join(CASES))
+    parser.add_option('--latency', dest='latency', type='float', default=0, \
+        help="Seconds each fake route 53 call takes.")
+    parser.add_option('--rate', dest='rate', type='float', default=None, \
+        help="Limit route 53 requests a second through the client, by default they are not limited.")
+    parser.add_option('--json', dest='json', help="Also write the results as json to this file.")
+    parser.add_option('-v', '--verbose', action='store_true', dest='verbose', default=False)
+
+    return parser.parse_args()
+
+def write_zone(path, size, seed, changed=0.0):
+    """ Write a bind zone file with about size rrsets of assorted types.
+    With changed above 0 roughly that fraction of rrsets has new values, a new ttl, is removed or is added.
+    """
+    rand = random.Random(seed)
+    lines = ["$ORIGIN %s." % ZONE_NAME, "$TTL 300", \
+        "@ IN SOA ns1 hostmaster 1 7200 900 1209600 86400", "@ IN NS ns1", "ns1 IN A 10.255.255.1"]
+    for n in range(size):
+        change = changed > 0 and rand.random() < changed
+        kind = change and rand.choice(['value', 'ttl', 'remove', 'add']) or None
+        if kind == 'remove':
+            continue
+        name = 'host%d' % n
+        ttl = 300
+        if kind == 'ttl':
+            ttl = 60
+        octet = n % 250
+        if kind == 'value':
+            octet = 251
+        if n % 100 == 99:
+            lines.append('_alias.%s 600 IN TXT "Alias Z2FDTNDATAQYW2 lb-%d.elb.amazonaws.com."' % (name, octet))
+        elif n % 50 == 49:
+            lines.append('%s %d IN MX 10 mx%d.example.org.' % (name, ttl, octet))
+        elif n % 20 == 19:
+            lines.append('%s %d IN TXT "v=spf1 ip4:10.0.%d.0/24 -all"' % (name, ttl, octet))
+        elif n % 10 == 9:
+            lines.append('%s %d IN CNAME host%d' % (name, ttl, octet))
+        else:
+            lines.append('%s %d IN A 10.%d.%d.%d' % (name, ttl, n // 62500, n // 250 % 250, octet))
+        if kind == 'add':
+            lines.append('new%d %d IN A 10.254.%d.%d' % (n, ttl, n // 250 % 250, octet))
+
+    zone_file = open(path, 'w')
+    zone_file.write('\n'.join(lines) + '\n')
+    zone_file.close()
+
+def load_remote(conn, zone_file):
+    """Create the zone in the fake route 53 holding the records of zone_file, returns the zone id."""
+    zone_id = conn.add_zone(ZONE_NAME)
+    loader = Zone(conn, ZONE_NAME)
+    dnszone = dns.zone.from_file(zone_file, origin=ZONE_NAME, relativize=False)
+    for rrset in loader._get_rrecords(dnszone).itervalues():
+        if rrset.alias is not None:
+            conn.add_rrset(zone_id, rrset.name, rrset.rtype, alias=(rrset.alias.zone_id, rrset.alias.dns_name))
+        else:
+            conn.add_rrset(zone_id, rrset.name, rrset.rtype, rrset.ttl, list(rrset.values))
+    return zone_id
+
+def setup(case, size, files, options):
+    """Build everything a case needs before the timing starts, returns (conn, function to time)."""
+    conn = FakeRoute53Connection(latency=options.latency)
+    limiter = None
+    if options.rate is not None:
+        limiter = RateLimiter(options.rate)
+    zone = Zone(Route53Client(conn, limiter), ZONE_NAME)
+    if case == 'create':
+        return conn, lambda: zone.create(files['current'], False)
+
+    load_remote(conn, files['current'])
+    zone.exists()
+    if case == 'parse':
+        return conn, lambda: zone._get_rrecords(dns.zone.from_file(files['changed'], origin=ZONE_NAME, \
+            relativize=False))
+    elif case == 'fetch':
+        return conn, zone._get_remote_rrecords
+    elif case == 'to_dnszone':
+        return conn, zone._to_dnszone
+    elif case == 'export':
+        return conn, lambda: zone.export(Exporter(open(os.devnull, 'w')))
+    elif case == 'update':
+        return conn, lambda: zone.update(files['changed'], False)
+    elif case == 'update_stream':
+        return conn, lambda: zone.update(files['changed'], False, stream=True)
+    elif case == 'remove':
+        return conn, lambda: zone.remove(False)
+    elif case == 'get_host':
+        hosts = ['host%d.%s' % (n, ZONE_NAME) for n in random.Random(size).sample(xrange(size), min(size, 100))]
+        return conn, lambda: [zone.get_host(host) for host in hosts]
+
+    remote = zone._get_remote_rrecords()
+    local = zone._get_rrecords(dns.zone.from_file(files['changed'], origin=ZONE_NAME, relativize=False))
+    if case == 'compare':
+        return conn, lambda: zone._compare(remote, local)
+    elif case == 'changeset':
+        adds, deletes, updates = zone._compare(remote, local)
+        return conn, lambda: zone._create_changeset(adds, deletes, updates)
+    raise ValueError("Unknown case " + case)
+
+def run_case(case, size, files, options):
+    """Run a case in a forked process, returning a dictionary of its results."""
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        try:
+            conn, func = setup(case, size, files, options)
+            conn.reset_calls()
+            rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            start = time.time()
+            func()
+            elapsed = time.time() - start
+            rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            result = {'seconds': elapsed, 'calls': conn.calls, 'peak_kb': rss_after - rss_before}
+        except Exception as e:
+            log.exception("Case %s failed for %d records" % (case, size))
+            result = {'error': str(e)}
+        os.write(write_fd, json.dumps(result))
+        os._exit(0)
+
+    os.close(write_fd)
+    output = []
+    while True:
+        data = os.read(read_fd, 65536)
+        if not data:
+            break
+        output.append(data)
+    os.close(read_fd)
+    os.waitpid(pid, 0)
+    result = json.loads(''.join(output))
+    result.update({'case': case, 'size': size})
+    return result
+
+def main():
+    options, args = get_args()
+    if options.verbose:
+        log.setLevel(logging.INFO)
+    else:
+        log.setLevel(logging.ERROR)
+
+    sizes = [int(size) for size in options.sizes.split(',')]
+    cases = options.cases.split(',')
+    tmpdir = tempfile.mkdtemp(prefix='cirrus-bench-')
+    results = []
+    try:
+        print "%8s %-14s %10s %8s %10s  %s" % ('records', 'case', 'seconds', 'calls', 'peak MB', 'calls by operation')
+        for size in sizes:
+            files = {'current': os.path.join(tmpdir, '%d.zone' % size), \
+                'changed': os.path.join(tmpdir, '%d-changed.zone' % size)}
+            write_zone(files['current'], size, size)
+            write_zone(files['changed'], size, size, 0.1)
+            for case in cases:
+                result = run_case(case, size, files, options)
+                results.append(result)
+                if 'error' in result:
+                    print "%8d %-14s failed: %s" % (size, case, result['error'])
+                    continue
+                calls = ' '.join('%s=%d' % item for item in sorted(result['calls'].items()))
+                print "%8d %-14s %10.3f %8d %10.1f  %s" % (size, case, result['seconds'], \
+                    sum(result['calls'].values()), result['peak_kb'] / 1024.0, calls)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    if options.json is not None:
+        json_file = open(options.json, 'w')
+        json.dump(results, json_file, indent=1)
+        json_file.close()
+
+    if [result for result in results if 'error' in result]:
+        return 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,35 +3,318 @@
 """ dns_setup
 Run this on a yaml dns definition an it will check the cloud to make sure your dns is setup
 and if not will set it up.
+With plan the changes are worked out and written to a plan file instead, which apply then submits
+without comparing the zones again. With --watch it keeps running, syncing each zone when its file changes.
 """
 
 import logging
 from optparse import OptionParser
+import os
+import threading
+import time
 import yaml
 import sys
 
 import boto
 
+from cirrus.changes import ChangeTracker
+from cirrus.export import EXTENSIONS, Exporter, FORMATS
+from cirrus.parsecache import ParseCache, parse_zones
+from cirrus.client import RateLimiter, Route53Client
+from cirrus.plan import read_plan, write_plan
 from cirrus.r53 import Zone
+from cirrus.snapshot import SnapshotStore
+from cirrus.stats import write_stats
+from cirrus.sync import sync_zones
+from cirrus.threaded import ThreadedZone
+from cirrus.watch import FileWatcher
 
 log = logging.getLogger('cirrus')
 log.addHandler(logging.StreamHandler())
 
 def get_args():
     """Sets up Option parser and then resturns the parsed options and args."""
-    usage = "usage: %prog [options] <yaml definition>"
+    usage = "usage: %prog [options] <yaml definition>\n" + \
+        "       %prog [options] plan <yaml definition> <plan file>\n" + \
+        "       %prog [options] apply <plan file> [<yaml definition>]"
     parser = OptionParser(usage=usage)
     parser.add_option('-d', '--dry-run', action='store_true', dest='dry_run', default=False, \
         help="Report what would be done but do nothing.")
     parser.add_option('-s', '--show', action='store_true', dest='show', default=False, \
-        help="Returns a bind style zone file for the defined domains.")
+        help="Write out the records of the defined domains as they are listed from route 53.")
+    parser.add_option('--format', dest='format', type='choice', choices=FORMATS, default='bind', \
+        help="The format --show writes, one of %s. The default is bind." % ', '.join(FORMATS))
+    parser.add_option('-o', '--output', dest='output', \
+        help="Write each zone --show exports to a file of its own in this directory rather than to stdout.")
     parser.add_option('--terminate', action='store_true', dest='terminate', default=False, \
         help="Instead of creating zones delete them.")
+    parser.add_option('-j', '--jobs', dest='jobs', type='int', default=1, \
+        help="Sync up to this many zones concurrently.")
+    parser.add_option('--rate', dest='rate', type='float', default=5, \
+        help="The maximum Route 53 requests per second, shared by all workers with --jobs.")
+    parser.add_option('--batches', dest='batches', type='int', default=1, \
+        help="Send up to this many change batches to a zone at once and list each zone in as many ranges " + \
+            "at once, a page ahead. Batches changing the same names are still sent in order.")
+    parser.add_option('-w', '--wait', action='store_true', dest='wait', default=False, \
+        help="Wait until route 53 reports all changes made are INSYNC.")
+    parser.add_option('--wait-timeout', dest='wait_timeout', type='int', default=600, \
+        help="The most seconds to wait for changes with --wait.")
+    parser.add_option('--state-dir', dest='state_dir', \
+        help="Keep a snapshot of each zone file applied here, zones unchanged since are skipped.")
+    parser.add_option('--parse-cache', dest='parse_cache', \
+        help="Keep the records parsed from each zone file here, a zone file unchanged since is not parsed again. " + \
+            "Zone files not in it are parsed up front in a process for each cpu.")
+    parser.add_option('--verify', action='store_true', dest='verify', default=False, \
+        help="Compare every zone with route 53 even if its snapshot says it is unchanged.")
+    parser.add_option('--stream', action='store_true', dest='stream', default=False, \
+        help="Compare route 53 a page at a time and send changes as they are found, for very large zones.")
+    parser.add_option('--subtree', dest='subtree', \
+        help="Only update the records at or under this name, leaving the rest of its zone untouched.")
+    parser.add_option('--watch', action='store_true', dest='watch', default=False, \
+        help="Keep running, updating each zone when its zone file or the yaml definition changes.")
+    parser.add_option('--poll', dest='poll', type='float', default=2, \
+        help="Seconds between checks for changed files with --watch.")
+    parser.add_option('--debounce', dest='debounce', type='float', default=2, \
+        help="Seconds a changed file must stay the same before it is synced with --watch.")
+    parser.add_option('--reconcile', dest='reconcile', type='float', default=3600, \
+        help="Seconds between comparing every zone with route 53 in full with --watch, to correct drift.")
+    parser.add_option('--stats-json', dest='stats_json', \
+        help="Write the route 53 requests made and time taken, per zone and in total, to this json file.")
+    parser.add_option('--prometheus', dest='prometheus', \
+        help="Write the same stats as --stats-json to this Prometheus node exporter textfile.")
     parser.add_option('-v', '--verbose', action='store_true', dest='verbose', default=False)
     parser.add_option('-q', '--quite', action='store_true', dest='quite', default=False)
     parser.add_option('--debug', action='store_true', dest='debug', default=False)
 
-    return parser.parse_args()
+    options, args = parser.parse_args()
+    if len(args) > 0 and args[0] == 'plan':
+        if len(args) != 3:
+            parser.error("plan needs a yaml definition and the plan file to write")
+    elif len(args) > 0 and args[0] == 'apply':
+        if len(args) not in (2, 3):
+            parser.error("apply needs a plan file and optionally the yaml definition for the credentials")
+    elif len(args) != 1:
+        parser.error("a yaml definition is needed")
+    if args[0] in ('plan', 'apply') and (options.terminate or options.show):
+        parser.error("%s can't be used with --terminate or --show" % args[0])
+    if options.watch and (args[0] in ('plan', 'apply') or options.terminate or options.show or options.subtree):
+        parser.error("--watch only syncs whole zones, it can't be used with plan, apply, --terminate, " + \
+            "--show or --subtree")
+    if options.output is not None and not options.show:
+        parser.error("--output is only used with --show")
+    if options.output is not None and not os.path.isdir(options.output):
+        parser.error("--output %s is not a directory" % options.output)
+    if options.show and options.jobs > 1 and options.output is None and options.format == 'bind':
+        #Pages of several zones would interleave on stdout, bind only names the zone in a header
+        parser.error("--show with --jobs above 1 needs --output or a jsonl or csv --format")
+    return options, args
+
+def make_zone(conn, name, options, tracker=None, snapshots=None):
+    """ Return the Zone for name, a ThreadedZone sending options.batches changesets at once if more than one,
+    reading zone files through the --parse-cache if there is one.
+    """
+    parse_cache = None
+    if options.parse_cache is not None:
+        parse_cache = ParseCache(options.parse_cache)
+    if options.batches > 1:
+        return ThreadedZone(conn, name, tracker, snapshots, parse_cache, concurrency=options.batches)
+    return Zone(conn, name, tracker, snapshots, parse_cache)
+
+def export_zone(r53zone, options, exporter=None):
+    """Export a zone's records with the shared exporter, or with --output to a file of its own."""
+    if options.output is None:
+        return r53zone.export(exporter)
+    path = os.path.join(options.output, '%s.%s' % (r53zone.zone_name.rstrip('.'), EXTENSIONS[options.format]))
+    export_file = open(path, 'w')
+    try:
+        count = r53zone.export(Exporter(export_file, options.format))
+    finally:
+        export_file.close()
+    log.info("Wrote %s record sets of zone %s to %s" % (count, r53zone.zone_name, path))
+    return count
+
+def sync_zone(conn, name, zone_file, options, tracker=None, snapshots=None, exporter=None):
+    """Create, update, remove or show a single zone, show writing the zone through exporter."""
+    r53zone = make_zone(conn, name, options, tracker, snapshots)
+
+    if r53zone.exists():
+        if options.terminate:
+            r53zone.remove(options.dry_run)
+            if snapshots is not None and not options.dry_run:
+                snapshots.discard(name)
+        elif options.show:
+            export_zone(r53zone, options, exporter)
+        else:
+            r53zone.update(zone_file, options.dry_run, options.verify, options.stream, options.subtree)
+    elif options.show or options.terminate:
+        log.warn('Zone %s does not exist' % (name))
+    elif options.subtree is not None:
+        log.error("Zone %s does not exist, create it before updating part of it" % name)
+    else:
+        r53zone.create(zone_file, options.dry_run)
+
+def subtree_zone(zones, subtree):
+    """Return the name of the zone a subtree is in, the longest zone name it ends with, or None."""
+    subtree = subtree.lower().rstrip('.')
+    found = None
+    for name in zones:
+        zone_name = name.lower().rstrip('.')
+        if subtree == zone_name or subtree.endswith('.' + zone_name):
+            if found is None or len(name) > len(found):
+                found = name
+    return found
+
+def plan_zones(conn, zones, options, plan_path, definition):
+    """Plan the changes for each zone and write them to a plan file. Returns the exit status."""
+    plans = {}
+    lock = threading.Lock()
+
+    def plan_zone(name, zone_file):
+        zone_plan = make_zone(conn, name, options).plan(zone_file, options.subtree)
+        if zone_plan is None:
+            raise ValueError("Zone %s could not be planned" % name)
+        with lock:
+            plans[name] = zone_plan
+
+    status = None
+    if options.jobs > 1:
+        if [result for result in sync_zones(zones, plan_zone, options.jobs) if not result.ok]:
+            status = 1
+    else:
+        for name, zone_file in zones.iteritems():
+            try:
+                plan_zone(name, zone_file)
+            except ValueError as e:
+                log.error(str(e))
+                status = 1
+    if status is not None:
+        log.error("Not writing a plan as some zones failed")
+        return status
+
+    plans = [plans[name] for name in sorted(plans)]
+    write_plan(plan_path, plans, definition)
+    log.warn("Wrote a plan of %d changesets for %d zones to %s" % \
+        (sum(len(zone_plan.changesets) for zone_plan in plans), len(plans), plan_path))
+
+def apply_plans(conn, plans, options, tracker=None, snapshots=None):
+    """Submit the changesets of each zone plan. Returns the exit status."""
+    def apply_zone(name, zone_plan):
+        if not make_zone(conn, name, options, tracker).apply(zone_plan):
+            raise ValueError("Zone %s was not applied" % name)
+        if snapshots is not None:
+            snapshots.discard(name) #The next update compares the zone in full and takes a new snapshot
+
+    plans = dict((zone_plan.zone_name, zone_plan) for zone_plan in plans)
+    if options.jobs > 1:
+        if [result for result in sync_zones(plans, apply_zone, options.jobs) if not result.ok]:
+            return 1
+    else:
+        status = None
+        for name in sorted(plans):
+            try:
+                apply_zone(name, plans[name])
+            except ValueError as e:
+                log.error(str(e))
+                status = 1
+        return status
+
+def run_zones(zones, func, jobs):
+    """ Call func(name, zone_file) for each zone using up to jobs threads, logging any error rather than
+    raising it. Returns true if every zone succeeded.
+    """
+    if len(zones) == 0:
+        return True
+    if jobs > 1:
+        return not [result for result in sync_zones(zones, func, jobs) if not result.ok]
+    ok = True
+    for name, zone_file in sorted(zones.iteritems()):
+        try:
+            func(name, zone_file)
+        except Exception as e:
+            log.debug('Error syncing zone %s' % name, exc_info=True)
+            log.error('Zone %s failed: %s' % (name, e))
+            ok = False
+    return ok
+
+def watch_zones(conn, definition, zones, options, tracker=None, snapshots=None):
+    """ Sync every zone then keep running until interrupted, syncing a zone again only when its zone file
+    changes. The changed file is compared with the records last applied, held in memory, rather than with
+    route 53. Zones added to the yaml definition are synced as it changes and every options.reconcile
+    seconds all zones are compared with route 53 in full to catch changes made elsewhere.
+    """
+    files = FileWatcher(options.debounce)
+    r53zones = {} #Kept between syncs so the hosted zone ids and records last applied are remembered
+    lock = threading.Lock()
+
+    def get_zone(name):
+        with lock:
+            if name not in r53zones:
+                r53zones[name] = make_zone(conn, name, options, tracker, snapshots)
+            return r53zones[name]
+
+    def sync(name, zone_file, verify):
+        r53zone = get_zone(name)
+        if r53zone.exists():
+            r53zone.update(zone_file, options.dry_run, verify, options.stream)
+        else:
+            r53zone.create(zone_file, options.dry_run)
+
+    def sync_changed(name, zone_file):
+        r53zone = get_zone(name)
+        if r53zone.exists():
+            r53zone.update_from(zone_file, options.dry_run)
+        else:
+            r53zone.create(zone_file, options.dry_run)
+
+    def wait():
+        if tracker is not None and not tracker.wait(conn, options.wait_timeout):
+            log.error("Carrying on watching with changes still pending")
+        write_stats(conn.stats, options.stats_json, options.prometheus)
+
+    files.add(definition)
+    for zone_file in set(zones.itervalues()):
+        files.add(zone_file)
+    run_zones(zones, lambda name, zone_file: sync(name, zone_file, options.verify), options.jobs)
+    wait()
+    reconciled = time.time()
+    log.warn("Watching %d zones for changes" % len(zones))
+
+    try:
+        while True:
+            time.sleep(options.poll)
+            changed = set(files.changed())
+            added = {}
+            if definition in changed:
+                try:
+                    new_zones = yaml.load(open(definition, 'r'))['zones']
+                except (IOError, KeyError, TypeError, yaml.YAMLError) as e:
+                    log.error("Not using the changed definition %s: %s" % (definition, e))
+                    new_zones = zones
+                for name in zones:
+                    if name not in new_zones:
+                        log.warn("Zone %s is no longer defined, it is left as it is in route 53" % name)
+                        with lock:
+                            r53zones.pop(name, None)
+                for name, zone_file in new_zones.iteritems():
+                    if zones.get(name) != zone_file:
+                        added[name] = zone_file
+                        files.add(zone_file)
+                for zone_file in set(zones.itervalues()) - set(new_zones.itervalues()):
+                    files.remove(zone_file)
+                zones = new_zones
+
+            if time.time() - reconciled >= options.reconcile:
+                log.warn("Comparing all %d zones with route 53" % len(zones))
+                run_zones(zones, lambda name, zone_file: sync(name, zone_file, True), options.jobs)
+                reconciled = time.time()
+            else:
+                run_zones(added, lambda name, zone_file: sync(name, zone_file, options.verify), options.jobs)
+                changed_zones = dict((name, zone_file) for name, zone_file in zones.iteritems() \
+                    if zone_file in changed and name not in added)
+                run_zones(changed_zones, sync_changed, options.jobs)
+            wait()
+    except KeyboardInterrupt:
+        log.warn("Stopped watching")
 
 def main():
     options, args = get_args()
@@ -45,31 +328,88 @@ def main():
     else:
         log.setLevel(logging.WARN)
 
+    command = None
+    if args[0] in ('plan', 'apply'):
+        command = args.pop(0)
+
+    if command == 'apply':
+        plans, definition = read_plan(args[0])
+        if len(args) > 1:
+            definition = args[1]
+        if definition is None:
+            log.error("The plan doesn't name a yaml definition, give one for the credentials")
+            return 1
+    else:
+        definition = args[0]
+
     #Pull from the yaml file
-    def_file = open(args[0], 'r')
+    def_file = open(definition, 'r')
     dns_def = yaml.load(def_file)
     zones = dns_def['zones']
+    if options.subtree is not None and command != 'apply': #A plan already holds its subtree
+        if options.terminate:
+            log.error("--subtree only applies to updates, it can't be used with --terminate")
+            return 1
+        name = subtree_zone(zones, options.subtree)
+        if name is None:
+            log.error("%s is not in any of the zones defined" % options.subtree)
+            return 1
+        zones = {name: zones[name]}
+
+    if options.parse_cache is not None and command != 'apply' and not (options.show or options.terminate):
+        parse_zones(ParseCache(options.parse_cache), zones)
 
     #Get the connection
-    conn = boto.connect_route53(dns_def['access_id'], dns_def['secret_key'])
+    conn = Route53Client(boto.connect_route53(dns_def['access_id'], dns_def['secret_key']), RateLimiter(options.rate))
+
+    if command == 'plan':
+        status = plan_zones(conn, zones, options, args[1], os.path.abspath(definition))
+        log.info(conn.report())
+        write_stats(conn.stats, options.stats_json, options.prometheus)
+        return status
 
     if options.dry_run:
         log.warn("Doing a dry-run, only reporting actions.")
 
-    for name, zone_file in zones.iteritems():
-        r53zone = Zone(conn, name)
-       
-        if r53zone.exists():
-            if options.terminate:
-                r53zone.remove(options.dry_run)
-            elif options.show:
-                print str(r53zone)
-            else:
-                r53zone.update(zone_file, options.dry_run)
-        elif options.show or options.terminate:
-            log.warn('Zone %s does not exist' % (name))
+    tracker = None
+    if options.wait:
+        tracker = ChangeTracker()
+    snapshots = None
+    if options.state_dir is not None:
+        snapshots = SnapshotStore(options.state_dir)
+
+    exporter = None
+    if options.show and options.output is None:
+        exporter = Exporter(sys.stdout, options.format)
+
+    status = None
+    if options.watch:
+        watch_zones(conn, definition, zones, options, tracker, snapshots)
+    elif command == 'apply':
+        if options.dry_run:
+            for zone_plan in plans:
+                log.warn("Would apply %d changesets to zone %s" % (len(zone_plan.changesets), zone_plan.zone_name))
         else:
-            r53zone.create(zone_file, options.dry_run)
+            status = apply_plans(conn, plans, options, tracker, snapshots)
+    elif options.jobs > 1:
+        results = sync_zones(zones, \
+            lambda name, zone_file: sync_zone(conn, name, zone_file, options, tracker, snapshots, exporter), \
+            options.jobs)
+        if [result for result in results if not result.ok]:
+            status = 1
+    else:
+        for name, zone_file in zones.iteritems():
+            sync_zone(conn, name, zone_file, options, tracker, snapshots, exporter)
+
+    if tracker is not None and not options.watch and not tracker.wait(conn, options.wait_timeout):
+        status = 3
+
+    if conn.retries > 0:
+        log.warn(conn.report())
+    else:
+        log.info(conn.report())
+    write_stats(conn.stats, options.stats_json, options.prometheus)
+    return status
 
 if __name__ == "__main__":
     sys.exit(main())
@@ -2,6 +2,10 @@
 #
 """ update_host
 Update a single host entry in Amazon r53. If the entry doesn't exist it is created.
+With -f many entries are read from a file, or stdin, one 'fqdn rtype ttl value' per line
+and sent to each zone together.
+With --listen it runs as a daemon taking registrations from many instances and sending them on together,
+which --daemon sends the entries to rather than to route 53.
 """
 
 import logging
@@ -9,9 +13,13 @@ from optparse import OptionParser
 import os
 import sys
 
-import boto
-
+#The modules only some options need are imported once the arguments are checked, this runs at boot on every
+#instance so starting quickly matters. Route 53 is reached with cirrus.connection rather than boto for the same reason.
+from cirrus.client import get_client
+from cirrus.hostedzones import get_index
 from cirrus.r53 import Zone
+from cirrus.records import RecordIndex, RRSet
+from cirrus.stats import write_stats
 
 log = logging.getLogger('cirrus')
 log.addHandler(logging.StreamHandler())
@@ -22,35 +30,97 @@ def get_args(usage):
     parser.add_option('-a', dest='arecord', help="Set host to an a record")
     parser.add_option('-A', dest='alias', help="Route 53 Alias record, specify quoted 'HostedZoneID DNSName'")
     parser.add_option('-c', '--cname', dest='cname', help="Set host to a cname.")
+    parser.add_option('-f', '--file', dest='batch_file', \
+        help="Read 'fqdn rtype ttl value' lines from this file, - for stdin, and update all the hosts.")
     parser.add_option('-t', '--ttl', dest='ttl', type='int', default=3600, help="The ttl for this entry")
+    parser.add_option('-w', '--wait', action='store_true', dest='wait', default=False, \
+        help="Wait until route 53 reports the changes are INSYNC.")
+    parser.add_option('--wait-timeout', dest='wait_timeout', type='int', default=600, \
+        help="The most seconds to wait for changes with --wait.")
+    parser.add_option('--zone-cache', dest='zone_cache', \
+        help="Keep the list of hosted zones in this file so later runs can skip listing them.")
+    parser.add_option('--zone-cache-ttl', dest='zone_cache_ttl', type='int', default=3600, \
+        help="The seconds a zone cache file is used for before the hosted zones are listed again.")
+    parser.add_option('--stats-json', dest='stats_json', \
+        help="Write the route 53 requests made and time taken, per zone and in total, to this json file.")
+    parser.add_option('--prometheus', dest='prometheus', \
+        help="Write the same stats as --stats-json to this Prometheus node exporter textfile.")
+    parser.add_option('--daemon', dest='daemon', \
+        help="Send the entries to the update daemon at this unix socket path or host:port instead of route 53.")
+    parser.add_option('--listen', dest='listen', \
+        help="Run as the update daemon, taking entries on this unix socket path, :port on localhost or host:port.")
+    parser.add_option('--flush-interval', dest='flush_interval', type='float', default=1, \
+        help="The seconds the daemon collects entries for before sending them to route 53.")
+    parser.add_option('--allow-zones', dest='allow_zones', \
+        help="Comma separated zones the daemon accepts entries for, by default any zone.")
+    parser.add_option('--secret-file', dest='secret_file', \
+        help="A file holding the secret the daemon requires clients to send, or the client sends it with --daemon.")
+    parser.add_option('--host-cache-ttl', dest='host_cache_ttl', type='int', default=300, \
+        help="The seconds the daemon trusts a host it set is unchanged, so the same entry needs no request.")
+    parser.add_option('--boto', action='store_true', dest='boto', default=False, \
+        help="Connect to route 53 with boto rather than the smaller built in connection.")
     parser.add_option('-v', '--verbose', action='store_true', dest='verbose', default=False)
 
     return parser.parse_args()
 
-def main():
-    usage = "usage: %prog <fqdn> [domain] <-c [cname] | -a [a record] | -A [Route 53 Alias]>"
-    options, args = get_args(usage)
-    if len(args) < 1 or len(args) > 2:
-        print usage
-        sys.exit(1)
+def get_domain(host):
+    """Return the domain for a host, assumed to be everything after the first label."""
+    if host.count('.') > 1:
+        return host.split('.', 1)[1]
+    else: #must be the domain root
+        return host
+
+def read_hosts(stream, domain=None):
+    """ Read 'fqdn rtype ttl value' lines returning {domain: RecordIndex}.
+    Lines for the same fqdn and rtype are combined into one RRSet with several values.
+    """
+    hosts = {}
+    for number, line in enumerate(stream):
+        line = line.strip()
+        if len(line) == 0 or line[0] == '#':
+            continue
+        words = line.split(None, 3)
+        if len(words) != 4 or not words[2].isdigit():
+            log.error("Skipping line %d, expected 'fqdn rtype ttl value': %s" % (number + 1, line))
+            continue
+        fqdn, rtype, ttl, value = words
+        try:
+            rrset = RRSet.from_text(fqdn, rtype, ttl, [value])
+        except ValueError as e:
+            log.error("Skipping line %d, %s" % (number + 1, e))
+            continue
+        hosts.setdefault(domain or get_domain(fqdn.rstrip('.')), RecordIndex()).add(rrset)
+
+    return hosts
+
+def read_batch(batch_file, domain):
+    """Read the hosts from a batch file, - for stdin, as read_hosts does."""
+    if batch_file == '-':
+        return read_hosts(sys.stdin, domain)
+    return read_hosts(open(batch_file, 'r'), domain)
+
+def update_batch(conn, batch_file, domain, tracker=None):
+    """Update all hosts read from the batch file, returning 2 if any zone doesn't exist."""
+    hosts = read_batch(batch_file, domain)
+
+    status = None
+    for zone_name, zone_hosts in sorted(hosts.iteritems()):
+        r53zone = Zone(conn, zone_name, tracker)
+        if not r53zone.exists():
+            log.error('Zone ' + zone_name + " doesn't exist!")
+            status = 2
+            continue
+        r53zone.update_hosts(zone_hosts)
+
+    return status
+
+def get_entry(args, options, usage):
+    """Return the (fqdn, domain, rtype, value) of the single host entry given by the arguments and options."""
     host = args[0] #host is fqdn
     if len(args) == 2:
         domain = args[1] #domain is zone
     else:
-        if host.count('.') > 1:
-            domain = host.split('.', 1)[1]
-        else: #must be the domain root
-            domain = host
-
-    if not ( os.environ.has_key('AWS_ACCESS_ID') and os.environ.has_key('AWS_SECRET_KEY') ):
-        log.error("Please set environment variables AWS_ACCESS_ID and AWS_SECRET_KEY")
-        sys.exit(1)
-    access_id = os.environ['AWS_ACCESS_ID']
-    secret_key =  os.environ['AWS_SECRET_KEY']
-    if options.verbose:
-        log.setLevel(logging.DEBUG)
-    else:
-        log.setLevel(logging.WARN)
+        domain = get_domain(host)
 
     if options.cname is not None:
         rtype = 'CNAME'
@@ -64,10 +134,134 @@ def main():
     else:
         print usage
         sys.exit(1)
+    return host, domain, rtype, value
+
+def read_secret(secret_file):
+    """Return the secret held in a file, or None if no file is given."""
+    if secret_file is None:
+        return None
+    secret = open(secret_file, 'r').read().strip()
+    if len(secret) == 0:
+        raise ValueError("%s holds no secret" % secret_file)
+    return secret
+
+def send_to_daemon(address, hosts, secret=None):
+    """Send {domain: RecordIndex} to the update daemon, returning 1 if it failed to set any host."""
+    from cirrus.daemon import send_registrations
+    lines = []
+    for zone_name, zone_hosts in sorted(hosts.iteritems()):
+        for key in sorted(zone_hosts):
+            rrset = zone_hosts[key]
+            for value in rrset.text_values():
+                lines.append('%s %s %s %d %s' % (zone_name, rrset.name, rrset.rtype, rrset.ttl, value))
+    try:
+        answers = send_registrations(address, lines, secret=secret)
+    except (IOError, OSError) as e: #socket.error is an IOError
+        log.error("Unable to reach the update daemon at %s: %s" % (address, e))
+        return 1
+
+    status = None
+    for answer in answers:
+        if answer[:6] == 'error ':
+            log.error(answer[6:])
+            status = 1
+        elif answer[:11] == 'superseded ':
+            fqdn, values = (answer[11:].split(None, 1) + [''])[:2]
+            log.warn("%s was set to %s by a later registration" % (fqdn, values))
+        else:
+            log.info(answer)
+    return status
+
+def listen(address, options):
+    """Run as the update daemon until stopped."""
+    from cirrus.daemon import serve, UpdateDaemon
+    allowed_zones = None
+    if options.allow_zones is not None:
+        allowed_zones = [zone_name for zone_name in options.allow_zones.split(',') if zone_name]
+    conn = connect(options)
+    on_flush = lambda: write_stats(conn.stats, options.stats_json, options.prometheus)
+    daemon = UpdateDaemon(conn, options.flush_interval, options.host_cache_ttl, on_flush, \
+        allowed_zones=allowed_zones, secret=read_secret(options.secret_file))
+    try:
+        serve(daemon, address)
+    except ValueError as e:
+        log.error("%s, give --allow-zones or --secret-file" % e)
+        return 1
+    log.info(conn.report())
+    on_flush()
+
+def connect(options):
+    """Return the client for route 53, with the credentials from the environment."""
+    if not ( os.environ.has_key('AWS_ACCESS_ID') and os.environ.has_key('AWS_SECRET_KEY') ):
+        log.error("Please set environment variables AWS_ACCESS_ID and AWS_SECRET_KEY")
+        sys.exit(1)
+    access_id = os.environ['AWS_ACCESS_ID']
+    secret_key =  os.environ['AWS_SECRET_KEY']
+
+    if options.boto:
+        from boto.route53.connection import Route53Connection
+    else:
+        from cirrus.connection import Route53Connection
+    conn = get_client(Route53Connection(access_id, secret_key))
+    if options.zone_cache is not None:
+        get_index(conn, options.zone_cache, options.zone_cache_ttl)
+    return conn
+
+def main():
+    usage = "usage: %prog <fqdn> [domain] <-c [cname] | -a [a record] | -A [Route 53 Alias]>\n" + \
+        "       %prog -f <file> [domain]\n" + \
+        "       %prog --listen <unix socket path | host:port>"
+    options, args = get_args(usage)
+    if options.listen is not None:
+        if len(args) > 0 or options.daemon is not None:
+            print usage
+            sys.exit(1)
+    elif options.batch_file is not None:
+        if len(args) > 1:
+            print usage
+            sys.exit(1)
+    elif len(args) < 1 or len(args) > 2:
+        print usage
+        sys.exit(1)
+
+    if options.verbose:
+        log.setLevel(logging.DEBUG)
+    else:
+        log.setLevel(logging.WARN)
+
+    if options.listen is not None:
+        return listen(options.listen, options)
+    if options.daemon is not None:
+        if options.batch_file is not None:
+            domain = None
+            if len(args) == 1:
+                domain = args[0]
+            return send_to_daemon(options.daemon, read_batch(options.batch_file, domain), \
+                read_secret(options.secret_file))
+        host, domain, rtype, value = get_entry(args, options, usage)
+        hosts = RecordIndex()
+        hosts.add(RRSet.from_text(host, rtype, options.ttl, [value]))
+        return send_to_daemon(options.daemon, {domain: hosts}, read_secret(options.secret_file))
+
+    conn = connect(options)
+    tracker = None
+    if options.wait:
+        from cirrus.changes import ChangeTracker
+        tracker = ChangeTracker()
+
+    if options.batch_file is not None:
+        if len(args) == 1:
+            status = update_batch(conn, options.batch_file, args[0], tracker)
+        else:
+            status = update_batch(conn, options.batch_file, None, tracker)
+        if tracker is not None and not tracker.wait(conn, options.wait_timeout):
+            status = 3
+        log.info(conn.report())
+        write_stats(conn.stats, options.stats_json, options.prometheus)
+        return status
 
-    #Get the connection
-    conn = boto.connect_route53(access_id, secret_key)
-    r53zone = Zone(conn, domain)
+    host, domain, rtype, value = get_entry(args, options, usage)
+    r53zone = Zone(conn, domain, tracker)
 
     if not r53zone.exists():
         log.error('Zone ' + domain + " doesn't exist!")
@@ -78,6 +272,12 @@ def main():
         r53zone.create_host(host, rtype, options.ttl, value)
     else:
         r53zone.update_host(host, rtype, options.ttl, existing, value)
+    status = None
+    if tracker is not None and not tracker.wait(conn, options.wait_timeout):
+        status = 3
+    log.info(conn.report())
+    write_stats(conn.stats, options.stats_json, options.prometheus)
+    return status
 
 if __name__ == "__main__":
     sys.exit(main())
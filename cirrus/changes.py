@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+#
+""" Track changes submitted to route 53 until they have propagated.
+Every ChangeResourceRecordSets and CreateHostedZone response carries a change id which stays PENDING until
+all the route 53 name servers have the change, then becomes INSYNC.
+"""
+
+import logging
+import Queue
+import sys
+import threading
+import time
+
+from cirrus.client import get_client
+
+log = logging.getLogger('cirrus')
+
+class ChangeTracker(object):
+    """ Collects the change ids from submitted requests, possibly from many zones and threads,
+    and waits for all of them together.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = {} #change id: (zone name, time submitted)
+        self.latency = {} #change id: (zone name, seconds from submission until seen INSYNC)
+
+    def add(self, zone_name, response):
+        """Record the change from a route 53 response to a change request."""
+        change_info = response.values()[0]['ChangeInfo']
+        change_id = change_info['Id'].replace('/change/', '')
+        with self.lock:
+            self.pending[change_id] = (zone_name, time.time())
+        log.debug("Tracking change %s for zone %s" % (change_id, zone_name))
+
+    def _poll(self, conn, pending, concurrency):
+        """ Check each pending change once with up to concurrency GetChange requests in flight, sharing the
+        client's rate limit. Returns {change id: seconds from submission until INSYNC} for those now INSYNC.
+        """
+        changes = Queue.Queue()
+        for change_id, (zone_name, submitted) in sorted(pending.items(), key=lambda item: item[1][1]):
+            changes.put(change_id)
+        insync = {}
+        failed = []
+
+        def check():
+            while len(failed) == 0:
+                try:
+                    change_id = changes.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    response = conn.get_change(change_id)
+                except Exception:
+                    failed.append(sys.exc_info())
+                    return
+                if response['GetChangeResponse']['ChangeInfo']['Status'] == 'INSYNC':
+                    insync[change_id] = time.time() - pending[change_id][1]
+
+        threads = []
+        for n in range(min(concurrency, len(pending))):
+            thread = threading.Thread(target=check, name='cirrus-get-change')
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        if len(failed) > 0:
+            raise failed[0][0], failed[0][1], failed[0][2]
+        return insync
+
+    def wait(self, conn, timeout=600, interval=2, concurrency=5):
+        """ Poll route 53 for every pending change on a shared schedule until all are INSYNC or timeout seconds pass.
+        Each round checks all the changes still pending, up to concurrency at once within the client's rate
+        limit, then sleeps interval seconds. The summary counts only the changes this call waited for.
+        Returns true if every change is INSYNC.
+        """
+        conn = get_client(conn)
+        deadline = time.time() + timeout
+        with self.lock:
+            pending = dict(self.pending)
+        if len(pending) > 0:
+            log.warn("Waiting for %d changes to be INSYNC" % len(pending))
+
+        waited = {} #change id: seconds until INSYNC, for the changes of this call
+        while len(pending) > 0:
+            for change_id, latency in self._poll(conn, pending, concurrency).iteritems():
+                zone_name = pending.pop(change_id)[0]
+                log.info("Change %s for zone %s INSYNC after %.1fs" % (change_id, zone_name, latency))
+                waited[change_id] = latency
+                with self.lock:
+                    del self.pending[change_id]
+                    self.latency[change_id] = (zone_name, latency)
+
+            if len(pending) == 0:
+                break
+            if time.time() + interval > deadline:
+                log.error("Timed out with %d changes still pending: %s" % (len(pending), ' '.join(sorted(pending))))
+                return False
+            time.sleep(interval)
+
+        if len(waited) > 0:
+            log.warn("All %d changes INSYNC, the slowest after %.1fs" % (len(waited), max(waited.itervalues())))
+        return True
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+#
+
+import logging
+import random
+import socket
+import threading
+import time
+import weakref
+
+from cirrus.stats import Stats
+
+log = logging.getLogger('cirrus')
+
+#Route 53 error codes which mean the request can be sent again
+RETRY_ERRORS = ('Throttling', 'PriorRequestNotComplete', 'ServiceUnavailable', 'RequestExpired', 'InternalError')
+#Of those, the server errors after which route 53 may still have applied the request
+SERVER_ERRORS = ('ServiceUnavailable', 'InternalError')
+
+class RateLimiter(object):
+    """ A thread safe token bucket.
+    Route 53 allows a limited number of requests a second for each AWS account, every thread sharing a limiter
+    draws from the same bucket so together they stay under that rate.
+    """
+
+    def __init__(self, rate=5, burst=None):
+        self.rate = float(rate)
+        if burst is None:
+            burst = rate
+        self.capacity = float(burst)
+        self.tokens = self.capacity
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token, sleeping until one is available. Returns the seconds spent waiting."""
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+class Route53Client(object):
+    """ Wraps a boto route 53 connection, every call made through it first takes a token from the limiter.
+    Calls rejected because of throttling or other transient errors are retried with jittered exponential
+    backoff, so a multi request update carries on from the request which failed rather than stopping part way.
+    It exposes the connection methods used by cirrus.r53.Zone and can be shared between threads.
+    Each request and retry is counted in stats, a cirrus.stats.Stats, with the zones adding their own counts.
+    """
+
+    def __init__(self, conn, limiter=None, max_retries=8, base_delay=0.5, max_delay=30):
+        self.conn = conn
+        self.limiter = limiter
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.retries = 0
+        self.waited = 0.0
+        self.stats = Stats()
+
+    def _retryable(self, method, e, kwargs):
+        """Return true if the error from calling method means it is safe and worthwhile to try again."""
+        status = getattr(e, 'status', None)
+        server_error = getattr(e, 'error_code', None) in SERVER_ERRORS or (isinstance(status, int) and status >= 500)
+        #A hosted zone may have been created before a server error, only a retry with the same caller_ref is safe
+        if server_error and method == 'create_hosted_zone' and kwargs.get('caller_ref') is None:
+            return False
+        if server_error or getattr(e, 'error_code', None) in RETRY_ERRORS:
+            return True
+        #A change may have been applied before the connection dropped, only reads are retried for these
+        return isinstance(e, socket.error) and method.startswith('get_')
+
+    def _call(self, method, *args, **kwargs):
+        """Call a method on the underlying connection once the limiter allows it, retrying transient errors."""
+        attempt = 0
+        while True:
+            waited = 0.0
+            if self.limiter is not None:
+                waited = self.limiter.acquire()
+            with self.lock:
+                self.calls += 1
+                self.waited += waited
+
+            self.stats.count('api_calls', 1, method)
+            try:
+                with self.stats.span('api', method):
+                    return getattr(self.conn, method)(*args, **kwargs)
+            except Exception as e:
+                if attempt >= self.max_retries or not self._retryable(method, e, kwargs):
+                    raise
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                attempt += 1
+                log.info("Route 53 %s failed, retry %d in %.1fs: %s" % (method, attempt, delay, e))
+                with self.lock:
+                    self.retries += 1
+                    self.waited += delay
+                self.stats.count('retries', 1, method)
+                time.sleep(delay)
+
+    def report(self):
+        """Return a one line summary of the calls made through this client."""
+        return "Route 53 requests: %d, retries: %d, seconds waiting: %.1f" % (self.calls, self.retries, self.waited)
+
+    def change_rrsets(self, hosted_zone_id, xml_body):
+        return self._call('change_rrsets', hosted_zone_id, xml_body)
+
+    def create_hosted_zone(self, domain_name, *args, **kwargs):
+        return self._call('create_hosted_zone', domain_name, *args, **kwargs)
+
+    def delete_hosted_zone(self, hosted_zone_id):
+        return self._call('delete_hosted_zone', hosted_zone_id)
+
+    def get_change(self, change_id):
+        return self._call('get_change', change_id)
+
+    def get_all_hosted_zones(self, *args, **kwargs):
+        return self._call('get_all_hosted_zones', *args, **kwargs)
+
+    def get_all_rrsets(self, hosted_zone_id, *args, **kwargs):
+        return self._call('get_all_rrsets', hosted_zone_id, *args, **kwargs)
+
+_clients = weakref.WeakKeyDictionary()
+_clients_lock = threading.Lock()
+
+def get_client(conn):
+    """ Return the Route53Client for a connection, conn itself if it already is one.
+    Every Zone made with the same connection shares one client and so one rate limit.
+    """
+    if isinstance(conn, Route53Client):
+        return conn
+    with _clients_lock:
+        client = _clients.get(conn)
+        if client is None:
+            client = Route53Client(conn, RateLimiter())
+            _clients[conn] = client
+        return client
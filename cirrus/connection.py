@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+#
+""" A minimal route 53 connection for update_host.py.
+Importing boto to reach route 53 loads hundreds of modules, which is most of the time update_host.py takes
+when it runs at boot. This connection makes the few requests needed to look up and change hosts with httplib
+and signature version 4, and returns what the boto connection returns for them, so cirrus.r53.Zone and
+cirrus.client.Route53Client work with either. Creating and deleting hosted zones still needs boto.
+"""
+
+import hashlib
+import hmac
+import httplib
+import logging
+import socket
+import threading
+import time
+from xml.etree import cElementTree as ElementTree
+
+log = logging.getLogger('cirrus')
+
+HOST = 'route53.amazonaws.com'
+REGION = 'us-east-1'
+SERVICE = 'route53'
+API_VERSION = '2013-04-01'
+XMLNS = '{https://route53.amazonaws.com/doc/%s/}' % API_VERSION
+
+def _quote(value):
+    """Percent encode a string as signature version 4 requires, leaving only unreserved characters."""
+    unreserved = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_.~'
+    return ''.join(char in unreserved and char or '%%%02X' % ord(char) for char in value)
+
+def _hmac(key, msg):
+    return hmac.new(key, msg, hashlib.sha256).digest()
+
+def sign(method, host, path, params, headers, body, access_id, secret_key, timestamp, region=REGION, \
+        service=SERVICE):
+    """ Return the signature version 4 Authorization header for a request. Headers must hold every header
+    to sign, including host and x-amz-date, with lower case names. Timestamp is seconds since the epoch.
+    """
+    amz_date = time.strftime('%Y%m%dT%H%M%SZ', time.gmtime(timestamp))
+    scope = '%s/%s/%s/aws4_request' % (amz_date[:8], region, service)
+    query = '&'.join('%s=%s' % (_quote(key), _quote(value)) for key, value in sorted(params.iteritems()))
+    signed_headers = ';'.join(sorted(headers))
+    canonical_headers = ''.join('%s:%s\n' % (name, ' '.join(headers[name].split())) for name in sorted(headers))
+    canonical_request = '\n'.join([method, '/'.join(_quote(part) for part in path.split('/')), query, \
+        canonical_headers, signed_headers, hashlib.sha256(body).hexdigest()])
+    string_to_sign = '\n'.join(['AWS4-HMAC-SHA256', amz_date, scope, hashlib.sha256(canonical_request).hexdigest()])
+
+    key = _hmac('AWS4' + secret_key, amz_date[:8])
+    for part in (region, service, 'aws4_request'):
+        key = _hmac(key, part)
+    signature = hmac.new(key, string_to_sign, hashlib.sha256).hexdigest()
+    return 'AWS4-HMAC-SHA256 Credential=%s/%s, SignedHeaders=%s, Signature=%s' % \
+        (access_id, scope, signed_headers, signature)
+
+class Route53Error(Exception):
+    """An error response from route 53, with the status, error_code and message of a boto DNSServerError."""
+
+    def __init__(self, status, reason, body=''):
+        Exception.__init__(self, status, reason, body)
+        self.status = status
+        self.reason = reason
+        self.body = body
+        self.error_code = None
+        self.message = ''
+        try:
+            error = ElementTree.fromstring(body).find('%sError' % XMLNS)
+        except SyntaxError:
+            error = None
+        if error is not None:
+            self.error_code = error.findtext(XMLNS + 'Code')
+            self.message = error.findtext(XMLNS + 'Message') or ''
+
+    def __str__(self):
+        return '%s %s: %s %s' % (self.status, self.reason, self.error_code, self.message)
+
+class Record(object):
+    """A resource record set with the attributes of a boto.route53.record.Record which cirrus uses."""
+
+    def __init__(self, element):
+        self.name = element.findtext(XMLNS + 'Name')
+        self.type = element.findtext(XMLNS + 'Type')
+        self.ttl = element.findtext(XMLNS + 'TTL') or 600
+        self.identifier = element.findtext(XMLNS + 'SetIdentifier')
+        self.resource_records = [value.text for value in element.iter(XMLNS + 'Value')]
+        self.alias_hosted_zone_id = element.findtext('%sAliasTarget/%sHostedZoneId' % (XMLNS, XMLNS))
+        self.alias_dns_name = element.findtext('%sAliasTarget/%sDNSName' % (XMLNS, XMLNS))
+
+class ResourceRecordSets(list):
+    """One page of a listing, with the is_truncated, next_record_name and next_record_type boto sets."""
+    is_truncated = False
+    next_record_name = None
+    next_record_type = None
+
+class Route53Connection(object):
+    """ Makes get_all_hosted_zones, get_all_rrsets, change_rrsets and get_change requests over one kept alive
+    https connection. Requests are made one at a time, a connection may be shared by threads.
+    """
+
+    def __init__(self, access_id, secret_key, host=HOST, timeout=30):
+        self.access_id = access_id
+        self.secret_key = secret_key
+        self.host = host
+        self.timeout = timeout
+        self.http = None
+        self.lock = threading.Lock()
+
+    def _send(self, method, path, params, body):
+        """Send a signed request on the kept alive connection, returning (status, reason, body)."""
+        now = time.time()
+        headers = {'host': self.host, 'x-amz-date': time.strftime('%Y%m%dT%H%M%SZ', time.gmtime(now))}
+        headers['authorization'] = sign(method, self.host, path, params, headers, body, self.access_id, \
+            self.secret_key, now)
+        if len(params) > 0:
+            path += '?' + '&'.join('%s=%s' % (_quote(key), _quote(value)) \
+                for key, value in sorted(params.iteritems()))
+        if body:
+            headers['content-type'] = 'text/xml'
+
+        if self.http is None:
+            self.http = httplib.HTTPSConnection(self.host, timeout=self.timeout)
+        self.http.request(method, path, body, headers)
+        response = self.http.getresponse()
+        return response.status, response.reason, response.read()
+
+    def _request(self, method, path, params=None, body=''):
+        """Make a request and return the parsed xml of the response, raising Route53Error for an error response."""
+        params = dict((key, str(value)) for key, value in (params or {}).iteritems() if value is not None)
+        path = '/%s/%s' % (API_VERSION, path)
+        with self.lock:
+            reused = self.http is not None
+            try:
+                status, reason, data = self._send(method, path, params, body)
+            except (socket.error, httplib.HTTPException) as e:
+                self.http.close()
+                self.http = None
+                #route 53 may have closed a kept alive connection, only a read is safe to send again
+                if not reused or method != 'GET':
+                    raise
+                log.debug("Reconnecting to %s after %s" % (self.host, e))
+                status, reason, data = self._send(method, path, params, body)
+
+        log.debug("%s %s %s" % (method, path, status))
+        if status >= 300:
+            raise Route53Error(status, reason, data)
+        return ElementTree.fromstring(data)
+
+    def _change_info(self, root, response_name):
+        change_info = root.find(XMLNS + 'ChangeInfo')
+        return {response_name: {'ChangeInfo': dict((child.tag.replace(XMLNS, ''), child.text) \
+            for child in change_info)}}
+
+    def get_all_hosted_zones(self, start_marker=None, zone_list=None):
+        root = self._request('GET', 'hostedzone', {'marker': start_marker})
+        zones = []
+        for zone in root.iter(XMLNS + 'HostedZone'):
+            zones.append(dict((child.tag.replace(XMLNS, ''), child.text) for child in zone if len(child) == 0))
+        response = {'HostedZones': zones, 'IsTruncated': root.findtext(XMLNS + 'IsTruncated')}
+        if root.findtext(XMLNS + 'NextMarker') is not None:
+            response['NextMarker'] = root.findtext(XMLNS + 'NextMarker')
+        return {'ListHostedZonesResponse': response}
+
+    def get_all_rrsets(self, hosted_zone_id, type=None, name=None, identifier=None, maxitems=None):
+        root = self._request('GET', 'hostedzone/%s/rrset' % hosted_zone_id, \
+            {'type': type, 'name': name, 'identifier': identifier, 'maxitems': maxitems})
+        rrsets = ResourceRecordSets(Record(element) for element in root.iter(XMLNS + 'ResourceRecordSet'))
+        rrsets.is_truncated = root.findtext(XMLNS + 'IsTruncated') == 'true'
+        rrsets.next_record_name = root.findtext(XMLNS + 'NextRecordName')
+        rrsets.next_record_type = root.findtext(XMLNS + 'NextRecordType')
+        return rrsets
+
+    def change_rrsets(self, hosted_zone_id, xml_body):
+        root = self._request('POST', 'hostedzone/%s/rrset' % hosted_zone_id, body=xml_body)
+        return self._change_info(root, 'ChangeResourceRecordSetsResponse')
+
+    def get_change(self, change_id):
+        root = self._request('GET', 'change/%s' % change_id.replace('/change/', ''))
+        return self._change_info(root, 'GetChangeResponse')
@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+#
+""" A local daemon which takes host registrations from many instances and sends them to route 53 together.
+Instances connect over a unix or tcp socket and send lines of '<zone> <fqdn> <rtype> <ttl> <value>', as
+update_host.py --daemon does. Registrations for the same host and type are coalesced, the latest wins, and every interval
+the hosts registered in each zone are set with one Zone.update_hosts call, so a boot storm costs a few packed
+change batches rather than a lookup and a change for every instance. The entry last set for each host and type
+is kept, a registration matching it is answered without a request at all.
+Once its registrations are flushed a client is sent a line for each host, 'ok <fqdn>', 'error <fqdn> <message>' or,
+if a later registration for the host and type replaced its value, 'superseded <fqdn> <values written>'.
+The daemon sets records in any zone its credentials cover, so it can be limited to a list of zones and can require
+clients to first send the line 'auth <secret>'. A tcp address, reachable by other hosts, needs at least one of them.
+"""
+
+import hmac
+import logging
+import os
+import signal
+import socket
+import SocketServer
+import stat
+import sys
+import threading
+import time
+
+from cirrus.hostedzones import get_index
+from cirrus.r53 import Zone, _fqdn
+from cirrus.records import RecordIndex, RRSet
+
+log = logging.getLogger('cirrus')
+
+class Registration(object):
+    """ A host entry waiting to be flushed to route 53. Once it has been, error is set if it failed and
+    superseded to the RRSet written instead if a later registration replaced it.
+    """
+
+    def __init__(self, zone_name, rrset):
+        self.zone_name = zone_name
+        self.rrset = rrset
+        self.done = threading.Event()
+        self.error = None
+        self.superseded = None
+
+    def finish(self, error=None, superseded=None):
+        self.error = error
+        self.superseded = superseded
+        self.done.set()
+
+class UpdateDaemon(object):
+    """ Coalesces host registrations and flushes them to route 53 a zone at a time every interval seconds.
+    A host set is remembered for cache_ttl seconds, after that a registration is checked with route 53 again.
+    On_flush, if given, is called after each flush that sent anything. A client waits at most answer_timeout
+    seconds for its registrations to be flushed before it is answered with an error.
+    With allowed_zones, a list of zone names, registrations for any other zone are refused. With secret a client
+    must send 'auth <secret>' before its registrations.
+    """
+
+    def __init__(self, conn, interval=1.0, cache_ttl=300, on_flush=None, answer_timeout=30, allowed_zones=None, \
+            secret=None):
+        self.conn = conn
+        self.stats = conn.stats
+        self.interval = interval
+        self.cache_ttl = cache_ttl
+        self.on_flush = on_flush
+        self.answer_timeout = answer_timeout
+        self.allowed_zones = None
+        if allowed_zones is not None:
+            self.allowed_zones = set(zone_name.rstrip('.').lower() for zone_name in allowed_zones)
+        self.secret = secret
+        self.lock = threading.Lock()
+        self.pending = {} #zone name: {(fqdn, rtype): [Registration, ]}, the last registration of each is sent
+        self.cache = {} #(fqdn, rtype): (RRSet, time it was set)
+        self.zones = {} #zone name: Zone
+        self.missing = {} #zone name: time a fresh listing of the hosted zones last didn't have it
+        self.stopped = threading.Event()
+
+    def register(self, zone_name, rrset):
+        """Queue a host entry returning its Registration, which is already finished if the entry is known set."""
+        zone_name = zone_name.rstrip('.').lower()
+        key = (_fqdn(rrset.name), rrset.rtype)
+        registration = Registration(zone_name, rrset)
+        self.stats.count('registrations')
+        if self.allowed_zones is not None and zone_name not in self.allowed_zones:
+            registration.finish("Zone %s is not one this daemon updates" % zone_name)
+            return registration
+        with self.lock:
+            hosts = self.pending.setdefault(zone_name, {})
+            cached = self.cache.get(key)
+            if key not in hosts and cached is not None and time.time() - cached[1] < self.cache_ttl and \
+                    cached[0].matches(rrset):
+                self.stats.count('host_cache_hits')
+                registration.finish()
+                return registration
+            if key in hosts:
+                self.stats.count('registrations_coalesced')
+            hosts.setdefault(key, []).append(registration)
+        return registration
+
+    def _zone(self, zone_name):
+        """ Return the Zone for a zone name, None if there is no such hosted zone.
+        A zone missing from the hosted zone index, as one created since the daemon started is, is looked for in a
+        fresh listing, at most once every cache_ttl seconds for each name.
+        """
+        zone = self.zones.get(zone_name)
+        if zone is None:
+            zone = Zone(self.conn, zone_name)
+            if not zone.exists():
+                missing = self.missing.get(zone_name)
+                if missing is not None and time.time() - missing < self.cache_ttl:
+                    return None
+                log.info("Zone %s isn't known, listing the hosted zones again" % zone_name)
+                get_index(self.conn).refresh()
+                if not zone.exists():
+                    self.missing[zone_name] = time.time()
+                    return None
+            self.missing.pop(zone_name, None)
+            self.zones[zone_name] = zone
+        return zone
+
+    def flush(self):
+        """ Set the hosts registered since the last flush, one update_hosts call for each zone.
+        Returns the host entries sent, one for each host and type.
+        """
+        with self.lock:
+            pending = self.pending
+            self.pending = {}
+
+        sent = 0
+        for zone_name, hosts in sorted(pending.iteritems()):
+            if len(hosts) == 0:
+                continue
+            rrsets = RecordIndex()
+            for registrations in hosts.itervalues():
+                rrsets.add(registrations[-1].rrset)
+
+            error = None
+            try:
+                zone = self._zone(zone_name)
+                if zone is None:
+                    error = "Zone %s doesn't exist" % zone_name
+                else:
+                    zone.update_hosts(rrsets)
+            except Exception as e:
+                log.debug('Error flushing zone %s' % zone_name, exc_info=True)
+                error = str(e) or e.__class__.__name__
+            if error is not None:
+                log.error("Unable to set %d hosts in zone %s: %s" % (len(hosts), zone_name, error))
+
+            now = time.time()
+            fqdns = set(fqdn for fqdn, rtype in hosts)
+            with self.lock:
+                #update_hosts may have replaced an entry of another type, so forget those of the hosts sent
+                for key in [key for key in self.cache if key[0] in fqdns and key not in hosts]:
+                    del self.cache[key]
+                for key, registrations in hosts.iteritems():
+                    if error is None:
+                        self.cache[key] = (registrations[-1].rrset, now)
+                    else:
+                        self.cache.pop(key, None)
+            for registrations in hosts.itervalues():
+                written = registrations[-1].rrset
+                for registration in registrations:
+                    if error is None and not registration.rrset.matches(written):
+                        registration.finish(superseded=written)
+                    else:
+                        registration.finish(error)
+            sent += len(hosts)
+
+        if sent > 0 and self.on_flush is not None:
+            self.on_flush()
+        return sent
+
+    def _flush(self):
+        """Flush, logging rather than raising any error so the flusher keeps running."""
+        try:
+            self.flush()
+        except Exception:
+            log.exception('Error flushing registrations')
+
+    def run(self):
+        """Flush every interval until stop is called, then flush whatever is left."""
+        while not self.stopped.wait(self.interval):
+            self._flush()
+        self._flush()
+
+    def stop(self):
+        self.stopped.set()
+
+class _RegistrationHandler(SocketServer.StreamRequestHandler):
+    """ Reads the registration lines of one client until it closes its side, waits for them to be flushed then
+    answers with a line for each host.
+    """
+
+    def handle(self):
+        daemon = self.server.update_daemon
+        hosts = {} #zone name: RecordIndex, several lines for a host and type are one entry with several values
+        answers = []
+        authorized = daemon.secret is None
+        for number, line in enumerate(self.rfile):
+            line = line.strip()
+            if len(line) == 0 or line[0] == '#':
+                continue
+            if not authorized:
+                if line[:5] != 'auth ' or not hmac.compare_digest(line[5:].strip(), daemon.secret):
+                    log.warn("Refused registrations from %s, it didn't authenticate" % (self.client_address,))
+                    self.wfile.write("error - not authorized\n")
+                    return
+                authorized = True
+                continue
+            words = line.split(None, 4)
+            if len(words) != 5 or not words[3].isdigit():
+                answers.append("error - line %d, expected '<zone> <fqdn> <rtype> <ttl> <value>'" % (number + 1))
+                continue
+            zone_name, fqdn, rtype, ttl, value = words
+            try:
+                rrset = RRSet.from_text(fqdn, rtype, ttl, [value])
+            except ValueError as e:
+                answers.append("error %s %s" % (fqdn, e))
+                continue
+            hosts.setdefault(zone_name, RecordIndex()).add(rrset)
+
+        registrations = [daemon.register(zone_name, rrset) \
+            for zone_name, rrsets in hosts.iteritems() for rrset in rrsets.itervalues()]
+        deadline = time.time() + daemon.answer_timeout
+        for registration in registrations:
+            if not registration.done.wait(max(deadline - time.time(), 0)):
+                answers.append("error %s not flushed within %ds" % (registration.rrset.name, daemon.answer_timeout))
+            elif registration.superseded is not None:
+                answers.append("superseded %s %s" % (registration.rrset.name, \
+                    ' '.join(registration.superseded.text_values())))
+            elif registration.error is None:
+                answers.append("ok %s" % registration.rrset.name)
+            else:
+                answers.append("error %s %s" % (registration.rrset.name, registration.error))
+        self.wfile.write(''.join(answer + '\n' for answer in answers))
+
+class _UnixServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+    request_queue_size = socket.SOMAXCONN #Instances booting together all connect at once
+
+class _TCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = socket.SOMAXCONN
+
+def parse_address(address):
+    """Return (socket family, address) for 'host:port', ':port' for localhost, or a unix socket path."""
+    if '/' not in address and ':' in address:
+        host, port = address.rsplit(':', 1)
+        return socket.AF_INET, (host or '127.0.0.1', int(port))
+    return socket.AF_UNIX, address
+
+def serve(daemon, address):
+    """ Take registrations on address, a unix socket path or host:port, until interrupted or terminated.
+    Raises ValueError for a tcp address if the daemon has neither allowed zones nor a secret.
+    """
+    family, server_address = parse_address(address)
+    if family != socket.AF_UNIX and daemon.allowed_zones is None and daemon.secret is None:
+        raise ValueError("Registrations over tcp on %s need a list of allowed zones or a secret" % address)
+    if family == socket.AF_UNIX:
+        if os.path.exists(server_address) and stat.S_ISSOCK(os.stat(server_address).st_mode):
+            os.remove(server_address) #Left by a daemon which didn't stop cleanly
+        server = _UnixServer(server_address, _RegistrationHandler)
+    else:
+        server = _TCPServer(server_address, _RegistrationHandler)
+    server.update_daemon = daemon
+
+    flusher = threading.Thread(target=daemon.run, name='cirrus-flush')
+    flusher.daemon = True
+    flusher.start()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    log.warn("Taking host registrations on %s" % address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        daemon.stop()
+        flusher.join()
+        if family == socket.AF_UNIX and os.path.exists(server_address):
+            os.remove(server_address)
+        log.warn("Stopped taking host registrations")
+
+def send_registrations(address, lines, timeout=60, secret=None):
+    """ Send registration lines to the daemon at address and return the lines it answers with, once the
+    registrations are flushed. With secret the lines are sent after authenticating with it.
+    """
+    if secret is not None:
+        lines = ['auth ' + secret] + list(lines)
+    family, server_address = parse_address(address)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(server_address)
+        sock.sendall(''.join(line + '\n' for line in lines))
+        sock.shutdown(socket.SHUT_WR)
+        answers = sock.makefile('r')
+        return [answer.rstrip('\n') for answer in answers]
+    finally:
+        sock.close()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+#
+""" Write the record sets of route 53 zones out as they are listed, for audits and backups.
+Zone.export hands each page to an Exporter as it arrives, so only a page of a zone is held in memory at once.
+One Exporter can be shared by zones exported from several threads, each page is written whole.
+In bind format an alias is written as the TXT record '_alias.<name>' with the value 'Alias <hosted zone id>
+<dns name>', the form cirrus reads from zone files, in json lines and csv as that value of the record set.
+"""
+
+import json
+import threading
+
+#Format: file extension
+EXTENSIONS = {'bind': 'zone', 'jsonl': 'jsonl', 'csv': 'csv'}
+FORMATS = sorted(EXTENSIONS)
+
+CSV_COLUMNS = ['zone', 'name', 'type', 'ttl', 'value']
+
+class Exporter(object):
+    """Writes record sets from one or more zones to a file object in the bind, jsonl or csv format."""
+
+    def __init__(self, out, fmt='bind'):
+        if fmt not in EXTENSIONS:
+            raise ValueError("Unknown export format %s, use one of %s" % (fmt, ', '.join(FORMATS)))
+        self.out = out
+        self.fmt = fmt
+        self.lock = threading.Lock()
+        self.records = 0
+        if fmt == 'csv':
+            import csv
+            self.csv = csv.writer(out, lineterminator='\n')
+            self.csv.writerow(CSV_COLUMNS)
+
+    def start(self, zone_name, zone_id):
+        """Begin a zone, in bind format with a comment naming it."""
+        if self.fmt == 'bind':
+            with self.lock:
+                self.out.write("; Zone %s ID: %s\n" % (zone_name, zone_id))
+
+    def write(self, zone_name, rrsets):
+        """Write a page of RRSets from a zone, none of another zone's records are written in between."""
+        if self.fmt == 'csv':
+            rows = [[zone_name, rrset.name, rrset.rtype, rrset.ttl, value] \
+                for rrset in rrsets for value in rrset.text_values()]
+            with self.lock:
+                self.csv.writerows(rows)
+                self.records += len(rrsets)
+            return
+
+        if self.fmt == 'jsonl':
+            lines = [json.dumps({'zone': zone_name, 'name': rrset.name, 'type': rrset.rtype, 'ttl': rrset.ttl, \
+                'values': rrset.text_values()}, sort_keys=True) + '\n' for rrset in rrsets]
+        else:
+            lines = [line for rrset in rrsets for line in _bind_lines(rrset)]
+        data = ''.join(lines)
+        with self.lock:
+            self.out.write(data)
+            self.records += len(rrsets)
+
+def _bind_lines(rrset):
+    """Return the bind zone file lines for an RRSet, an alias as an _alias TXT record."""
+    lines = []
+    if rrset.alias is not None:
+        lines.append('_alias.%s\t%d\tIN\tTXT\t"%s"\n' % (rrset.name, rrset.ttl, rrset.alias))
+    for value in rrset.values:
+        lines.append('%s\t%d\tIN\t%s\t%s\n' % (rrset.name, rrset.ttl, rrset.rtype, value))
+    return lines
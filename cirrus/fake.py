@@ -0,0 +1,338 @@
+#!/usr/bin/env python
+#
+""" An in memory stand in for a boto route 53 connection.
+It implements the calls cirrus.r53.Zone makes, paginates and validates the way route 53 does and counts every
+call, so Zone can be exercised and measured without AWS. Latency and throttling can be injected to see how
+code behaves against a slow or busy account.
+"""
+
+import itertools
+import re
+import threading
+import time
+import xml.etree.cElementTree as ElementTree
+
+from cirrus.r53 import ChangeBatch, _route53_order
+
+XMLNS = '{https://route53.amazonaws.com/doc/2013-04-01/}'
+RTYPES = ('A', 'AAAA', 'CAA', 'CNAME', 'MX', 'NAPTR', 'NS', 'PTR', 'SOA', 'SPF', 'SRV', 'TXT')
+
+class FakeRoute53Error(Exception):
+    """Raised for a failed request, with the same status and error_code attributes as boto's DNSServerError."""
+
+    def __init__(self, status, error_code, message):
+        Exception.__init__(self, "%d %s: %s" % (status, error_code, message))
+        self.status = status
+        self.reason = error_code
+        self.error_code = error_code
+        self.message = message
+
+class FakeRecord(object):
+    """A rrset as returned by get_all_rrsets, with the attributes of a boto.route53.record.Record."""
+
+    def __init__(self, name, type, ttl, resource_records, alias_hosted_zone_id=None, alias_dns_name=None):
+        self.name = name
+        self.type = type
+        self.ttl = ttl
+        self.resource_records = resource_records
+        self.alias_hosted_zone_id = alias_hosted_zone_id
+        self.alias_dns_name = alias_dns_name
+
+class FakeResultSet(list):
+    """A page of rrsets with the paging attributes of a boto.route53.record.ResourceRecordSets."""
+    is_truncated = False
+    next_record_name = None
+    next_record_type = None
+    next_record_identifier = None
+
+class FakeZone(object):
+    """A hosted zone's rrsets keyed by (lower case name, type) along with a lazily sorted list of the keys."""
+
+    def __init__(self, zone_id, name):
+        self.id = zone_id
+        self.name = name
+        self.rrsets = {}
+        self.order = []
+        self.sorted = True
+
+    def put(self, key, rrset):
+        if key not in self.rrsets:
+            self.sorted = False
+        self.rrsets[key] = rrset
+
+    def keys_from(self, name=None, rtype=None):
+        """Iterate the keys in route 53 order starting at name and rtype."""
+        if not self.sorted:
+            self.order = sorted(self.rrsets.iterkeys(), key=_sort_key)
+            self.sorted = True
+        start = 0
+        if name is not None:
+            start = _bisect(self.order, (_route53_order(name), rtype or ''))
+        for key in itertools.islice(self.order, start, None):
+            if key in self.rrsets: #Deleted keys stay in the order until it is next sorted
+                yield key
+
+def _sort_key(key):
+    return (_route53_order(key[0]), key[1])
+
+def _bisect(order, target):
+    """Return the index of the first key in the sorted order not less than target."""
+    low, high = 0, len(order)
+    while low < high:
+        middle = (low + high) // 2
+        if _sort_key(order[middle]) < target:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+def _escape(name):
+    """Return a name the way route 53 returns it, lower case with special characters as octal escapes."""
+    return re.sub(r'[^a-z0-9\-_.]', lambda match: '\\%03o' % ord(match.group(0)), name)
+
+def _unescape(name):
+    return re.sub(r'\\([0-7]{3})', lambda match: chr(int(match.group(1), 8)), name)
+
+def _canonical(name):
+    name = _unescape(name).lower()
+    if name[-1:] != '.':
+        name += '.'
+    return name
+
+class FakeRoute53Connection(object):
+    """ Implements get_all_rrsets, change_rrsets, get_change and the hosted zone calls of a boto route 53
+    connection in memory. Calls are counted by name in self.calls.
+    latency is the seconds each call sleeps, throttle_rate the requests a second allowed before calls fail with
+    Throttling, sync_delay the seconds a change stays PENDING and page_size the rrsets and zones listed per call.
+    """
+
+    def __init__(self, latency=0, throttle_rate=None, sync_delay=0, page_size=100):
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.sync_delay = sync_delay
+        self.page_size = page_size
+        self.zones = {}
+        self.changes = {}
+        self.caller_refs = set()
+        self.calls = {}
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.tokens = throttle_rate
+        self.last = time.time()
+
+    def _request(self, method):
+        """Count, delay and possibly throttle a call."""
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            if self.throttle_rate is not None:
+                now = time.time()
+                self.tokens = min(self.throttle_rate, self.tokens + (now - self.last) * self.throttle_rate)
+                self.last = now
+                if self.tokens < 1:
+                    self.calls['throttled'] = self.calls.get('throttled', 0) + 1
+                    raise FakeRoute53Error(400, 'Throttling', 'Rate exceeded')
+                self.tokens -= 1
+
+    def _zone(self, hosted_zone_id):
+        zone = self.zones.get(hosted_zone_id.replace('/hostedzone/', ''))
+        if zone is None:
+            raise FakeRoute53Error(404, 'NoSuchHostedZone', 'No hosted zone found with ID: ' + hosted_zone_id)
+        return zone
+
+    def _change_info(self):
+        change_id = 'C%08d' % self.ids.next()
+        self.changes[change_id] = time.time()
+        return {'Id': '/change/' + change_id, 'Status': 'PENDING', \
+            'SubmittedAt': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())}
+
+    def reset_calls(self):
+        with self.lock:
+            self.calls = {}
+
+    def add_zone(self, name):
+        """Create a hosted zone without counting a call, returning its id."""
+        with self.lock:
+            zone_id = 'Z%012d' % self.ids.next()
+            name = _canonical(name)
+            zone = FakeZone(zone_id, name)
+            zone.put((name, 'SOA'), FakeRecord(name, 'SOA', '900', \
+                ['ns-1.fake.invalid. hostmaster.fake.invalid. 1 7200 900 1209600 86400']))
+            zone.put((name, 'NS'), FakeRecord(name, 'NS', '172800', ['ns-%d.fake.invalid.' % n for n in range(1, 5)]))
+            self.zones[zone_id] = zone
+            return zone_id
+
+    def add_rrset(self, zone_id, name, rtype, ttl=300, values=(), alias=None):
+        """Add or replace a rrset without counting a call, alias is a (hosted zone id, dns name) tuple."""
+        name = _canonical(name)
+        if alias is not None:
+            rrset = FakeRecord(_escape(name), rtype, 600, [], alias[0], alias[1])
+        else:
+            rrset = FakeRecord(_escape(name), rtype, str(ttl), list(values))
+        with self.lock:
+            self.zones[zone_id].put((name, rtype), rrset)
+
+    def get_all_hosted_zones(self, start_marker=None, zone_list=None):
+        self._request('get_all_hosted_zones')
+        with self.lock:
+            zone_ids = sorted(self.zones)
+            if start_marker is not None:
+                zone_ids = [zone_id for zone_id in zone_ids if zone_id >= start_marker]
+            hosted_zones = []
+            for zone_id in zone_ids[:self.page_size]:
+                zone = self.zones[zone_id]
+                hosted_zones.append({'Id': '/hostedzone/' + zone_id, 'Name': zone.name, \
+                    'CallerReference': zone_id, 'Config': {}, 'ResourceRecordSetCount': str(len(zone.rrsets))})
+        response = {'HostedZones': hosted_zones, 'MaxItems': str(self.page_size), 'IsTruncated': 'false'}
+        if len(zone_ids) > self.page_size:
+            response['IsTruncated'] = 'true'
+            response['NextMarker'] = zone_ids[self.page_size]
+        return {'ListHostedZonesResponse': response}
+
+    def create_hosted_zone(self, domain_name, caller_ref=None, comment=''):
+        self._request('create_hosted_zone')
+        if caller_ref is not None:
+            with self.lock:
+                if caller_ref in self.caller_refs:
+                    raise FakeRoute53Error(409, 'HostedZoneAlreadyExists', \
+                        'A hosted zone has already been created with the specified caller reference.')
+                self.caller_refs.add(caller_ref)
+        zone_id = self.add_zone(domain_name)
+        zone = self.zones[zone_id]
+        with self.lock:
+            change_info = self._change_info()
+        return {'CreateHostedZoneResponse': {'HostedZone': {'Id': '/hostedzone/' + zone_id, 'Name': zone.name}, \
+            'ChangeInfo': change_info, 'DelegationSet': {'NameServers': ['ns-%d.fake.invalid' % n for n in range(1, 5)]}}}
+
+    def delete_hosted_zone(self, hosted_zone_id):
+        self._request('delete_hosted_zone')
+        with self.lock:
+            zone = self._zone(hosted_zone_id)
+            for name, rtype in zone.rrsets:
+                if name != zone.name or rtype not in ('SOA', 'NS'):
+                    raise FakeRoute53Error(400, 'HostedZoneNotEmpty', 'The hosted zone contains resource records')
+            del self.zones[zone.id]
+            return {'DeleteHostedZoneResponse': {'ChangeInfo': self._change_info()}}
+
+    def get_all_rrsets(self, hosted_zone_id, type=None, name=None, identifier=None, maxitems=None):
+        self._request('get_all_rrsets')
+        if type is not None and name is None:
+            raise FakeRoute53Error(400, 'InvalidInput', 'The type can only be given with a name')
+        maxitems = int(maxitems or self.page_size)
+        with self.lock:
+            zone = self._zone(hosted_zone_id)
+            if name is not None:
+                name = _canonical(name)
+            keys = list(itertools.islice(zone.keys_from(name, type), maxitems + 1))
+            page = FakeResultSet(zone.rrsets[key] for key in keys[:maxitems])
+        if len(keys) > maxitems:
+            page.is_truncated = True
+            page.next_record_name = _escape(keys[maxitems][0])
+            page.next_record_type = keys[maxitems][1]
+        return page
+
+    def get_change(self, change_id):
+        self._request('get_change')
+        change_id = change_id.replace('/change/', '')
+        with self.lock:
+            submitted = self.changes.get(change_id)
+        if submitted is None:
+            raise FakeRoute53Error(404, 'NoSuchChange', 'Could not find change with ID ' + change_id)
+        status = 'PENDING'
+        if time.time() - submitted >= self.sync_delay:
+            status = 'INSYNC'
+        return {'GetChangeResponse': {'ChangeInfo': {'Id': '/change/' + change_id, 'Status': status}}}
+
+    def _parse_change(self, change):
+        """Return (action, key, rrset, records, characters) for a Change element."""
+        def text(element, tag):
+            found = element.find(XMLNS + tag)
+            if found is None or found.text is None:
+                raise FakeRoute53Error(400, 'InvalidInput', 'Missing ' + tag)
+            return found.text.strip()
+
+        action = text(change, 'Action')
+        if action not in ('CREATE', 'DELETE', 'UPSERT'):
+            raise FakeRoute53Error(400, 'InvalidInput', 'Invalid action ' + action)
+        rrset = change.find(XMLNS + 'ResourceRecordSet')
+        if rrset is None:
+            raise FakeRoute53Error(400, 'InvalidInput', 'Missing ResourceRecordSet')
+        name = _canonical(text(rrset, 'Name'))
+        rtype = text(rrset, 'Type')
+
+        alias = rrset.find(XMLNS + 'AliasTarget')
+        if alias is not None:
+            dns_name = text(alias, 'DNSName')
+            record = FakeRecord(_escape(name), rtype, 600, [], text(alias, 'HostedZoneId'), dns_name)
+            records, characters = 1, len(dns_name)
+        else:
+            values = [value.text or '' for value in rrset.iter(XMLNS + 'Value')]
+            if len(values) == 0:
+                raise FakeRoute53Error(400, 'InvalidInput', 'No ResourceRecords for ' + name)
+            record = FakeRecord(_escape(name), rtype, text(rrset, 'TTL'), values)
+            records, characters = len(values), sum(len(value) for value in values)
+        if action == 'UPSERT':
+            records *= 2
+            characters *= 2
+        return action, (name, rtype), record, records, characters
+
+    def change_rrsets(self, hosted_zone_id, xml_body):
+        self._request('change_rrsets')
+        try:
+            root = ElementTree.fromstring(xml_body)
+        except SyntaxError as e:
+            raise FakeRoute53Error(400, 'InvalidInput', 'Invalid XML: %s' % e)
+        if root.tag != XMLNS + 'ChangeResourceRecordSetsRequest':
+            raise FakeRoute53Error(400, 'InvalidInput', 'Unexpected root element ' + root.tag)
+        changes = [self._parse_change(change) for change in root.iter(XMLNS + 'Change')]
+        if len(changes) == 0:
+            raise FakeRoute53Error(400, 'InvalidInput', 'No changes')
+        if sum(change[3] for change in changes) > ChangeBatch.MAX_RECORDS:
+            raise FakeRoute53Error(400, 'InvalidChangeBatch', 'Number of records limit of 1000 exceeded.')
+        if sum(change[4] for change in changes) > ChangeBatch.MAX_CHARS:
+            raise FakeRoute53Error(400, 'InvalidChangeBatch', 'Number of characters limit of 32000 exceeded.')
+
+        with self.lock:
+            zone = self._zone(hosted_zone_id)
+            staged = {} #Changes apply in order and only take effect if the whole batch is valid
+            def current(key):
+                if key in staged:
+                    return staged[key]
+                return zone.rrsets.get(key)
+
+            for action, key, record, records, characters in changes:
+                if key[0] != zone.name and not key[0].endswith('.' + zone.name):
+                    raise FakeRoute53Error(400, 'InvalidChangeBatch', '%s is not in zone %s' % (key[0], zone.name))
+                existing = current(key)
+                if action == 'CREATE' and existing is not None:
+                    raise FakeRoute53Error(400, 'InvalidChangeBatch', \
+                        "Tried to create resource record set %s type %s but it already exists" % key)
+                if action == 'DELETE':
+                    if existing is None or not _same(existing, record):
+                        raise FakeRoute53Error(400, 'InvalidChangeBatch', \
+                            "Tried to delete resource record set %s type %s but it was not found" % key)
+                    staged[key] = None
+                else:
+                    staged[key] = record
+
+            rtypes = set(RTYPES) | set(key[1] for key in staged)
+            for name in set(key[0] for key in staged):
+                types = [rtype for rtype in rtypes if current((name, rtype)) is not None]
+                if 'CNAME' in types and len(types) > 1:
+                    raise FakeRoute53Error(400, 'InvalidChangeBatch', \
+                        "RRSet of type CNAME with DNS name %s conflicts with other records with the same name" % name)
+
+            for key, rrset in staged.iteritems():
+                if rrset is None:
+                    del zone.rrsets[key]
+                else:
+                    zone.put(key, rrset)
+            return {'ChangeResourceRecordSetsResponse': {'ChangeInfo': self._change_info()}}
+
+def _same(existing, record):
+    """Return true if a DELETE for record matches the existing rrset exactly."""
+    if existing.alias_hosted_zone_id is not None or record.alias_hosted_zone_id is not None:
+        return existing.alias_hosted_zone_id == record.alias_hosted_zone_id and \
+            _canonical(existing.alias_dns_name or '') == _canonical(record.alias_dns_name or '')
+    return str(existing.ttl) == str(record.ttl) and sorted(existing.resource_records) == sorted(record.resource_records)
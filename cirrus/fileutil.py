@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+#
+""" Writing the files cirrus keeps between runs: caches, snapshots, plans and stats.
+Each is written to a temporary file in the same directory and renamed over the old one, so a reader, or a
+run after a failed write, sees either the whole old file or the whole new one.
+"""
+
+import os
+
+def atomic_write(path, data, mode=None):
+    """ Replace the file at path with data in one step, setting its permissions to mode if given.
+    If the write or rename fails the temporary file is removed and the error raised.
+    """
+    import tempfile
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        tmp_file = os.fdopen(fd, 'wb')
+        try:
+            tmp_file.write(data)
+        finally:
+            tmp_file.close()
+        if mode is not None:
+            os.chmod(tmp_path, mode)
+        os.rename(tmp_path, path)
+    except:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+#
+""" An index of every hosted zone in the account.
+The hosted zones are listed once, following every page of the listing, and the index is shared by all the
+cirrus.r53.Zone objects using the same connection. It can be kept in a file for a time so that short lived
+processes, like update_host.py at boot, skip the listing entirely.
+"""
+
+import logging
+import os
+import threading
+import time
+import weakref
+
+from cirrus.client import get_client
+from cirrus.fileutil import atomic_write
+
+log = logging.getLogger('cirrus')
+
+class HostedZoneIndex(object):
+    """ Maps zone names, without the trailing dot, to a dictionary of the hosted zone 'id' and its
+    resource record set 'count'. The listing is done on the first lookup.
+    """
+
+    def __init__(self, conn, cache_file=None, cache_ttl=3600):
+        self.conn = conn
+        self.cache_file = cache_file
+        self.cache_ttl = cache_ttl
+        self.lock = threading.RLock()
+        self.zones = None
+        self.from_cache = False
+
+    def _list(self):
+        """List every hosted zone from route 53, following the NextMarker of each page."""
+        zones = {}
+        marker = None
+        while True:
+            response = self.conn.get_all_hosted_zones(marker).values()[0]
+            for hosted_zone in response['HostedZones']:
+                name = hosted_zone['Name'].rstrip('.').lower()
+                if name in zones:
+                    log.warn("There is more than one hosted zone named %s, using %s" % (name, zones[name]['id']))
+                    continue
+                count = hosted_zone.get('ResourceRecordSetCount')
+                if count is not None:
+                    count = int(count)
+                zones[name] = {'id': hosted_zone['Id'].replace('/hostedzone/', ''), 'count': count}
+
+            marker = response.get('NextMarker')
+            if str(response.get('IsTruncated', 'false')).lower() != 'true' or marker is None:
+                break
+        log.debug("Listed %d hosted zones" % len(zones))
+        return zones
+
+    def _read_cache(self):
+        """Return the zones from the cache file if it is recent enough, otherwise None."""
+        import json
+        try:
+            if time.time() - os.path.getmtime(self.cache_file) > self.cache_ttl:
+                return None
+            cache = open(self.cache_file, 'r')
+            try:
+                return json.load(cache)['zones']
+            finally:
+                cache.close()
+        except (IOError, OSError, ValueError, KeyError) as e:
+            log.debug("Not using hosted zone cache %s: %s" % (self.cache_file, e))
+            return None
+
+    def _write_cache(self):
+        """Write the zones to the cache file."""
+        import json
+        try:
+            atomic_write(self.cache_file, json.dumps({'zones': self.zones}))
+        except (IOError, OSError) as e:
+            log.warn("Unable to write hosted zone cache %s: %s" % (self.cache_file, e))
+
+    def refresh(self):
+        """List the hosted zones from route 53 again."""
+        with self.lock:
+            self.zones = self._list()
+            self.from_cache = False
+            if self.cache_file is not None:
+                self._write_cache()
+
+    def lookup(self, name):
+        """ Return the {'id':, 'count':} of the hosted zone for name, None if it doesn't exist.
+        A zone missing from a cached index is looked for again in a fresh listing.
+        """
+        name = name.rstrip('.').lower()
+        with self.lock:
+            if self.zones is None and self.cache_file is not None:
+                self.zones = self._read_cache()
+                self.from_cache = self.zones is not None
+            if self.zones is None or (self.from_cache and name not in self.zones):
+                self.refresh()
+            return self.zones.get(name)
+
+    def add(self, name, zone_id, count=2):
+        """Record a newly created hosted zone, which starts with its SOA and NS records."""
+        with self.lock:
+            if self.zones is not None:
+                self.zones[name.rstrip('.').lower()] = {'id': zone_id, 'count': count}
+                if self.cache_file is not None:
+                    self._write_cache()
+
+    def set_count(self, name, count):
+        """Record the resource record set count of a zone after changing it."""
+        with self.lock:
+            zone = self.zones and self.zones.get(name.rstrip('.').lower())
+            if zone is not None:
+                zone['count'] = count
+                if self.cache_file is not None:
+                    self._write_cache()
+
+    def remove(self, name):
+        """Forget a deleted hosted zone."""
+        with self.lock:
+            if self.zones is not None and self.zones.pop(name.rstrip('.').lower(), None) is not None:
+                if self.cache_file is not None:
+                    self._write_cache()
+
+_indexes = weakref.WeakKeyDictionary()
+_indexes_lock = threading.Lock()
+
+def get_index(conn, cache_file=None, cache_ttl=3600):
+    """ Return the HostedZoneIndex shared by everything using this connection or its client.
+    The cache settings only apply when the index is first made.
+    """
+    client = get_client(conn)
+    with _indexes_lock:
+        index = _indexes.get(client)
+        if index is None:
+            index = HostedZoneIndex(client, cache_file, cache_ttl)
+            _indexes[client] = index
+        return index
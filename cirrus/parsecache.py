@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+#
+""" A cache of parsed zone files, so a zone file parsed once is never parsed again while its content is the same.
+Each entry holds the rows of the cirrus.records.RecordIndex that Zone._get_rrecords made from a zone file,
+marshalled and zlib compressed, in a file named for the zone's origin and the sha1 of the zone file's content.
+Only the latest entry for each origin is kept. parse_zones fills the cache for many zone files at once in a
+pool of processes, so the zones a run updates find their records already parsed.
+"""
+
+import logging
+import marshal
+import multiprocessing
+import os
+import zlib
+
+from cirrus.fileutil import atomic_write
+from cirrus.records import RecordIndex
+from cirrus.snapshot import file_hash
+
+log = logging.getLogger('cirrus')
+
+#Changed whenever the rows or the way zone files are read into them change, so older entries are not used
+VERSION = 1
+
+class ParseCache(object):
+    """Keeps the parsed records of zone files in a directory."""
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def _origin(self, origin):
+        return origin.rstrip('.').lower()
+
+    def _file(self, zone_hash, origin):
+        return os.path.join(self.path, '%s.%s.rows' % (self._origin(origin), zone_hash))
+
+    def has(self, zone_hash, origin):
+        """Return true if there is an entry for the zone file content hash and origin."""
+        return os.path.exists(self._file(zone_hash, origin))
+
+    def get(self, zone_hash, origin):
+        """Return the RecordIndex parsed from a zone file with this content hash and origin, or None."""
+        try:
+            cache_file = open(self._file(zone_hash, origin), 'rb')
+            try:
+                version, rows = marshal.loads(zlib.decompress(cache_file.read()))
+            finally:
+                cache_file.close()
+        except (IOError, EOFError, ValueError, TypeError, zlib.error) as e:
+            log.debug("No parsed records cached for zone %s: %s" % (origin, e))
+            return None
+        if version != VERSION:
+            return None
+        return RecordIndex.from_rows(rows)
+
+    def put(self, zone_hash, origin, rrecords):
+        """Store the RecordIndex parsed from a zone file and remove the entries for any other content of the zone.
+        """
+        cache_path = self._file(zone_hash, origin)
+        atomic_write(cache_path, zlib.compress(marshal.dumps((VERSION, rrecords.to_rows()))))
+
+        origin = self._origin(origin)
+        for name in os.listdir(self.path):
+            parts = name.rsplit('.', 2)
+            if len(parts) == 3 and parts[0] == origin and parts[2] == 'rows' and name != os.path.basename(cache_path):
+                try:
+                    os.remove(os.path.join(self.path, name))
+                except OSError:
+                    pass
+
+def _parse(job):
+    """Parse one zone file into the cache, run in a pool process. Returns the error as a string if it fails."""
+    from cirrus.r53 import parse_zone_file
+    path, zone_file, origin, zone_hash = job
+    try:
+        ParseCache(path).put(zone_hash, origin, parse_zone_file(zone_file, origin))
+    except Exception as e:
+        return '%s: %s' % (e.__class__.__name__, e)
+    return None
+
+def parse_zones(cache, zones, processes=None):
+    """ Parse every zone file of a dictionary of {zone name: zone file} which isn't already in the cache,
+    using a pool of processes, by default one for each cpu. A zone file which fails to parse is left for
+    the zone to parse and report itself. Returns the number of zone files parsed.
+    """
+    jobs = []
+    for name, zone_file in zones.iteritems():
+        try:
+            zone_hash = file_hash(zone_file)
+        except IOError:
+            continue
+        if not cache.has(zone_hash, name):
+            jobs.append((cache.path, zone_file, name, zone_hash))
+    if len(jobs) == 0:
+        return 0
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = min(processes, len(jobs))
+    log.info("Parsing %d zone files in %d processes" % (len(jobs), processes))
+    if processes <= 1:
+        errors = map(_parse, jobs)
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            errors = pool.map(_parse, jobs, 1)
+        finally:
+            pool.close()
+            pool.join()
+    for job, error in zip(jobs, errors):
+        if error is not None:
+            log.debug("Zone file %s for zone %s was not parsed ahead: %s" % (job[1], job[2], error))
+    return len(jobs)
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+#
+""" Plans of changes to zones, made by cirrus.r53.Zone.plan and submitted later by Zone.apply.
+A plan file is zlib compressed json holding for each zone the adds, deletes and updates found, the
+changesets packed for them and a fingerprint of the route 53 records they were computed from.
+"""
+
+import json
+import logging
+import zlib
+
+from cirrus.fileutil import atomic_write
+from cirrus.records import RecordIndex, RRSet
+
+log = logging.getLogger('cirrus')
+
+PLAN_VERSION = 1
+
+class ZonePlan(object):
+    """ The changes planned for one zone. Adds and deletes are RecordIndexes and updates
+    {(name, rtype): (RRSet, RRSet)} as returned by Zone._compare. A zone_id of None
+    means the zone is to be created, the fingerprint is None then as there are no records to compare with.
+    """
+
+    def __init__(self, zone_name, zone_id, fingerprint, adds, deletes, updates, changesets, subtree=None):
+        self.zone_name = zone_name
+        self.zone_id = zone_id
+        self.fingerprint = fingerprint
+        self.adds = adds
+        self.deletes = deletes
+        self.updates = updates
+        self.changesets = changesets
+        self.subtree = subtree
+
+    def __repr__(self):
+        return "<ZonePlan %s: %d adds, %d deletes, %d updates in %d changesets>" % \
+            (self.zone_name, len(self.adds), len(self.deletes), len(self.updates), len(self.changesets))
+
+    def to_dict(self):
+        """Return the plan as a dictionary which json can write."""
+        return {'zone_name': self.zone_name, 'zone_id': self.zone_id, 'fingerprint': self.fingerprint, \
+            'subtree': self.subtree, 'changesets': self.changesets, \
+            'adds': self.adds.to_rows(), 'deletes': self.deletes.to_rows(), \
+            'updates': [self.updates[key][0].to_row() + self.updates[key][1].to_row()[2:] \
+                for key in sorted(self.updates)]}
+
+    @classmethod
+    def from_dict(cls, plan):
+        """Return the ZonePlan for a dictionary made by to_dict."""
+        updates = {}
+        for name, rtype, from_ttl, from_values, ttl, values in plan['updates']:
+            to_rrset = RRSet.from_text(name, rtype, ttl, values)
+            updates[to_rrset.key] = (RRSet.from_text(name, rtype, from_ttl, from_values), to_rrset)
+        subtree = plan['subtree']
+        if subtree is not None:
+            subtree = str(subtree)
+        zone_id = plan['zone_id']
+        if zone_id is not None:
+            zone_id = str(zone_id)
+        return cls(str(plan['zone_name']), zone_id, plan['fingerprint'], RecordIndex.from_rows(plan['adds']), \
+            RecordIndex.from_rows(plan['deletes']), updates, [str(changeset) for changeset in plan['changesets']], \
+            subtree)
+
+def write_plan(path, plans, definition=None):
+    """Write a list of ZonePlan to a plan file, along with the path of the yaml definition they came from."""
+    data = {'version': PLAN_VERSION, 'definition': definition, 'zones': [plan.to_dict() for plan in plans]}
+    atomic_write(path, zlib.compress(json.dumps(data, separators=(',', ':')), 9))
+
+def read_plan(path):
+    """Read a plan file returning (list of ZonePlan, path of the yaml definition or None)."""
+    plan_file = open(path, 'rb')
+    try:
+        data = json.loads(zlib.decompress(plan_file.read()))
+    finally:
+        plan_file.close()
+    if data.get('version') != PLAN_VERSION:
+        raise ValueError("%s is a version %s plan, only version %d can be applied" % \
+            (path, data.get('version'), PLAN_VERSION))
+    return [ZonePlan.from_dict(plan) for plan in data['zones']], data['definition']
@@ -1,14 +1,240 @@
 #!/usr/bin/env python
 #
 
+from functools import wraps
+import hashlib
+from itertools import groupby
 import logging
-import tempfile
+import re
+import sys
+import threading
+import time
 
-import dns
-import dns.zone
+#dnspython, and the plan and snapshot modules with the json, gzip, zlib and tempfile they use, are imported by
+#the methods which need them, so looking up and changing a single host, as update_host.py does at boot, loads
+#only the client, the hosted zone index and the record types
+from cirrus.client import get_client
+from cirrus.hostedzones import get_index
+from cirrus.records import AliasTarget, RecordIndex, RRSet, RRType
 
 log = logging.getLogger('cirrus')
 
+def _load_zone(zone_file, origin):
+    """Parse a bind style zone file into a dns.zone.Zone with absolute names."""
+    import dns.zone
+    return dns.zone.from_file(zone_file, origin=origin, relativize=False)
+
+def _add_node_rrecords(rrecords, zone_name, name, node, only=None):
+    """ Add the rdatas of one node of a zone to a RecordIndex, as Zone._get_rrecords does.
+    With only set, rdatas which become an RRSet for any other name are left out.
+    """
+    import dns.rdatatype
+    name = str(name)
+    alias_name = name
+    if alias_name[:7] == '_alias.':
+        alias_name = alias_name[7:]
+    for rdataset in node:
+        rtype = RRType(dns.rdatatype.to_text(rdataset.rdtype))
+        if rtype is RRType.NS and name[:-1] == zone_name:
+            continue
+        elif rtype is RRType.SOA:
+            continue
+
+        values = []
+        for rdata in rdataset:
+            rvalue = rdata.to_text()
+            if rtype is RRType.TXT and rvalue[1:7] == 'Alias ':
+                log.info('Interpreting TXT entry as a route53 alias.')
+                if only is None or alias_name == only:
+                    rrecords.add(RRSet(alias_name, RRType.A, rdataset.ttl, (), \
+                        AliasTarget.from_text(rvalue.strip('"'))))
+            else:
+                values.append(rvalue)
+        if len(values) > 0 and (only is None or name == only):
+            log.debug("Adding %s, type %s, ttl %d, values %s to rrecords" % (name, rtype, rdataset.ttl, values))
+            rrecords.add(RRSet(name, rtype, rdataset.ttl, values))
+
+def parse_zone_file(zone_file, origin):
+    """ Parse a bind style zone file into the RecordIndex Zone._get_rrecords makes, without a Zone.
+    This is what a cirrus.parsecache process pool runs for each zone file.
+    """
+    rrecords = RecordIndex()
+    for name, node in _load_zone(zone_file, origin).iteritems():
+        _add_node_rrecords(rrecords, origin, name, node)
+    return rrecords
+
+def escape(data):
+    """Escape &, < and > in xml character data, as xml.sax.saxutils does without importing urllib with it."""
+    return data.replace('&', '&amp;').replace('>', '&gt;').replace('<', '&lt;')
+
+def _unescape(name):
+    """Route 53 returns some characters in names as 3 digit octal escapes, ie \\052 for *. Return the plain name."""
+    if '\\' not in name:
+        return name
+    return re.sub(r'\\([0-7]{3})', lambda match: chr(int(match.group(1), 8)), name)
+
+def _route53_order(name):
+    """ Return a key which sorts names in the order route 53 lists them.
+    Route 53 compares the plain lower case name in ascii order, not as it escapes it, with its labels reversed
+    and a trailing dot, ie www.example.com sorts as com.example.www. and *.example.com before 1.example.com.
+    """
+    labels = _unescape(name).lower().rstrip('.').split('.')
+    labels.reverse()
+    return '.'.join(labels) + '.'
+
+def _fqdn(host):
+    """Return host lower case with a trailing dot, for comparing names."""
+    return host.lower().rstrip('.') + '.'
+
+def _in_subtree(name, subtree):
+    """Return true if name is subtree or a name under it, both fully qualified."""
+    name = name.lower()
+    subtree = subtree.lower()
+    return name == subtree or name.endswith('.' + subtree)
+
+def _prefetch(iterable, depth=4, stats=None):
+    """ Yield the items of iterable while a separate thread reads up to depth items ahead, so the next page
+    is fetched from route 53 while the caller is still working on the last. Errors are raised in the caller.
+    With stats, a cirrus.stats.Stats, what the thread counts is counted for the caller's zone.
+    """
+    import Queue
+    items = Queue.Queue(depth)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def read():
+        try:
+            for item in iterable:
+                if not put((True, item)):
+                    return
+            put((False, None))
+        except Exception:
+            put((False, sys.exc_info()))
+
+    def read_for(zone):
+        with stats.zone(zone):
+            read()
+
+    if stats is None:
+        reader = threading.Thread(target=read, name='cirrus-prefetch')
+    else:
+        reader = threading.Thread(target=read_for, args=(stats.current_zone(),), name='cirrus-prefetch')
+
+    reader.daemon = True
+    reader.start()
+    try:
+        while True:
+            more, item = items.get()
+            if not more:
+                if item is not None:
+                    raise item[0], item[1], item[2]
+                return
+            yield item
+    finally:
+        stop.set()
+
+def _counted(method):
+    """Decorate a Zone method so what is counted in its thread while it runs is counted for the zone."""
+    @wraps(method)
+    def counted(self, *args, **kwargs):
+        with self.stats.zone(self.zone_name):
+            return method(self, *args, **kwargs)
+    return counted
+
+class ChangeBatch(object):
+    """ Packs route 53 changes into ChangeResourceRecordSets request xml.
+    A request may hold at most MAX_RECORDS ResourceRecord elements and MAX_CHARS characters in all Value
+    elements, with UPSERT changes counting twice. Changes are added until the next group would go over either
+    limit, at which point the finished request is handed back and a new one started.
+    """
+    MAX_RECORDS = 1000
+    MAX_CHARS = 32000
+
+    def __init__(self, comment):
+        self.header = "<?xml version=\"1.0\" encoding=\"UTF-8\"?>\n" + \
+            "<ChangeResourceRecordSetsRequest xmlns=\"https://route53.amazonaws.com/doc/2013-04-01/\">\n" + \
+            " <ChangeBatch>\n" + "  <Comment>" + escape(comment) + "</Comment>\n" + "  <Changes>\n"
+        self.footer = "  </Changes>\n" + " </ChangeBatch>\n" + "</ChangeResourceRecordSetsRequest>\n"
+        self.parts = []
+        self.records = 0
+        self.chars = 0
+
+    def _alias_xml(self, action, rrset):
+        """Returns the xml, record count and value characters for a change to a route 53 alias."""
+        xmlout = "   <Change>\n" + "    <Action>" + action + "</Action>\n" + "    <ResourceRecordSet>\n" + \
+            "     <Name>" + escape(rrset.name) + "</Name>\n" + "     <Type>" + rrset.rtype + "</Type>\n" + \
+            "     <AliasTarget>\n" + "      <HostedZoneId>" + escape(rrset.alias.zone_id) + "</HostedZoneId>\n" + \
+            "      <DNSName>" + escape(rrset.alias.dns_name) + "</DNSName>\n" + "     </AliasTarget>\n" + \
+            "    </ResourceRecordSet>\n" + "   </Change>\n"
+        #Counted like a single value, erring on the side of smaller requests
+        return xmlout, 1, len(rrset.alias.dns_name)
+
+    def _change_xml(self, action, rrset):
+        """ Returns the xml, record count and value characters for an action on a RRSet.
+        A record set with both an alias and values is sent as a change for each.
+        """
+        xmlout = ''
+        records = 0
+        chars = 0
+        if rrset.alias is not None:
+            xmlout, records, chars = self._alias_xml(action, rrset)
+            if len(rrset.values) == 0:
+                return xmlout, records, chars
+
+        parts = [xmlout, "   <Change>\n" + "    <Action>" + action + "</Action>\n" + "    <ResourceRecordSet>\n" + \
+            "     <Name>" + escape(rrset.name) + "</Name>\n" + "     <Type>" + rrset.rtype + "</Type>\n" + \
+            "     <TTL>" + str(rrset.ttl) + "</TTL>\n" + "     <ResourceRecords>\n"]
+        for rvalue in rrset.values:
+            parts.append("      <ResourceRecord><Value>" + escape(rvalue) + "</Value></ResourceRecord>\n")
+            chars += len(rvalue)
+        parts.append("     </ResourceRecords>\n" + "    </ResourceRecordSet>\n" + "   </Change>\n")
+        return ''.join(parts), records + len(rrset.values), chars
+
+    def add(self, changes):
+        """ Add a list of (action, RRSet) changes which must be sent in the same request.
+        Returns the xml for the current request if these changes did not fit in it, otherwise None.
+        """
+        parts = []
+        records = 0
+        chars = 0
+        for action, rrset in changes:
+            xmlout, change_records, change_chars = self._change_xml(action, rrset)
+            if action == 'UPSERT':
+                change_records *= 2
+                change_chars *= 2
+            parts.append(xmlout)
+            records += change_records
+            chars += change_chars
+
+        if records > self.MAX_RECORDS or chars > self.MAX_CHARS:
+            log.warn("Changes to %s are larger than route 53 allows in a single request." % changes[0][1].name)
+
+        finished = None
+        if self.records + records > self.MAX_RECORDS or self.chars + chars > self.MAX_CHARS:
+            finished = self.flush()
+        self.parts.extend(parts)
+        self.records += records
+        self.chars += chars
+        return finished
+
+    def flush(self):
+        """Return the xml for the changes added since the last request, None if there are none."""
+        if len(self.parts) == 0:
+            return None
+        xmlout = self.header + ''.join(self.parts) + self.footer
+        self.parts = []
+        self.records = 0
+        self.chars = 0
+        return xmlout
+
 class Zone:
     """ An interface to Amazon web services route 53.
     The class defines an aws zone and can create the resource records,
@@ -19,16 +245,27 @@ class Zone:
     validation issues this is stored in the zone file as TXT entry and the domain name has _alias added.
     """
 
-    def __init__(self, conn, zone_name):
-        self.conn = conn
+    #Seconds between remove progress reports at the default log level
+    PROGRESS_INTERVAL = 10
+
+    def __init__(self, conn, zone_name, tracker=None, snapshots=None, parse_cache=None):
+        self.conn = get_client(conn)
         self.zone_name = zone_name
+        #The cirrus.stats.Stats of the client, shared with every zone using it
+        self.stats = self.conn.stats
+        #An optional cirrus.changes.ChangeTracker, given each change submitted
+        self.tracker = tracker
+        #An optional cirrus.snapshot.SnapshotStore, used by update to skip zones unchanged since last applied
+        self.snapshots = snapshots
+        #An optional cirrus.parsecache.ParseCache, holding the records of zone files already parsed
+        self.parse_cache = parse_cache
         #Set on create or exists call
         self.id = None
-        self.xml_header = "<?xml version=\"1.0\" encoding=\"UTF-8\"?>\n" + \
-            "<ChangeResourceRecordSetsRequest xmlns=\"https://route53.amazonaws.com/doc/2013-04-01/\">\n" + \
-            " <ChangeBatch>\n" + "  <Comment>Updates to Zone " + self.zone_name + "</Comment>\n" + "  <Changes>\n"
-        self.xml_footer = "  </Changes>\n" + " </ChangeBatch>\n" + "</ChangeResourceRecordSetsRequest>\n"
+        self.record_count = None
+        #The records from the zone file last applied by update, which route 53 had when it finished
+        self.applied = None
 
+    @_counted
     def __repr__(self):
         """Return a bind style zone file for the current zone in aws."""
         if not self.exists():
@@ -37,234 +274,384 @@ class Zone:
         dnszone = self._to_dnszone()
         return self._print(dnszone)
 
-    def _change_alias_xml(self, action, name, rvalue):
-        """Returns amazon change xml for a specific route 53 entry."""
-        rtype = 'A'
-        words = rvalue.split()
-        zone_id = words[1]
-        dns_name = words[2]
-        xmlout = "   <Change>\n" + "    <Action>" + action + "</Action>\n" + "     <ResourceRecordSet>\n" + \
-            "      <Name>" + name + "</Name>\n" + "      <Type>" + rtype + "</Type>\n" + \
-            "      <AliasTarget>\n            <HostedZoneId>" + zone_id + "</HostedZoneId>\n" + \
-            "            <DNSName>" + dns_name + "</DNSName>\n      </AliasTarget>\n" + \
-            "     </ResourceRecordSet>\n" + "   </Change>\n"
-        return xmlout
-
-    def _change_xml(self, action, name, rtype, ttl, values):
-        """Returns amazon Change xml for an action on an entry."""
-        #Check to see if any entries are a masked route53 alias
-        if rtype == 'A':
-            for rvalue in values:
-                if rvalue[:6] == 'Alias ':
-                    log.info('Interpreting entry as a route53 alias.')
-                    xmlout = self._change_alias_xml(action, name, rvalue)
-                    if len(values) > 1:
-                        values.remove(rvalue)
-                        xmlout += self._change_xml(action, name, rtype, ttl, values)
-                    return xmlout
-        
-        xmlout = "   <Change>\n" + "    <Action>" + action + "</Action>\n" + "     <ResourceRecordSet>\n" + \
-            "      <Name>" + name + "</Name>\n" + "      <Type>" + rtype + "</Type>\n" + \
-            "      <TTL>" + str(ttl) + "</TTL>\n" + "      <ResourceRecords>\n"
-
-        for rvalue in values:
-            xmlout += "       <ResourceRecord>\n" + "        <Value>" + rvalue + "</Value>\n" + \
-            "       </ResourceRecord>\n" 
-        
-        xmlout += "     </ResourceRecords>\n" + "    </ResourceRecordSet>\n" + "   </Change>\n"
-        return xmlout
-
-    def _add_change_xml(self, name, rtype, ttl, values):
-        """Returns amazon Change xml for adding an entry."""
-        return self._change_xml('CREATE', name, rtype, ttl, values)
-
-    def _delete_change_xml(self, name, rtype, ttl, values):
-        """Returns amazon Change xml for deleting an entry."""
-        return self._change_xml('DELETE', name, rtype, ttl, values)
+    def _changesets(self, changes):
+        """Pack groups of changes into as few amazon changesets as possible, yielding each changeset as soon
+        as it is full. Changes is an iterable of lists of (action, RRSet) tuples, each list
+        is kept together in one changeset.
+        """
+        batch = ChangeBatch('Updates to Zone ' + self.zone_name)
+        packing = 0.0 #Seconds spent packing, counted as each changeset is handed on
+        for group in changes:
+            start = time.time()
+            changeset = batch.add(group)
+            packing += time.time() - start
+            if changeset is not None:
+                self.stats.count('xml_seconds', packing)
+                packing = 0.0
+                yield changeset
+        start = time.time()
+        changeset = batch.flush()
+        self.stats.count('xml_seconds', packing + time.time() - start)
+        if changeset is not None:
+            yield changeset
 
     def _create_changeset(self, adds, deletes, updates):
         """Create amazon changeset xml for adds and deletes and updates to a zone.
             Return a list of individual changesets.
-            For updates the host, rtype and ttl all must be the same only value changes.
+            Deletes are packed first so they are applied before any add or update which conflicts with them.
         """
         if len(adds) == 0 and len(deletes) == 0 and len(updates) == 0:
             return None
 
-        changesets = []
-
-        #Splitting my rrecords should be moved to a method it is nearly identical each time I do it.
-        rrecord_keys = deletes.keys()
-        rrecord_groups = [ rrecord_keys[n:n+100] for n in range(0, len(rrecord_keys), 100)]
-        for rrecords_slice in rrecord_groups: 
-            xmlout = self.xml_header
-            for key in rrecords_slice:
-                xmlout += self._delete_change_xml(key[0], key[1], key[2], deletes[key])
-            xmlout += self.xml_footer
-            changesets.append(xmlout)
-
-        rrecord_keys = updates.keys()
-        rrecord_groups = [ rrecord_keys[n:n+50] for n in range(0, len(rrecord_keys), 50)]
-        for rrecords_slice in rrecord_groups: 
-            xmlout = self.xml_header
-            for key in rrecords_slice:
-                xmlout += self._delete_change_xml(key[0], key[1], key[2], updates[key][0])
-                xmlout += self._add_change_xml(key[0], key[1], key[2], updates[key][1])
-            xmlout += self.xml_footer
-            changesets.append(xmlout)
-
-        rrecord_keys = adds.keys()
-        rrecord_groups = [ rrecord_keys[n:n+100] for n in range(0, len(rrecord_keys), 100)]
-        for rrecords_slice in rrecord_groups: 
-            xmlout = self.xml_header
-            for key in rrecords_slice:
-                xmlout += self._add_change_xml(key[0], key[1], key[2], adds[key])
-            xmlout += self.xml_footer
-            changesets.append(xmlout)
-
-        return changesets
-
-    def _compare(self, from_zone, to_zone):
-        """Compare two dns zones and return resource record dictionaries for add deletes and updates.
-        Ignores SOA and root NS records because Amazon autogenerates those."""
-        from_records = self._get_rrecords(from_zone)
-        to_records = self._get_rrecords(to_zone)
-        adds = {}
-        deletes = {}
+        return list(self._changesets(self._changes(adds, deletes, updates)))
+
+    def _changes(self, adds, deletes, updates):
+        """Return the groups of changes for the output of _compare, deletes first then updates and adds."""
+        changes = []
+        for rrset in deletes.itervalues():
+            changes.append([('DELETE', rrset)])
+        for from_rrset, to_rrset in updates.itervalues():
+            changes.append(self._update_changes(from_rrset, to_rrset))
+        for rrset in adds.itervalues():
+            changes.append([('CREATE', rrset)])
+        return changes
+
+    def _update_changes(self, from_rrset, to_rrset):
+        """ Return the changes which replace one RRSet with another for the same name.
+        An rrset keeping its type is replaced in place with an UPSERT, changing type or going between an alias and
+        plain records needs the old rrset deleted and the new created in the same changeset.
+        """
+        if from_rrset.rtype is to_rrset.rtype and (from_rrset.alias is None) == (to_rrset.alias is None):
+            return [('UPSERT', to_rrset)]
+        return [('DELETE', from_rrset), ('CREATE', to_rrset)]
+
+    def _compare(self, from_records, to_records):
+        """Compare two RecordIndexes and return RecordIndexes of the adds and deletes and a dictionary of updates.
+        Updates map (name, rtype) to a pair of RRSets, the existing and the new, and include ttl changes.
+        Ignores SOA and root NS records because Amazon autogenerates those. Neither RecordIndex is changed."""
+        start = time.time()
+        adds = RecordIndex()
+        deletes = RecordIndex()
         updates = {}
 
-        for key in to_records.iterkeys(): #key is [name, rtype, ttl]
-            name = key[0]
-            rtype = key[1]
+        for key, rrset in to_records.iteritems(): #key is (name, rtype)
             #skip records amazon automatically generates
-            if rtype == 'NS' and name[:-1] == self.zone_name:
+            if rrset.rtype is RRType.NS and rrset.name[:-1] == self.zone_name:
                 continue
-            elif rtype == 'SOA':
+            elif rrset.rtype is RRType.SOA:
                 continue
-            if from_records.has_key(key):
-                from_records[key].sort() #I sort both to avoid ordering issues
-                to_records[key].sort()
-                if from_records[key] != to_records[key]:
-                    log.warn("Updating %s %s %s to %s" % (key[0], key[1], key[2], to_records[key]))
-                    updates[key] = [from_records[key], to_records[key]]
-                del from_records[key] #no-op or modify either way pull from from_records.
-            else:
-                adds[key] = to_records[key]
-                log.warn("Adding %s %s %s %s" % (key[0], key[1], key[2], to_records[key]))
+            from_rrset = from_records.get(key)
+            if from_rrset is None:
+                adds[key] = rrset
+                log.warn("Adding %r" % rrset)
+            elif not from_rrset.matches(rrset):
+                log.warn("Updating %r to %s %s" % (from_rrset, rrset.ttl, rrset.text_values()))
+                updates[key] = (from_rrset, rrset)
 
-        #Anything remaining in the from_records is a delete
-        for key in from_records.iterkeys():
-            deletes[key] = from_records[key]
-            log.warn("Removing %s %s %s %s" % (key[0], key[1], key[2], from_records[key]))
+        #Anything in from_records but not to_records is a delete
+        for key, rrset in from_records.iteritems():
+            if key not in to_records:
+                deletes[key] = rrset
+                log.warn("Removing %r" % rrset)
 
+        self.stats.count('records_diffed', len(to_records) + len(deletes))
+        self.stats.count('diff_seconds', time.time() - start)
         return adds, deletes, updates
 
     def _create_xml(self, zone_file):
-        """Create a list of Amazon change resource record xml given a bind style zone file.
-        There is one xml string in the list for each 100 entries."""
-        dnszone = dns.zone.from_file(zone_file, origin=self.zone_name, relativize=False)
-        rrecords = self._get_rrecords(dnszone)
+        """Yield Amazon change resource record xml given a bind style zone file.
+        Each xml string is a changeset packed as full as route 53 allows."""
+        rrecords = self._local_rrecords(zone_file)
+        changes = ([('CREATE', rrset)] for rrset in rrecords.itervalues())
+        return self._changesets(changes)
 
-        xmllist = []
-        rrecord_keys = rrecords.keys()
-        rrecord_groups = [ rrecord_keys[n:n+100] for n in range(0, len(rrecord_keys), 100)]
-        for rrecords_slice in rrecord_groups: 
-            xmlout = self.xml_header
+    def _get_rrecords(self, dnszone):
+        """Given a dns zone return a cirrus.records.RecordIndex of its RRSets, keyed by (name, rtype).
+        Skips any SOA entries and NS entries for the root.
+        """
+        rrecords = RecordIndex()
+        with self.stats.span('parse'):
+            for name, node in dnszone.iteritems():
+                self._add_node_rrecords(rrecords, name, node)
+        return rrecords
 
-            for key in rrecords_slice:
-                xmlout += self._add_change_xml(key[0], key[1], key[2], rrecords[key])
+    def _load(self, zone_file):
+        """Parse a bind style zone file for this zone into a dns.zone.Zone."""
+        with self.stats.span('parse'):
+            return _load_zone(zone_file, self.zone_name)
 
-            xmlout += self.xml_footer
-            xmllist.append(xmlout)
+    def _add_node_rrecords(self, rrecords, name, node, only=None):
+        """ Add the rdatas of one zone node to a RecordIndex, as _get_rrecords does.
+        With only set, rdatas which become an RRSet for any other name are left out.
+        """
+        _add_node_rrecords(rrecords, self.zone_name, name, node, only)
 
-        return xmllist
-    
-    def _get_rrecords(self, dnszone):
-        """Given a dns zone return a dictionary of rrecords, with a format
-        {(name, rtype, ttl): rvalue} where each variable is a string.
-        Skips any SOA entries and NS entries for the root.
+    def _local_rrecords(self, zone_file, zone_hash=None):
+        """ Return the RecordIndex _get_rrecords makes for a zone file, from the parse cache if the zone has one
+        and it holds the file, parsing and adding it if not. Zone hash is the file's hash, if already known.
+        """
+        if self.parse_cache is None:
+            return self._get_rrecords(self._load(zone_file))
+
+        if zone_hash is None:
+            from cirrus.snapshot import file_hash
+            zone_hash = file_hash(zone_file)
+        rrecords = self.parse_cache.get(zone_hash, self.zone_name)
+        if rrecords is not None:
+            self.stats.count('parse_cache_hits')
+            return rrecords
+        self.stats.count('parse_cache_misses')
+        rrecords = self._get_rrecords(self._load(zone_file))
+        self.parse_cache.put(zone_hash, self.zone_name, rrecords)
+        return rrecords
+
+    def _iter_names(self, dnszone, subtree=None):
+        """ Yield (name, rrecords) for each name in a dns zone in the order route 53 lists them, where
+        rrecords is a RecordIndex as _get_rrecords returns holding only that name's records.
+        Just the names are sorted, the records for each are built from the zone as they are needed.
+        With subtree only names at or under it are included.
         """
-        rrecords = {}
-        for name, ttl, rdata in dnszone.iterate_rdatas():
-            rtype = dns.rdatatype.to_text(rdata.rdtype)
+        names = set()
+        for name in dnszone.iterkeys():
             name = str(name)
-            if rtype == 'NS' and name[:-1] == self.zone_name:
-                continue
-            elif rtype == 'SOA':
-                continue
+            names.add(name)
+            if name[:7] == '_alias.': #Alias entries are records of the name without _alias
+                names.add(name[7:])
+        if subtree is not None:
+            names = [name for name in names if _in_subtree(name, subtree)]
+        names = sorted(names, key=_route53_order)
 
-            rvalue = rdata.to_text()
-            if rtype == 'TXT' and rvalue[1:7] == 'Alias ':
-                log.info('Interpreting TXT entry as a route53 alias.')
-                rvalue = rvalue.strip('"') #Strip quotes
-                if name[:7] == '_alias.':
-                    name = name[7:]
-                rtype = 'A'
-
-            log.debug("Adding %s, type %s, ttl %d, value %s to rrecords" % (name, rtype, ttl, rvalue))
-            if (name, rtype, ttl) in rrecords:
-                new_value = rrecords[(name, rtype, ttl)]
-                new_value.append(rvalue)
-                rrecords[(name, rtype, ttl)] = new_value
-            else:
-                rrecords[(name, rtype, ttl)] = [rvalue]
+        for name in names:
+            rrecords = RecordIndex()
+            for node_name in (name, '_alias.' + name):
+                node = dnszone.get_node(node_name)
+                if node is not None:
+                    self._add_node_rrecords(rrecords, node_name, node, name)
+            if len(rrecords) > 0:
+                yield name, rrecords
+
+    def _get_rrsets(self, ltype=None, lname=None):
+        """Gets rrsets from route 53 starting with the name and type specified or if None, the beginning.
+        Amazon only returns 100 at a time so this yields each page as a list of boto rrsets as it arrives,
+        requesting the next page only once the previous one has been consumed.
+        """
+        last = None
+        while True:
+            rrsets = self.conn.get_all_rrsets(self.id, ltype, lname)
+            page = rrsets[:] #Slicing avoids the automatic paging newer versions of boto do on iteration
+            self.stats.count('pages')
+            truncated = getattr(rrsets, 'is_truncated', len(page) > 99) and len(page) > 0
+            if getattr(rrsets, 'next_record_name', None) is not None:
+                ltype = rrsets.next_record_type
+                lname = rrsets.next_record_name
+                next_last = None
+            elif truncated: #Without a next record marker the next page starts with the last rrset of this one
+                ltype = str(page[-1].type)
+                lname = str(page[-1].name)
+                next_last = (ltype, lname)
+
+            if last is not None:
+                page = [rrset for rrset in page if (str(rrset.type), str(rrset.name)) != last]
+            yield page
+
+            if not truncated:
+                break
+            last = next_last
+
+    def _get_remote_rrecords(self, subtree=None, digest=None):
+        """Gets all resource records from route 53 and returns them as a RecordIndex, as _get_rrecords does.
+        Each page is added as it arrives. With subtree only the records at or under that name are fetched.
+        """
+        rrecords = RecordIndex()
+        for rrset in self._iter_remote_rrecords(subtree, digest):
+            rrecords.add(rrset)
 
         return rrecords
 
-    def _get_rrsets(self, ltype = None, lname = None):
-        """Gets rrsets from route 53 starting with the name specified or if None, the beginning.
-        Returns a simple bind representation of these records, the number of records retrieved and the
-        type and the name of the last retrieved.
-        Amazon only returns 100 at a time so this may need to be called multiple times to get the
-        whole list.
+    def _iter_listed(self, subtree=None, digest=None, between=None):
+        """ Yield (name, rrset) for each boto rrset listed from route 53, with the name unescaped.
+        With subtree the listing starts at that name and stops at the first name past the names under it,
+        which route 53 lists together. With digest, a hashlib object, each rrset yielded is added to it.
+        Between is a (first, last) pair of names, the listing starts at first and stops before last, either
+        may be None for the start or end of the zone.
         """
+        first, last = between or (None, None)
+        end = None
+        if last is not None:
+            end = _route53_order(last)
+        if subtree is None:
+            pages = self._get_rrsets(None, first)
+        else:
+            prefix = _route53_order(subtree)
+            pages = self._get_rrsets(None, subtree)
+        for page in pages:
+            for rrecord in page:
+                name = _unescape(str(rrecord.name))
+                if end is not None and _route53_order(name) >= end:
+                    return
+                if subtree is not None and not _in_subtree(name, subtree):
+                    if _route53_order(name) > prefix:
+                        return
+                    continue
+                if digest is not None:
+                    digest.update("%s %s %s %s %s %s\n" % (name, rrecord.type, rrecord.ttl, \
+                        rrecord.alias_hosted_zone_id, rrecord.alias_dns_name, \
+                        ' '.join(sorted(str(value) for value in rrecord.resource_records))))
+                yield name, rrecord
 
-        simple_bind = ""
-        last_name = None
-        last_type = None
-        number = 0
-        for rrecord in self.conn.get_all_rrsets(self.id, ltype, lname):
-            rtype = str(rrecord.type)
-            name = str(rrecord.name)
-            ttl = str(rrecord.ttl)
-
-            if len(rrecord.resource_records) == 0 and rrecord.alias_hosted_zone_id is not None:
-                simple_bind += "%s\t%s\tIN\tTXT\t\"Alias %s %s\"\n" % ('_alias.' + name, ttl, \
-                    str(rrecord.alias_hosted_zone_id), str(rrecord.alias_dns_name))
-            else:
-                for value in rrecord.resource_records:
-                    simple_bind += "%s\t%s\tIN\t%s\t%s\n" % (name, ttl, rtype, str(value))
+    def _iter_remote_rrecords(self, subtree=None, digest=None, between=None):
+        """ Yield a RRSet for each rrset listed from route 53, in the order listed, see _iter_listed.
+        SOA and root NS rrsets are skipped and values normalized the same way they are when read from a zone file.
+        """
+        import dns.name
+        import dns.rdata
+        import dns.rdataclass
+        import dns.rdatatype
+        origin = dns.name.from_text(self.zone_name)
+        for name, rrecord in self._iter_listed(subtree, digest, between):
+            rrset = self._listed_rrset(name, rrecord)
+            if rrset is not None and len(rrset.values) > 0 and rrset.rtype is not RRType.A:
+                rdtype = dns.rdatatype.from_text(rrset.rtype)
+                rrset = RRSet(name, rrset.rtype, rrset.ttl, [dns.rdata.from_text(dns.rdataclass.IN, rdtype, value, \
+                    origin, False).to_text() for value in rrset.values])
+            if rrset is not None:
+                yield rrset
 
-            last_type = rtype
-            last_name = name
-            number += 1
+    def _listed_rrset(self, name, rrecord):
+        """ Return the RRSet for a boto rrset, with its values exactly as listed, or None for the SOA and the
+        root NS which route 53 manages. A route 53 alias becomes an A RRSet with an AliasTarget.
+        """
+        rtype = RRType(str(rrecord.type))
+        if rtype is RRType.NS and name[:-1] == self.zone_name:
+            return None
+        elif rtype is RRType.SOA:
+            return None
 
-        return simple_bind, number, last_type, last_name
+        if len(rrecord.resource_records) == 0 and rrecord.alias_hosted_zone_id is not None:
+            return RRSet(name, RRType.A, rrecord.ttl, (), \
+                AliasTarget(rrecord.alias_hosted_zone_id, rrecord.alias_dns_name))
+        return RRSet(name, rtype, rrecord.ttl, [str(value) for value in rrecord.resource_records])
+
+    @_counted
+    def fingerprint(self, subtree=None):
+        """ Return a hash of the records in route 53, or of those at and under subtree.
+        The rrsets are listed but not parsed, any change to a name, type, ttl or value changes the hash.
+        """
+        digest = hashlib.sha1()
+        for name, rrecord in self._iter_listed(subtree, digest):
+            pass
+        return digest.hexdigest()
+
+    def _iter_remote_names(self, subtree=None):
+        """ Yield (name, rrecords) for each name listed from route 53, in the order listed, with rrecords a
+        RecordIndex. Raises ValueError if route 53 lists names in an order other than expected.
+        """
+        last = None
+        for name, rrsets in groupby(self._iter_remote_rrecords(subtree), lambda rrset: rrset.name):
+            order = _route53_order(name)
+            if last is not None and order < last:
+                raise ValueError("Route 53 listed %s out of the expected order, compare zone %s without streaming" \
+                    % (name, self.zone_name))
+            last = order
+            rrecords = RecordIndex()
+            for rrset in rrsets:
+                rrecords.add(rrset)
+            yield name, rrecords
+
+    def _stream_changes(self, dnszone, counts, subtree=None):
+        """ Merge join the records of a dns zone with those listed from route 53 a page at a time, both in the
+        order route 53 lists names, yielding a group of changes for each name which differs as soon as both
+        sides are past it. Only one name's records from each side are held at once.
+        The number of local records compared is kept in counts['records'].
+        """
+        counts['records'] = 0
+        local = self._iter_names(dnszone, subtree)
+        remote = self._iter_remote_names(subtree)
+        local_name, local_records = next(local, (None, None))
+        remote_name, remote_records = next(remote, (None, None))
+        while local_name is not None or remote_name is not None:
+            if remote_name is None or (local_name is not None and \
+                    _route53_order(local_name) < _route53_order(remote_name)):
+                from_records = RecordIndex()
+                to_records = local_records
+                local_name, local_records = next(local, (None, None))
+            elif local_name is None or _route53_order(remote_name) < _route53_order(local_name):
+                from_records = remote_records
+                to_records = RecordIndex()
+                remote_name, remote_records = next(remote, (None, None))
+            else:
+                from_records = remote_records
+                to_records = local_records
+                local_name, local_records = next(local, (None, None))
+                remote_name, remote_records = next(remote, (None, None))
+
+            counts['records'] += len(to_records)
+            adds, deletes, updates = self._compare(from_records, to_records)
+            changes = [change for group in self._changes(adds, deletes, updates) for change in group]
+            if len(changes) > 0:
+                yield changes
 
     def _to_dnszone(self):
         """Gets all resource records from route 53 and parses them into a dns.zone object."""
-        last_type = None
-        last_name = None
-        simple_bind = ""
-        while True:
-            rrset_batch, lines, ltype, lname = self._get_rrsets(last_type, last_name)
-            simple_bind += rrset_batch
-            if lines > 99:
-                last_name = lname
-                last_type = ltype
-            else:
-                break
+        lines = []
+        for page in self._get_rrsets():
+            for rrecord in page:
+                name = str(rrecord.name)
+                ttl = str(rrecord.ttl)
+                if len(rrecord.resource_records) == 0 and rrecord.alias_hosted_zone_id is not None:
+                    lines.append("%s\t%s\tIN\tTXT\t\"Alias %s %s\"\n" % ('_alias.' + name, ttl, \
+                        str(rrecord.alias_hosted_zone_id), str(rrecord.alias_dns_name)))
+                else:
+                    for value in rrecord.resource_records:
+                        lines.append("%s\t%s\tIN\t%s\t%s\n" % (name, ttl, str(rrecord.type), str(value)))
 
+        simple_bind = ''.join(lines)
         log.debug("Simple Bind zone created from aws r53 response.\n" + simple_bind + "\n")
+        import dns.zone
         zone = dns.zone.from_text(simple_bind, origin=self.zone_name, relativize=False)
         return zone
 
+    def _print_rrecords(self, rrecords):
+        """ Given a RecordIndex return a bind like string representation. """
+        lines = ["Zone %s ID: %s\n" % (self.zone_name, self.id)]
+        for key in sorted(rrecords.keys()):
+            rrset = rrecords[key]
+            for value in rrset.text_values():
+                lines.append("%s %d IN %s %s\n" % (rrset.name, rrset.ttl, rrset.rtype, value))
+        return ''.join(lines)
+
     def _print(self, dnszone):
         """ Given a dnszone return its string representation. """
-        tmp = tempfile.TemporaryFile()
-        dnszone.to_file(tmp)
-        tmp.seek(0)
-        return "Zone " + self.zone_name + " ID: " + self.id + "\n" + tmp.read()
+        from cStringIO import StringIO
+        text = StringIO()
+        dnszone.to_file(text)
+        return "Zone " + self.zone_name + " ID: " + str(self.id) + "\n" + text.getvalue()
 
+    @_counted
+    def export(self, exporter):
+        """ Write every record set in route 53, the SOA and NS included, to a cirrus.export.Exporter a page at
+        a time as they are listed. Returns the number of record sets written or None if the zone doesn't exist.
+        """
+        if not self.exists():
+            log.warn('Zone %s does not exist' % self.zone_name)
+            return None
+
+        exporter.start(self.zone_name, self.id)
+        count = 0
+        for page in self._get_rrsets():
+            rrsets = []
+            for rrecord in page:
+                name = _unescape(str(rrecord.name))
+                alias = None
+                if rrecord.alias_hosted_zone_id is not None:
+                    alias = AliasTarget(rrecord.alias_hosted_zone_id, rrecord.alias_dns_name)
+                rrsets.append(RRSet(name, str(rrecord.type), rrecord.ttl or 0, \
+                    [str(value) for value in rrecord.resource_records], alias))
+            exporter.write(self.zone_name, rrsets)
+            count += len(rrsets)
+        return count
+
+    @_counted
     def create(self, zone_file, dry_run):
         """ Create the zone and populate with settings from the passed in zone_file.
         Do nothing, report only, if dry_run is true.
@@ -275,103 +662,426 @@ class Zone:
         
         log.warn('Creating zone ' + self.zone_name)
         if not dry_run:
-            zone = self.conn.create_hosted_zone(self.zone_name)['CreateHostedZoneResponse']
-            nameservers = ""
-            for nameserve in zone['DelegationSet']['NameServers']:
-                nameservers += nameserve + ' '
-            log.warn('Zone nameservers: ' + nameservers)
-            self.id = zone['HostedZone']['Id'].replace('/hostedzone/', '')
-            zone_xml = self._create_xml(zone_file)
-            log.debug(zone_xml)
+            self._create_hosted_zone()
             log.debug("Adding rrsets to zone " + self.zone_name)
-            for xml in zone_xml:
-                change = self.conn.change_rrsets(self.id, xml)
+            self._submit(self._create_xml(zone_file))
+
+    def _create_hosted_zone(self):
+        """ Create the empty hosted zone in route 53, logging its name servers.
+        One caller reference is used for every retry of the request so route 53 creates the zone at most once,
+        if a retry finds the zone already created by an earlier attempt that zone is used.
+        """
+        import uuid
+        try:
+            response = self.conn.create_hosted_zone(self.zone_name, caller_ref=str(uuid.uuid4()))
+        except Exception as e:
+            if getattr(e, 'error_code', None) != 'HostedZoneAlreadyExists':
+                raise
+            index = get_index(self.conn)
+            index.refresh()
+            zone = index.lookup(self.zone_name)
+            if zone is None:
+                raise
+            log.warn("Zone %s was created by an earlier attempt of the request" % self.zone_name)
+            self.id = zone['id']
+            self.record_count = zone['count']
+            return
+        if self.tracker is not None:
+            self.tracker.add(self.zone_name, response)
+        zone = response['CreateHostedZoneResponse']
+        nameservers = ""
+        for nameserve in zone['DelegationSet']['NameServers']:
+            nameservers += nameserve + ' '
+        log.warn('Zone nameservers: ' + nameservers)
+        self.id = zone['HostedZone']['Id'].replace('/hostedzone/', '')
+        get_index(self.conn).add(self.zone_name, self.id)
     
+    @_counted
     def create_host(self, fqdn, rtype, ttl, value):
         """Create a host entry in this zone."""
-        xmlout = self.xml_header
-        xmlout += self._add_change_xml(fqdn, rtype, ttl, [value, ])
-        xmlout += self.xml_footer
-        log.debug(xmlout)
         log.warn("Adding %s %s %s to %s" % (fqdn, rtype, ttl, value))
-        self.conn.change_rrsets(self.id, xmlout)
+        self._submit(self._changesets([self._host_changes(RRSet.from_text(fqdn, rtype, ttl, [value, ]), None)]))
 
+    @_counted
     def exists(self):
         """Return true if the self.zone_name exists on AWS, false otherwise."""
         if self.id != None:
             return True
-        zones = self.conn.get_all_hosted_zones().values()[0]['HostedZones']
-        for zone in zones:
-            if zone['Name'][:-1] == self.zone_name: #strip the trailing .
-                self.id = zone['Id'].replace('/hostedzone/', '')
-                return True
+        zone = get_index(self.conn).lookup(self.zone_name)
+        if zone is None:
+            return False
 
-        return False
+        self.id = zone['id']
+        self.record_count = zone['count']
+        return True
 
-    def get_host(self, host, ltype=None, lname=None):
-        """Return the (rtype, [values, ]) if the host exists in this domain on AWS, None otherwise.
-            Host should be the fqdn
+    @_counted
+    def get_host(self, host, rtype=None):
+        """Return the (rtype, [values, ], ttl) if the host exists in this domain on AWS, None otherwise.
+            Host should be the fqdn, if rtype is given only an entry of that type is returned.
+            The listing starts at the host so a single request finds it.
         """
-        rrecords = self.conn.get_all_rrsets(self.id, ltype, lname) #Adding name=host is not working in boto.
-        if host[:-1] == '.':
+        for rrset in self._get_host_rrsets(host, rtype):
+            if rtype is None or rrset.rtype == rtype:
+                return self._host_entry(rrset)
+
+        return None
+
+    def _get_host_rrsets(self, host, rtype=None):
+        """Return the RRSets named host, starting the listing at the host and rtype if given."""
+        if host[-1:] == '.':
             fqdn = host
         else:
             fqdn = host + '.'
+
+        try:
+            rrecords = self.conn.get_all_rrsets(self.id, rtype, fqdn)[:]
+        except Exception as e:
+            if getattr(e, 'error_code', None) != 'InvalidInput':
+                raise
+            #Route 53 would not list from this name, search the pages in order until past where it would be
+            log.debug("Listing rrsets from %s failed, searching from the start. %s" % (fqdn, e))
+            rrecords = (rrecord for page in self._get_rrsets() for rrecord in page)
+
+        order = _route53_order(fqdn)
+        found = []
         for rrecord in rrecords:
-            log.debug(rrecord.name)
-            if fqdn == rrecord.name:
-                if len(rrecord.resource_records) == 0 and rrecord.alias_hosted_zone_id is not None:
-                    log.debug('Host has an Alias record, representing as a an A record.')
-                    return ('A', \
-                        ['Alias %s %s' %(rrecord.alias_hosted_zone_id, rrecord.alias_dns_name), ], rrecord.ttl)
-                else:
-                    return (rrecord.type, rrecord.resource_records, rrecord.ttl)
+            name = _unescape(str(rrecord.name))
+            log.debug(name)
+            if name.lower() == fqdn.lower():
+                rrset = self._listed_rrset(name, rrecord)
+                if rrset is not None:
+                    found.append(rrset)
+            elif _route53_order(name) > order:
+                break
 
-        if len(rrecords) == 100: #Amazon only returns 100 at a time so keep going
-            return self.get_host(host, rrecords[-1].type, rrecords[-1].name)
+        return found
 
-        return None
+    def _host_entry(self, rrset):
+        """Return the (rtype, [values, ], ttl) get_host representation of a RRSet, an alias as an 'Alias ' value."""
+        return (str(rrset.rtype), rrset.text_values(), rrset.ttl)
+
+    def _get_hosts(self, hosts):
+        """ Return a dictionary of {fqdn: [RRSet, ]} for the existing entries of many hosts.
+        Each host is looked up on its own unless listing the whole zone takes fewer requests.
+        """
+        fqdns = set(_fqdn(host) for host in hosts)
+        entries = dict((fqdn, []) for fqdn in fqdns)
+        if self.record_count is not None and self.record_count / 100 + 1 < len(fqdns):
+            log.debug("Listing all of zone %s to find %d hosts" % (self.zone_name, len(fqdns)))
+            for page in self._get_rrsets():
+                for rrecord in page:
+                    name = _unescape(str(rrecord.name))
+                    fqdn = _fqdn(name)
+                    if fqdn in entries:
+                        rrset = self._listed_rrset(name, rrecord)
+                        if rrset is not None:
+                            entries[fqdn].append(rrset)
+        else:
+            for fqdn in fqdns:
+                entries[fqdn] = self._get_host_rrsets(fqdn)
+
+        return entries
+
+    def _host_changes(self, rrset, existing):
+        """Return the changes which set a host entry to a RRSet, existing is the RRSet it has now or None."""
+        if existing is None:
+            return [('CREATE', rrset)]
+        return self._update_changes(existing, rrset)
 
-    def update(self, zone_file, dry_run):
+    @_counted
+    def update(self, zone_file, dry_run, verify=False, stream=False, subtree=None):
         """Compare existing Resource Records to the given zone file and update if needed.
         Do nothing, report only, if dry_run is true.
+        With a snapshot store, a zone file unchanged since it was last applied is skipped without fetching
+        the records from route 53, as long as route 53 reports the same record count. Verify always compares.
+        With stream the records from route 53 are compared a page at a time and changesets sent as they fill,
+        rather than holding every record of both zones, for very large zones.
+        With subtree, a name in the zone, only the records at or under that name are fetched and compared with
+        the same records of the zone file, everything else in the zone is left alone. Snapshots are not used.
         """
         if self.id == None:
             if not self.exists():
                 log.error('The zone ' + self.zone_name + " doesn't exist, create it don't update.")
                 return
+        if subtree is not None:
+            subtree = _fqdn(subtree)
+            if not self._check_subtree(subtree):
+                return
+
+        zone_hash = None
+        if self.snapshots is not None and subtree is None:
+            from cirrus.snapshot import file_hash
+            zone_hash = file_hash(zone_file)
+            snapshot = self.snapshots.get(self.zone_name)
+            if snapshot is not None and snapshot['hash'] == zone_hash and not verify:
+                if snapshot['id'] == self.id and snapshot['count'] == self.record_count:
+                    log.info("Zone %s is unchanged since it was last applied" % self.zone_name)
+                    self.applied = snapshot['records']
+                    return
+                log.warn("Zone %s has %s record sets in route 53 but %d were applied, comparing all records" % \
+                    (self.zone_name, self.record_count, snapshot['count']))
+
+        if stream:
+            self._update_stream(self._load(zone_file), zone_hash, dry_run, subtree)
+            return
 
-        dnszone = dns.zone.from_file(zone_file, origin=self.zone_name, relativize=False)
-        log.info("Bind zone from local file.\n" + self._print(dnszone) + "\n")
-        r53zone = self._to_dnszone()
-        log.info("Bind zone from r53.\n" + self._print(r53zone) + "\n")
+        rrecords = self._local_rrecords(zone_file, zone_hash)
+        if log.isEnabledFor(logging.INFO):
+            log.info("Records from local file.\n" + self._print_rrecords(rrecords) + "\n")
+        r53records = self._get_remote_rrecords(subtree)
+        if log.isEnabledFor(logging.INFO):
+            log.info("Records from r53.\n" + self._print_rrecords(r53records) + "\n")
 
-        adds, deletes, updates = self._compare(r53zone, dnszone)
+        if subtree is not None:
+            rrecords = RecordIndex((key, rrset) for key, rrset in rrecords.iteritems() \
+                if _in_subtree(rrset.name, subtree))
+        adds, deletes, updates = self._compare(r53records, rrecords)
         changesets = self._create_changeset(adds, deletes, updates)
         if changesets is None:
             log.warn("No differences found for zone %s" % self.zone_name)
+        else:
+            log.warn('Updating zone %s' % self.zone_name)
+            if dry_run:
+                return
+            self._submit(changesets)
+
+        if subtree is None and not dry_run:
+            self._record_applied(zone_hash, rrecords)
+
+    def _record_applied(self, zone_hash, rrecords):
+        """Keep the records route 53 now has from a zone file, with a snapshot of them if there is a store."""
+        self.applied = rrecords
+        if zone_hash is not None:
+            #Route 53 counts the SOA and root NS record sets along with those from the zone file
+            self.record_count = len(rrecords) + 2
+            get_index(self.conn).set_count(self.zone_name, self.record_count)
+            self.snapshots.put(self.zone_name, zone_hash, self.id, self.record_count, rrecords)
+
+    @_counted
+    def update_from(self, zone_file, dry_run):
+        """ Update the zone from a zone file changed since the last update, comparing it with the records that
+        update applied rather than fetching them from route 53 again. Without records applied, or if route 53
+        rejects a change because it no longer has the records expected, the zone is compared in full instead.
+        """
+        if self.applied is None:
+            self.update(zone_file, dry_run, True)
             return
 
-        log.warn('Updating zone %s' % self.zone_name)
-        if not dry_run:
-            for changeset in changesets:
-                log.debug(changeset)
-                change = self.conn.change_rrsets(self.id, changeset)
+        rrecords = self._local_rrecords(zone_file)
+        adds, deletes, updates = self._compare(self.applied, rrecords)
+        changesets = self._create_changeset(adds, deletes, updates)
+        if changesets is None:
+            log.warn("No differences found for zone %s" % self.zone_name)
+        else:
+            log.warn('Updating zone %s' % self.zone_name)
+            if dry_run:
+                return
+            try:
+                self._submit(changesets)
+            except Exception as e:
+                if getattr(e, 'error_code', None) != 'InvalidChangeBatch':
+                    raise
+                log.warn("Zone %s no longer has the records last applied, comparing it with route 53. %s" % \
+                    (self.zone_name, e))
+                self.applied = None
+                self.update(zone_file, dry_run, True)
+                return
+
+        zone_hash = None
+        if self.snapshots is not None:
+            from cirrus.snapshot import file_hash
+            zone_hash = file_hash(zone_file)
+        self._record_applied(zone_hash, rrecords)
+
+    def _check_subtree(self, subtree):
+        """Return true if the fqdn subtree is a name in this zone, logging an error if not."""
+        if _in_subtree(subtree, _fqdn(self.zone_name)):
+            return True
+        log.error("%s is not a name in zone %s" % (subtree, self.zone_name))
+        return False
+
+    @_counted
+    def plan(self, zone_file, subtree=None):
+        """ Compare the zone file with route 53 as update does but only return the changes found, as a
+        cirrus.plan.ZonePlan with the changesets packed and a fingerprint of the route 53 records compared.
+        A zone which doesn't exist is planned to be created. Returns None if subtree is not in the zone.
+        """
+        from cirrus.plan import ZonePlan
+        if subtree is not None:
+            subtree = _fqdn(subtree)
+            if not self._check_subtree(subtree):
+                return None
 
+        rrecords = self._local_rrecords(zone_file)
+        if subtree is not None:
+            rrecords = RecordIndex((key, rrset) for key, rrset in rrecords.iteritems() \
+                if _in_subtree(rrset.name, subtree))
+
+        if not self.exists():
+            if subtree is not None:
+                log.error("Zone %s does not exist, create it before updating part of it" % self.zone_name)
+                return None
+            log.warn('Planning to create zone ' + self.zone_name)
+            changesets = list(self._changesets(self._changes(rrecords, RecordIndex(), {})))
+            return ZonePlan(self.zone_name, None, None, rrecords, RecordIndex(), {}, changesets)
+
+        digest = hashlib.sha1()
+        r53records = self._get_remote_rrecords(subtree, digest)
+        adds, deletes, updates = self._compare(r53records, rrecords)
+        changesets = self._create_changeset(adds, deletes, updates) or []
+        if len(changesets) == 0:
+            log.warn("No differences found for zone %s" % self.zone_name)
+        return ZonePlan(self.zone_name, self.id, digest.hexdigest(), adds, deletes, updates, changesets, subtree)
+
+    @_counted
+    def apply(self, plan):
+        """ Submit the changesets of a plan without comparing again. Refuses, returning False, if route 53 no
+        longer has the records the plan was made from, which is checked by listing but not parsing them.
+        """
+        if plan.zone_id is None:
+            if self.exists():
+                log.error("Zone %s was created after it was planned, plan it again" % self.zone_name)
+                return False
+            log.warn('Creating zone ' + self.zone_name)
+            self._create_hosted_zone()
+        else:
+            if not self.exists() or self.id != plan.zone_id:
+                log.error("Zone %s is not the hosted zone %s it was planned for" % (self.zone_name, plan.zone_id))
+                return False
+            if self.fingerprint(plan.subtree) != plan.fingerprint:
+                log.error("The records of zone %s have changed since it was planned, plan it again" % \
+                    self.zone_name)
+                return False
+
+        if len(plan.changesets) == 0:
+            log.warn("No changes planned for zone %s" % self.zone_name)
+            return True
+        log.warn("Applying %d changesets to zone %s" % (len(plan.changesets), self.zone_name))
+        self._submit(plan.changesets)
+        return True
+
+    def _update_stream(self, dnszone, zone_hash, dry_run, subtree=None):
+        """The streaming half of update, comparing a page of route 53 records at a time."""
+        counts = {}
+        changesets = self._changesets(self._stream_changes(dnszone, counts, subtree))
+        if dry_run:
+            sent = len([changeset for changeset in changesets])
+        else:
+            sent = self._submit(changesets)
+
+        if sent == 0:
+            log.warn("No differences found for zone %s" % self.zone_name)
+        elif dry_run:
+            log.warn("Zone %s would be updated in %d changesets" % (self.zone_name, sent))
+        else:
+            log.warn("Updated zone %s in %d changesets" % (self.zone_name, sent))
+
+        if zone_hash is not None and not dry_run:
+            #Records aren't kept in a streamed snapshot, that would hold the whole zone in memory again
+            self.record_count = counts['records'] + 2
+            get_index(self.conn).set_count(self.zone_name, self.record_count)
+            self.snapshots.put(self.zone_name, zone_hash, self.id, self.record_count, None)
+
+    def _submit(self, changesets, progress=None):
+        """ Send each changeset to route 53 in order. Throttled requests are retried by the client so an
+        update resumes from the changeset which failed, if one fails for good the progress made is logged.
+        If given progress is called with the number of changesets sent after each one.
+        """
+        sent = 0
+        for changeset in changesets:
+            try:
+                self._send(changeset)
+            except Exception:
+                log.error("Zone %s failed after %d changesets were applied." % (self.zone_name, sent))
+                raise
+            sent += 1
+            if progress is not None:
+                progress(sent)
+        return sent
+
+    def _send(self, changeset):
+        """Send one changeset to route 53, counting it and handing the change to the tracker."""
+        log.debug(changeset)
+        response = self.conn.change_rrsets(self.id, changeset)
+        self.stats.count('batches')
+        self.stats.count('bytes_sent', len(changeset))
+        if self.tracker is not None:
+            self.tracker.add(self.zone_name, response)
+        return response
+
+    @_counted
     def update_host(self, fqdn, rtype, ttl, existing, value):
         """Updates a individual host entry in this zone.
             Existing is the output of get_host(host)
         """
-        xmlout = self.xml_header
-        xmlout += self._delete_change_xml(fqdn, existing[0], existing[2], existing[1])
-        xmlout += self._add_change_xml(fqdn, rtype, ttl, [value, ])
-        xmlout += self.xml_footer
-        log.debug(xmlout)
         log.warn("Updating %s %s %s to %s" % (fqdn, rtype, ttl, value))
-        self.conn.change_rrsets(self.id, xmlout)
+        current = RRSet.from_text(fqdn, existing[0], existing[2], existing[1])
+        self._submit(self._changesets([self._host_changes(RRSet.from_text(fqdn, rtype, ttl, [value, ]), current)]))
+
+    @_counted
+    def update_hosts(self, hosts):
+        """ Create or update many host entries in this zone using as few requests as possible.
+            Hosts is a RecordIndex of RRSets keyed by (fqdn, rtype), as with update_host an entry of another
+            type is replaced unless the host also has one of rtype. An entry of a type the batch also sets for
+            that host is never replaced, nor is one entry replaced twice. Entries already set are skipped.
+            Returns the number of hosts changed.
+        """
+        existing = self._get_hosts([fqdn for fqdn, rtype in hosts])
+        batch_types = {}
+        for fqdn, rtype in hosts:
+            batch_types.setdefault(_fqdn(fqdn), set()).add(RRType(rtype))
+        replaced = set()
+        changes = []
+        for key in sorted(hosts):
+            rrset = hosts[key]
+            fqdn = _fqdn(rrset.name)
+            entries = existing[fqdn]
+            current = None
+            for entry in entries:
+                if entry.rtype is rrset.rtype:
+                    current = entry
+            if current is None:
+                for entry in entries:
+                    if entry.rtype not in batch_types[fqdn] and (fqdn, entry.rtype) not in replaced:
+                        current = entry
+                        replaced.add((fqdn, entry.rtype))
+                        break
+
+            if current is not None and current.matches(rrset):
+                log.info("%r is already set" % rrset)
+                continue
+
+            if current is None:
+                log.warn("Adding %r" % rrset)
+            else:
+                log.warn("Updating %r" % rrset)
+            changes.append(self._host_changes(rrset, current))
+
+        self._submit(self._changesets(changes))
+        return len(changes)
+
+    def _delete_changes(self, pages, counts):
+        """ Yield a DELETE change group for each rrset in pages of boto rrsets, other than the SOA and root NS.
+        The values are sent back exactly as route 53 listed them. Keeps the rrsets seen in counts['listed'].
+        """
+        for page in pages:
+            for rrecord in page:
+                rrset = self._listed_rrset(_unescape(str(rrecord.name)), rrecord)
+                if rrset is None:
+                    continue
 
+                counts['listed'] += 1
+                log.debug("Removing %r" % rrset)
+                yield [('DELETE', rrset)]
+
+    @_counted
     def remove(self, dry_run):
-        """Remove this zone from AWS."""
+        """ Remove this zone from AWS.
+        The records are deleted as they are listed, a changeset is sent while the next page is fetched.
+        Progress is logged as it goes and since only the records still in route 53 are listed, running remove
+        again after it was interrupted carries on where it stopped.
+        """
         if self.id == None:
             if not self.exists():
                 log.warn("Zone " + self.zone_name + " doesn't exist.")
@@ -379,32 +1089,29 @@ class Zone:
 
         log.warn("Removing zone " + self.zone_name)
         if not dry_run:
-            rrecords = self._get_rrecords(self._to_dnszone())
-            
-            xmllist = []
-            rrecord_keys = rrecords.keys()
-            rrecord_groups = [ rrecord_keys[n:n+100] for n in range(0, len(rrecord_keys), 100)]
-            for rrecords_slice in rrecord_groups: 
-                xml = self.xml_header
-                
-                change_needed = False #If only NS and SOA records just delete the zone
-                for key in rrecords_slice:
-                    name = key[0]
-                    rtype = key[1]
-                    ttl = key[2]
-                    if rtype == 'NS' and name[:-1] == self.zone_name:
-                        continue
-                    elif rtype == 'SOA':
-                        continue
-                    change_needed = True
-                    log.debug("Removing %s, type %s, ttl %d, values %s" % (name, rtype, ttl, rrecords[key]))
-                    xml += self._delete_change_xml(name, rtype, ttl, rrecords[key])
-
-                xml += self.xml_footer
-                if change_needed:
-                    xmllist.append(xml)
-
-            for xml in xmllist:
-                log.debug("Change xml\n" + str(xml))
-                change = self.conn.change_rrsets(self.id, xml)
+            counts = {'listed': 0}
+            total = '?'
+            if self.record_count is not None:
+                total = max(self.record_count - 2, 0)
+            start = time.time()
+            last = [start]
+
+            def progress(sent):
+                now = time.time()
+                message = "Zone %s: %d changesets sent, %d of %s record sets listed for removal, %.1fs" % \
+                    (self.zone_name, sent, counts['listed'], total, now - start)
+                if now - last[0] >= self.PROGRESS_INTERVAL:
+                    last[0] = now
+                    log.warn(message)
+                else:
+                    log.info(message)
+
+            pages = _prefetch(self._get_rrsets(), stats=self.stats)
+            try:
+                sent = self._submit(self._changesets(self._delete_changes(pages, counts)), progress)
+            finally:
+                pages.close() #Stops the page reader if a changeset failed
+            log.warn("Removed %d record sets from zone %s in %d changesets, %.1fs" % \
+                (counts['listed'], self.zone_name, sent, time.time() - start))
             delete = self.conn.delete_hosted_zone(self.id)
+            get_index(self.conn).remove(self.zone_name)
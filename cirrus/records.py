@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+#
+""" The record sets cirrus.r53.Zone compares and sends to route 53.
+A zone of hundreds of thousands of records is held in memory while it is compared, so a record set is a
+slotted object with its name and type interned, shared by every record set of that name, and its values in
+an immutable sorted tuple. A route 53 alias is kept as an AliasTarget rather than as a value.
+Outside of Zone, in zone files, snapshots, plans and on the command line, an alias is written as the
+value 'Alias <hosted zone id> <dns name>'.
+"""
+
+ALIAS_PREFIX = 'Alias '
+
+class RRType(str):
+    """ A record type, ie RRType('A'). There is only one RRType for each type so they can be compared by
+    identity and cost nothing to hold in each record set. It is still a string, for xml and json.
+    """
+    __slots__ = ()
+    _types = {}
+
+    def __new__(cls, name):
+        rtype = cls._types.get(name)
+        if rtype is None:
+            rtype = str.__new__(cls, str(name).upper())
+            rtype = cls._types.setdefault(str(rtype), rtype)
+            cls._types[name] = rtype
+        return rtype
+
+    def __repr__(self):
+        return 'RRType(%s)' % str.__repr__(self)
+
+    def __reduce__(self):
+        return (RRType, (str(self),))
+
+for _name in ['A', 'AAAA', 'CAA', 'CNAME', 'MX', 'NAPTR', 'NS', 'PTR', 'SOA', 'SPF', 'SRV', 'TXT']:
+    setattr(RRType, _name, RRType(_name))
+
+class AliasTarget(object):
+    """The hosted zone id and dns name a route 53 alias points at."""
+    __slots__ = ('zone_id', 'dns_name')
+
+    def __init__(self, zone_id, dns_name):
+        self.zone_id = intern(str(zone_id))
+        self.dns_name = str(dns_name)
+
+    def __eq__(self, other):
+        return isinstance(other, AliasTarget) and self.zone_id == other.zone_id and self.dns_name == other.dns_name
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.zone_id, self.dns_name))
+
+    def __str__(self):
+        return '%s%s %s' % (ALIAS_PREFIX, self.zone_id, self.dns_name)
+
+    def __repr__(self):
+        return '<AliasTarget %s %s>' % (self.zone_id, self.dns_name)
+
+    @classmethod
+    def from_text(cls, value):
+        """Return the AliasTarget for an 'Alias <hosted zone id> <dns name>' value."""
+        words = value.split()
+        if len(words) != 3 or words[0] != ALIAS_PREFIX.strip():
+            raise ValueError("Expected 'Alias <hosted zone id> <dns name>', not %s" % value)
+        return cls(words[1], words[2])
+
+class RRSet(object):
+    """ One route 53 resource record set, the name, type, ttl and either sorted values or an alias.
+    A record set from a zone file can have an alias and values for the same name, they are sent as two
+    changes. Record sets are not changed once made, merge returns a new one.
+    """
+    __slots__ = ('name', 'rtype', 'ttl', 'values', 'alias')
+
+    def __init__(self, name, rtype, ttl, values=(), alias=None):
+        self.name = intern(str(name))
+        self.rtype = RRType(rtype)
+        self.ttl = int(ttl)
+        self.values = tuple(sorted(values))
+        self.alias = alias
+
+    @classmethod
+    def from_text(cls, name, rtype, ttl, values):
+        """Return the RRSet for a list of value strings in which an alias is an 'Alias ...' value."""
+        alias = None
+        plain = []
+        for value in values:
+            value = str(value)
+            if value[:len(ALIAS_PREFIX)] == ALIAS_PREFIX:
+                if alias is None:
+                    alias = AliasTarget.from_text(value)
+            else:
+                plain.append(value)
+        return cls(name, rtype, ttl, plain, alias)
+
+    @property
+    def key(self):
+        return (self.name, self.rtype)
+
+    def text_values(self):
+        """Return the values as a list of strings, an alias as an 'Alias ...' value."""
+        if self.alias is None:
+            return list(self.values)
+        return [str(self.alias)] + list(self.values)
+
+    def matches(self, other):
+        """Return true if other holds the same records, the ttl of an alias is not compared as it has none."""
+        return self.rtype is other.rtype and self.values == other.values and self.alias == other.alias and \
+            (self.ttl == other.ttl or self.alias is not None)
+
+    def merge(self, other):
+        """Return a record set with the values of both, keeping this ttl and the first alias."""
+        return RRSet(self.name, self.rtype, self.ttl, self.values + other.values, self.alias or other.alias)
+
+    def to_row(self):
+        """Return [name, rtype, ttl, [values]] with an alias as a value, the form kept in snapshots and plans."""
+        return [self.name, str(self.rtype), self.ttl, self.text_values()]
+
+    @classmethod
+    def from_row(cls, row):
+        """Return the RRSet for a row made by to_row, which may have come back from json as unicode."""
+        name, rtype, ttl, values = row
+        return cls.from_text(name, rtype, ttl, values)
+
+    def __eq__(self, other):
+        return isinstance(other, RRSet) and self.name == other.name and self.matches(other) and \
+            self.ttl == other.ttl
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '%s %s %s %s' % (self.name, self.rtype, self.ttl, self.text_values())
+
+class RecordIndex(dict):
+    """The record sets of a zone, or part of one, keyed by (name, rtype)."""
+
+    def add(self, rrset):
+        """Add a record set, merging its values with any already held for the same name and type."""
+        key = rrset.key
+        existing = self.get(key)
+        if existing is not None:
+            rrset = existing.merge(rrset)
+        self[key] = rrset
+
+    def to_rows(self):
+        """Return a row for each record set, sorted, as RRSet.to_row makes."""
+        return [self[key].to_row() for key in sorted(self)]
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Return the RecordIndex for rows made by to_rows."""
+        index = cls()
+        for row in rows:
+            index.add(RRSet.from_row(row))
+        return index
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+#
+""" Snapshots of the zone files last applied to route 53.
+For each zone the store keeps a hash of the zone file content, the hosted zone id, the resource record set
+count route 53 should report afterwards and the records the file produced. A zone whose file hash is unchanged
+and whose hosted zone still reports that count needs no fetch from route 53 at all.
+"""
+
+from cStringIO import StringIO
+import gzip
+import hashlib
+import json
+import logging
+import os
+
+from cirrus.fileutil import atomic_write
+from cirrus.records import RecordIndex
+
+log = logging.getLogger('cirrus')
+
+def file_hash(path):
+    """Return the sha1 hex digest of a file's content."""
+    digest = hashlib.sha1()
+    zone_file = open(path, 'rb')
+    try:
+        for chunk in iter(lambda: zone_file.read(65536), ''):
+            digest.update(chunk)
+    finally:
+        zone_file.close()
+    return digest.hexdigest()
+
+class SnapshotStore(object):
+    """Keeps a gzipped json snapshot for each zone in a directory."""
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def _file(self, zone_name):
+        return os.path.join(self.path, zone_name.rstrip('.').lower() + '.json.gz')
+
+    def get(self, zone_name):
+        """ Return the snapshot for a zone as a dictionary with keys hash, id, count and records or None.
+        Records are a cirrus.records.RecordIndex as Zone._get_rrecords returns, or None if not kept.
+        """
+        try:
+            snapshot_file = gzip.open(self._file(zone_name), 'rb')
+            try:
+                snapshot = json.load(snapshot_file)
+            finally:
+                snapshot_file.close()
+        except (IOError, ValueError) as e:
+            log.debug("No snapshot for zone %s: %s" % (zone_name, e))
+            return None
+
+        if snapshot['records'] is not None:
+            snapshot['records'] = RecordIndex.from_rows(snapshot['records'])
+        return snapshot
+
+    def put(self, zone_name, zone_hash, zone_id, count, records):
+        """Store the snapshot for a zone, records may be None to keep only the hash and count."""
+        if records is not None:
+            records = records.to_rows()
+        snapshot = {'hash': zone_hash, 'id': zone_id, 'count': count, 'records': records}
+        data = StringIO()
+        snapshot_file = gzip.GzipFile(fileobj=data, mode='wb')
+        try:
+            json.dump(snapshot, snapshot_file, separators=(',', ':'))
+        finally:
+            snapshot_file.close()
+        atomic_write(self._file(zone_name), data.getvalue())
+
+    def discard(self, zone_name):
+        """Remove the snapshot for a zone."""
+        try:
+            os.remove(self._file(zone_name))
+        except OSError:
+            pass
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+#
+""" Counters and timings for a run, kept by the Route53Client and added to by cirrus.r53.Zone.
+Everything counted is attributed to the zone being worked on by the thread counting it, which Zone sets while
+its methods run, so a run over many zones with --jobs reports each zone separately and in total. Work outside
+any zone, like listing the hosted zones or waiting for changes, is kept as unattributed.
+The report can be written as json or as a Prometheus node exporter textfile.
+"""
+
+from contextlib import contextmanager
+import logging
+import threading
+import time
+
+from cirrus.fileutil import atomic_write
+
+log = logging.getLogger('cirrus')
+
+#The zone each thread is working on, shared by every Stats so that anything logging from the thread can tell too
+_local = threading.local()
+
+def current_zone():
+    """Return the zone the calling thread is working on, None if it isn't working on one."""
+    return getattr(_local, 'zone', None)
+
+#Counter name: Prometheus help text
+COUNTERS = {
+    'api_calls': "Route 53 requests made, including retries.",
+    'api_seconds': "Seconds spent waiting on route 53 responses.",
+    'retries': "Route 53 requests retried after throttling or a transient error.",
+    'pages': "Pages of resource record sets listed.",
+    'records_diffed': "Resource record sets compared.",
+    'batches': "Change batches sent.",
+    'bytes_sent': "Bytes of change batch xml sent.",
+    'parse_seconds': "Seconds spent parsing zone files.",
+    'parse_cache_hits': "Zone files whose records were read from the parse cache.",
+    'parse_cache_misses': "Zone files parsed as the parse cache didn't hold them.",
+    'registrations': "Host registrations taken by the update daemon.",
+    'registrations_coalesced': "Host registrations replaced by a later one for the same host before a flush.",
+    'host_cache_hits': "Host registrations the update daemon knew were already set.",
+    'diff_seconds': "Seconds spent comparing records.",
+    'xml_seconds': "Seconds spent packing changes into change batch xml.",
+}
+
+class Stats(object):
+    """ Thread safe counters, keyed by zone, counter name and optionally the route 53 operation.
+    Timings are counters of seconds, named with a _seconds suffix.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {} #(zone, counter, operation): value
+        self.start = time.time()
+
+    def current_zone(self):
+        """Return the zone the calling thread is working on, None if it isn't working on one."""
+        return current_zone()
+
+    @contextmanager
+    def zone(self, name):
+        """Attribute everything counted by this thread to a zone until the block ends."""
+        previous = current_zone()
+        _local.zone = name
+        try:
+            yield
+        finally:
+            _local.zone = previous
+
+    def count(self, counter, value=1, operation=None):
+        """Add to a counter of the current zone."""
+        key = (self.current_zone(), counter, operation)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    @contextmanager
+    def span(self, name, operation=None):
+        """Add the seconds the block takes to the name_seconds counter of the current zone."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.count(name + '_seconds', time.time() - start, operation)
+
+    def to_dict(self):
+        """ Return the report as a dictionary of 'zones', {zone: counters}, 'unattributed' and 'total' counters
+        and the 'seconds' since the stats were started. Counters by operation are a dictionary of operations.
+        """
+        def add(counters, counter, operation, value):
+            if operation is None:
+                counters[counter] = counters.get(counter, 0) + value
+            else:
+                by_operation = counters.setdefault(counter, {})
+                by_operation[operation] = by_operation.get(operation, 0) + value
+
+        report = {'zones': {}, 'unattributed': {}, 'total': {}, 'seconds': time.time() - self.start}
+        with self.lock:
+            counters = self.counters.items()
+        for (zone, counter, operation), value in counters:
+            if zone is None:
+                add(report['unattributed'], counter, operation, value)
+            else:
+                add(report['zones'].setdefault(zone, {}), counter, operation, value)
+            add(report['total'], counter, operation, value)
+        return report
+
+    def prometheus(self):
+        """ Return the report in the Prometheus text format. Each counter is a cirrus_<counter>_total metric
+        labelled by zone, work outside any zone has no zone label, and cirrus_run_<counter>_total is the total.
+        """
+        def labels(**values):
+            values = [(name, value) for name, value in sorted(values.items()) if value is not None]
+            if len(values) == 0:
+                return ''
+            return '{%s}' % ','.join('%s="%s"' % (name, _label_value(value)) for name, value in values)
+
+        with self.lock:
+            counters = self.counters.items()
+        totals = {}
+        for (zone, counter, operation), value in counters:
+            totals[(counter, operation)] = totals.get((counter, operation), 0) + value
+
+        lines = []
+        for counter in sorted(set(counter for counter, operation in totals)):
+            for prefix, scope in (('cirrus_', 'zone'), ('cirrus_run_', 'run')):
+                metric = '%s%s_total' % (prefix, counter)
+                lines.append('# HELP %s %s Per %s.' % (metric, COUNTERS.get(counter, counter), scope))
+                lines.append('# TYPE %s counter' % metric)
+                if scope == 'zone':
+                    samples = [(labels(zone=zone, operation=operation), value) \
+                        for (zone, name, operation), value in counters if name == counter]
+                else:
+                    samples = [(labels(operation=operation), value) \
+                        for (name, operation), value in totals.iteritems() if name == counter]
+                for sample_labels, value in sorted(samples):
+                    lines.append('%s%s %s' % (metric, sample_labels, _number(value)))
+        lines.append('# HELP cirrus_run_seconds Seconds the run has taken.')
+        lines.append('# TYPE cirrus_run_seconds gauge')
+        lines.append('cirrus_run_seconds %s' % _number(time.time() - self.start))
+        lines.append('# HELP cirrus_run_timestamp_seconds When the stats were written.')
+        lines.append('# TYPE cirrus_run_timestamp_seconds gauge')
+        lines.append('cirrus_run_timestamp_seconds %d' % time.time())
+        return '\n'.join(lines) + '\n'
+
+    def write_json(self, path):
+        """Write the report as json, replacing the file in one step."""
+        import json
+        atomic_write(path, json.dumps(self.to_dict(), indent=1, sort_keys=True) + '\n', 0644)
+
+    def write_prometheus(self, path):
+        """Write the report for the Prometheus node exporter textfile collector, replacing the file in one step."""
+        atomic_write(path, self.prometheus(), 0644) #Readable by an exporter running as another user
+
+def write_stats(stats, json_path=None, prometheus_path=None):
+    """Write the report to either or both files, logging rather than raising if one can't be written."""
+    for path, write in ((json_path, stats.write_json), (prometheus_path, stats.write_prometheus)):
+        if path is None:
+            continue
+        try:
+            write(path)
+        except (IOError, OSError) as e:
+            log.error("Unable to write stats to %s: %s" % (path, e))
+
+def _label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _number(value):
+    if isinstance(value, float):
+        return '%.6f' % value
+    return str(value)
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+#
+""" Run an action against many zones at once with a bounded pool of worker threads.
+Log records from each worker, and from the threads it starts for its zone, are held back until the zone is
+finished and then written together, so the output for one zone is never interleaved with another.
+"""
+
+import logging
+import Queue
+import threading
+import time
+
+from cirrus.stats import current_zone
+
+log = logging.getLogger('cirrus')
+
+class ZoneResult(object):
+    """The outcome of running an action on a single zone."""
+
+    def __init__(self, name):
+        self.name = name
+        self.error = None
+        self.output = None
+        self.elapsed = 0.0
+        self.records = []
+
+    @property
+    def ok(self):
+        return self.error is None
+
+class _ZoneLogBuffer(logging.Filter):
+    """ A logger filter that holds back records logged from worker threads until the zone is done.
+    Records from other threads working on the zone, as cirrus.stats.current_zone tells, are held with them.
+    """
+
+    def __init__(self):
+        logging.Filter.__init__(self)
+        self.held = {} #thread ident: [LogRecord, ]
+        self.zones = {} #zone name: the same list of records as its worker thread
+
+    def filter(self, record):
+        if getattr(record, 'cirrus_replay', False):
+            return True
+        records = self.held.get(record.thread)
+        if records is None:
+            records = self.zones.get(current_zone())
+        if records is None:
+            return True
+        records.append(record)
+        return False
+
+    def start(self, name):
+        """Start holding records for the current thread and the zone it works on."""
+        records = []
+        self.held[threading.current_thread().ident] = records
+        self.zones[name] = records
+
+    def finish(self, name):
+        """Stop holding records for the current thread and its zone and return those held."""
+        self.zones.pop(name, None)
+        return self.held.pop(threading.current_thread().ident, [])
+
+    def replay(self, records):
+        """Write held records through the cirrus logger handlers."""
+        for record in records:
+            record.cirrus_replay = True
+            log.handle(record)
+
+def _worker(jobs, results, func, buf):
+    """Pull (name, zone_file) jobs off the queue until a None is found."""
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+        name, zone_file = job
+        result = ZoneResult(name)
+        buf.start(name)
+        start = time.time()
+        try:
+            result.output = func(name, zone_file)
+        except Exception as e:
+            log.debug('Error syncing zone %s' % name, exc_info=True)
+            log.error('Zone %s failed: %s' % (name, e))
+            result.error = e
+        result.elapsed = time.time() - start
+        result.records = buf.finish(name)
+        results.put(result)
+
+def sync_zones(zones, func, jobs):
+    """ Call func(name, zone_file) for each entry in the zones dictionary using up to jobs threads.
+    Any output returned by func is printed once that zone finishes. Returns a list of ZoneResult.
+    """
+    job_queue = Queue.Queue()
+    result_queue = Queue.Queue()
+    for name, zone_file in zones.iteritems():
+        job_queue.put((name, zone_file))
+
+    buf = _ZoneLogBuffer()
+    log.addFilter(buf)
+    try:
+        workers = min(jobs, len(zones))
+        for n in range(workers):
+            job_queue.put(None)
+            worker = threading.Thread(target=_worker, args=(job_queue, result_queue, func, buf))
+            worker.daemon = True
+            worker.start()
+
+        start = time.time()
+        results = []
+        while len(results) < len(zones):
+            try:
+                result = result_queue.get(True, 0.5) #A timeout keeps the main thread responsive to ctrl-c
+            except Queue.Empty:
+                continue
+            buf.replay(result.records)
+            result.records = []
+            if result.output is not None:
+                print result.output
+            results.append(result)
+    finally:
+        log.removeFilter(buf)
+
+    _summarize(results, time.time() - start)
+    return results
+
+def _summarize(results, elapsed):
+    """Log a summary line for the run and one line for each failed zone."""
+    failed = [result for result in results if not result.ok]
+    log.warn("Synced %d zones in %.1fs, %d ok, %d failed" % \
+        (len(results), elapsed, len(results) - len(failed), len(failed)))
+    for result in sorted(failed, key=lambda result: result.name):
+        log.error("  %s: %s" % (result.name, result.error))
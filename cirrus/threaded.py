@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+#
+""" A Zone which overlaps its route 53 requests with its own work and with each other.
+Listings fetch the next page while the last is still being compared, a whole zone is listed as several ranges
+of names at once when the zone file shows where to split it, and changesets which touch none of the
+same names are sent together, while a changeset sharing a name with an earlier one waits for it so deletes
+are still applied before the creates which conflict with them. Any Zone method can also be started in the
+background, returning a Task to wait on or be called back from.
+"""
+
+import logging
+import re
+import sys
+import threading
+
+from cirrus.r53 import Zone, _prefetch, _route53_order
+from cirrus.records import RecordIndex
+
+log = logging.getLogger('cirrus')
+
+_NAMES = re.compile(r'<(?:Name|DNSName)>([^<]*)</(?:Name|DNSName)>')
+_PLAIN_NAME = re.compile(r'^[a-z0-9\-_.]+$') #Names route 53 can start a listing at without escaping
+
+def _changeset_names(changeset):
+    """Return the record names, and the alias targets, a changeset's xml touches, lower case without the dot."""
+    return set(name.lower().rstrip('.') for name in _NAMES.findall(changeset))
+
+class Task(object):
+    """The outcome of a ThreadedZone method running in the background."""
+
+    def __init__(self):
+        self.finished = threading.Event()
+        self.lock = threading.Lock()
+        self.value = None
+        self.error = None
+        self.callbacks = []
+
+    def done(self):
+        return self.finished.is_set()
+
+    def result(self, timeout=None):
+        """Wait for the method to return and return its value, raising whatever it raised."""
+        if not self.finished.wait(timeout):
+            raise RuntimeError("Timed out waiting for the zone task")
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+        return self.value
+
+    def add_done_callback(self, func):
+        """Call func(task) from the task's thread once it finishes, or now if it already has."""
+        with self.lock:
+            if not self.finished.is_set():
+                self.callbacks.append(func)
+                return
+        func(self)
+
+    def _finish(self, value=None, error=None):
+        with self.lock:
+            self.value = value
+            self.error = error
+            self.finished.set()
+            callbacks = self.callbacks
+            self.callbacks = []
+        for func in callbacks:
+            try:
+                func(self)
+            except Exception:
+                log.exception("Zone task callback failed")
+
+class ThreadedZone(Zone):
+    """ A Zone which sends up to concurrency changesets at once and lists route 53 a page ahead.
+    Every request still goes through the shared client, so the rate limit and retries apply as for Zone.
+    """
+
+    def __init__(self, conn, zone_name, tracker=None, snapshots=None, parse_cache=None, concurrency=4):
+        Zone.__init__(self, conn, zone_name, tracker, snapshots, parse_cache)
+        self.concurrency = concurrency
+        self.boundaries = [] #Names splitting the zone into ranges listed at once, from the last zone file loaded
+
+    def start(self, method, *args, **kwargs):
+        """Run a Zone method, ie 'update', in a background thread returning a Task for its result."""
+        task = Task()
+        func = getattr(self, method)
+
+        def run():
+            try:
+                value = func(*args, **kwargs)
+            except Exception:
+                task._finish(error=sys.exc_info())
+            else:
+                task._finish(value)
+
+        thread = threading.Thread(target=run, name='cirrus-%s-%s' % (method, self.zone_name))
+        thread.daemon = True
+        thread.start()
+        return task
+
+    def _local_rrecords(self, zone_file, zone_hash=None):
+        """Read a zone file's records as Zone does, then pick names evenly spread through them to split listings at."""
+        rrecords = Zone._local_rrecords(self, zone_file, zone_hash)
+        self.boundaries = []
+        if self.concurrency > 1:
+            names = sorted(set(name.lower() for name, rtype in rrecords if _PLAIN_NAME.match(name.lower())), \
+                key=_route53_order)
+            step = len(names) // self.concurrency
+            if step > 0:
+                self.boundaries = [names[step * n] for n in range(1, self.concurrency)]
+        return rrecords
+
+    def _get_remote_rrecords(self, subtree=None, digest=None):
+        """ Gets all resource records from route 53 as Zone does, listing the ranges between boundaries at
+        once when there are any. A digest needs the records in order so is always listed in one go.
+        """
+        if subtree is not None or digest is not None or len(self.boundaries) == 0:
+            return Zone._get_remote_rrecords(self, subtree, digest)
+
+        ranges = zip([None] + self.boundaries, self.boundaries + [None])
+        results = [None] * len(ranges)
+        failed = []
+        zone = self.stats.current_zone()
+
+        def list_range(n, between):
+            try:
+                with self.stats.zone(zone):
+                    results[n] = list(self._iter_remote_rrecords(between=between))
+            except Exception:
+                failed.append(sys.exc_info())
+
+        threads = []
+        for n, between in enumerate(ranges):
+            thread = threading.Thread(target=list_range, args=(n, between), name='cirrus-list')
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        if len(failed) > 0:
+            raise failed[0][0], failed[0][1], failed[0][2]
+
+        rrecords = RecordIndex()
+        for rrsets in results:
+            for rrset in rrsets:
+                rrecords.add(rrset)
+        return rrecords
+
+    def _get_rrsets(self, ltype=None, lname=None):
+        """Gets rrsets from route 53 as Zone does, fetching each page while the one before is used."""
+        return _prefetch(Zone._get_rrsets(self, ltype, lname), 1, self.stats)
+
+    def _submit(self, changesets, progress=None):
+        """ Send the changesets with up to concurrency in flight. A changeset waits for every earlier one
+        touching any of its names, if one fails no changeset waiting for it is sent and the error is raised
+        once those in flight finish. Progress is called with the number sent after each one.
+        """
+        if self.concurrency <= 1:
+            return Zone._submit(self, changesets, progress)
+
+        slots = threading.BoundedSemaphore(self.concurrency)
+        lock = threading.Lock()
+        last = {} #name: Event set once the latest changeset touching it is finished
+        failed = []
+        sent = [0]
+        threads = []
+        zone = self.stats.current_zone()
+
+        def send(changeset, after, finished):
+            try:
+                for event in after:
+                    event.wait()
+                if len(failed) == 0:
+                    with self.stats.zone(zone):
+                        self._send(changeset)
+                        with lock:
+                            sent[0] += 1
+                            count = sent[0]
+                        if progress is not None:
+                            progress(count)
+            except Exception:
+                failed.append(sys.exc_info())
+            finally:
+                finished.set()
+                slots.release()
+
+        try:
+            for changeset in changesets:
+                slots.acquire()
+                if len(failed) > 0:
+                    slots.release()
+                    break
+                names = _changeset_names(changeset)
+                after = set(last[name] for name in names if name in last)
+                finished = threading.Event()
+                for name in names:
+                    last[name] = finished
+                thread = threading.Thread(target=send, args=(changeset, after, finished), name='cirrus-submit')
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+        finally:
+            for thread in threads:
+                thread.join()
+
+        if len(failed) > 0:
+            log.error("Zone %s failed after %d changesets were applied." % (self.zone_name, sent[0]))
+            raise failed[0][0], failed[0][1], failed[0][2]
+        return sent[0]
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+#
+""" Notice when files change, for dns_setup --watch.
+Files are polled rather than relying on a platform notification api, a change is reported only once a file
+has stopped changing so a file written in several steps is synced once, when it is complete.
+"""
+
+import logging
+import os
+import time
+
+log = logging.getLogger('cirrus')
+
+class FileWatcher(object):
+    """ Polls a set of files for changes to their modification time, size or inode.
+    A change is reported by changed once the file has looked the same for debounce seconds.
+    A file which goes missing is reported when it is back.
+    """
+
+    def __init__(self, debounce=2):
+        self.debounce = debounce
+        self.seen = {} #path: signature when last reported
+        self.pending = {} #path: (signature, time it was first seen)
+
+    def _signature(self, path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return (stat.st_mtime, stat.st_size, stat.st_ino)
+
+    def add(self, path):
+        """Start watching a file, it counts as unchanged as it is now."""
+        self.seen[path] = self._signature(path)
+        self.pending.pop(path, None)
+
+    def remove(self, path):
+        """Stop watching a file."""
+        self.seen.pop(path, None)
+        self.pending.pop(path, None)
+
+    def changed(self):
+        """Return the files which changed since they were added or last returned and have since settled."""
+        now = time.time()
+        settled = []
+        for path, seen in self.seen.items():
+            signature = self._signature(path)
+            if signature == seen:
+                self.pending.pop(path, None)
+                continue
+
+            pending = self.pending.get(path)
+            if pending is None or pending[0] != signature: #Changed again, start waiting over
+                log.debug("%s changed" % path)
+                self.pending[path] = (signature, now)
+            elif signature is not None and now - pending[1] >= self.debounce:
+                self.seen[path] = signature
+                del self.pending[path]
+                settled.append(path)
+        return settled
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+#
+"""Tests for cirrus.changes.ChangeTracker run against the in memory route 53 of cirrus.fake."""
+
+import logging
+import unittest
+
+from cirrus.changes import ChangeTracker
+from cirrus.client import Route53Client
+from cirrus.r53 import Zone
+from cirrus.records import RecordIndex, RRSet
+from tests.util import FakeZoneTestCase, LogMessages, ZONE_NAME
+
+class ChangeTrackerTest(FakeZoneTestCase):
+
+    def setUp(self):
+        FakeZoneTestCase.setUp(self)
+        self.client = Route53Client(self.conn)
+        self.tracker = ChangeTracker()
+        self.zone = Zone(self.client, ZONE_NAME, tracker=self.tracker)
+        self.zone.exists()
+        self.hosts = 0
+        self.messages = LogMessages()
+        logging.getLogger('cirrus').addHandler(self.messages)
+
+    def tearDown(self):
+        logging.getLogger('cirrus').removeHandler(self.messages)
+
+    def submit(self, count):
+        """Send count changes, one host at a time."""
+        for n in range(count):
+            self.hosts += 1
+            hosts = RecordIndex()
+            hosts.add(RRSet.from_text('host%d.%s.' % (self.hosts, ZONE_NAME), 'A', 300, ['10.0.0.1']))
+            self.zone.update_hosts(hosts)
+
+    def test_waits_for_every_change(self):
+        self.submit(12)
+        self.conn.reset_calls()
+        self.assertTrue(self.tracker.wait(self.client, timeout=5, interval=0, concurrency=4))
+        self.assertEqual(self.tracker.pending, {})
+        self.assertEqual(self.conn.calls['get_change'], 12)
+
+    def test_counts_each_wait(self):
+        self.submit(3)
+        self.tracker.wait(self.client, timeout=5, interval=0)
+        self.submit(2)
+        self.tracker.wait(self.client, timeout=5, interval=0)
+        summaries = [message for message in self.messages.messages if message.startswith('All ')]
+        self.assertEqual([summary.split(' changes')[0] for summary in summaries], ['All 3', 'All 2'])
+
+if __name__ == '__main__':
+    unittest.main()
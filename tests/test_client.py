@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+#
+"""Tests for cirrus.client.Route53Client retries run against the in memory route 53 of cirrus.fake."""
+
+import unittest
+
+from cirrus.client import Route53Client
+from cirrus.fake import FakeRoute53Connection, FakeRoute53Error
+from cirrus.r53 import Zone
+
+class LostResponseConnection(FakeRoute53Connection):
+    """Creates the hosted zone on the first create_hosted_zone call then fails it as a server error."""
+
+    def __init__(self):
+        FakeRoute53Connection.__init__(self)
+        self.failures = 1
+
+    def create_hosted_zone(self, domain_name, caller_ref=None, comment=''):
+        response = FakeRoute53Connection.create_hosted_zone(self, domain_name, caller_ref, comment)
+        if self.failures > 0:
+            self.failures -= 1
+            raise FakeRoute53Error(500, 'InternalError', 'We encountered an internal error.')
+        return response
+
+class CreateHostedZoneRetryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = LostResponseConnection()
+        self.client = Route53Client(self.conn, base_delay=0)
+
+    def test_not_retried_without_caller_ref(self):
+        self.assertRaises(FakeRoute53Error, self.client.create_hosted_zone, 'test.example.com')
+        self.assertEqual(self.conn.calls['create_hosted_zone'], 1)
+        self.assertEqual(len(self.conn.zones), 1)
+
+    def test_zone_created_once(self):
+        zone = Zone(self.client, 'test.example.com')
+        zone._create_hosted_zone()
+        self.assertEqual(self.conn.calls['create_hosted_zone'], 2)
+        self.assertEqual(self.conn.zones.keys(), [zone.id])
+
+if __name__ == '__main__':
+    unittest.main()
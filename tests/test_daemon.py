@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+#
+"""Tests for cirrus.daemon.UpdateDaemon run against the in memory route 53 of cirrus.fake."""
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from cirrus.client import get_client
+from cirrus.daemon import UpdateDaemon, _RegistrationHandler, _UnixServer, send_registrations, serve
+from cirrus.records import RRSet
+from tests.util import FakeZoneTestCase, ZONE_NAME
+
+class UpdateDaemonTest(FakeZoneTestCase):
+
+    def setUp(self):
+        FakeZoneTestCase.setUp(self)
+        self.daemon = UpdateDaemon(get_client(self.conn))
+
+    def test_flushes_every_type_of_a_host(self):
+        host = 'www.' + ZONE_NAME + '.'
+        a = self.daemon.register(ZONE_NAME, RRSet.from_text(host, 'A', 300, ['10.0.0.1']))
+        aaaa = self.daemon.register(ZONE_NAME, RRSet.from_text(host, 'AAAA', 300, ['fd00::1']))
+
+        self.assertEqual(self.daemon.flush(), 2)
+        self.assertTrue(a.done.is_set() and a.error is None)
+        self.assertTrue(aaaa.done.is_set() and aaaa.error is None)
+        self.assertEqual(self.rrsets(), {(host, 'A'): ['10.0.0.1'], (host, 'AAAA'): ['fd00::1']})
+
+    def test_latest_registration_wins(self):
+        host = 'www.' + ZONE_NAME + '.'
+        first = self.daemon.register(ZONE_NAME, RRSet.from_text(host, 'A', 300, ['10.0.0.1']))
+        last = self.daemon.register(ZONE_NAME, RRSet.from_text(host, 'A', 300, ['10.0.0.2']))
+
+        self.assertEqual(self.daemon.flush(), 1)
+        self.assertEqual(self.rrsets(), {(host, 'A'): ['10.0.0.2']})
+        self.assertEqual(first.superseded, last.rrset)
+        self.assertTrue(first.error is None and last.error is None and last.superseded is None)
+
+    def test_answers_superseded(self):
+        address = self.serve()
+        answers = {}
+        def send(n):
+            answers[n] = send_registrations(address, ['%s www.%s. A 300 10.0.0.%d' % (ZONE_NAME, ZONE_NAME, n)], 5)
+        clients = [threading.Thread(target=send, args=(n,)) for n in (1, 2)]
+        clients[0].start()
+        self.wait_for_registrations(1)
+        clients[1].start()
+        self.wait_for_registrations(2)
+        self.daemon.flush()
+        for client in clients:
+            client.join()
+        self.assertEqual(answers, {1: ['superseded www.%s. 10.0.0.2' % ZONE_NAME], 2: ['ok www.%s.' % ZONE_NAME]})
+
+    def wait_for_registrations(self, count):
+        for n in range(500):
+            if self.daemon.stats.to_dict()['total'].get('registrations', 0) >= count:
+                return
+            time.sleep(0.01)
+        self.fail("The daemon didn't take %d registrations" % count)
+
+    def test_finds_zone_created_after_start(self):
+        host = 'www.new.example.com.'
+        self.daemon.register(ZONE_NAME, RRSet.from_text('www.' + ZONE_NAME, 'A', 300, ['10.0.0.1']))
+        self.daemon.flush() #The hosted zones are listed
+        zone_id = self.conn.add_zone('new.example.com')
+        registration = self.daemon.register('new.example.com', RRSet.from_text(host, 'A', 300, ['10.0.0.1']))
+        self.daemon.flush()
+        self.assertTrue(registration.error is None, registration.error)
+        self.assertEqual([rrecord.name for rrecord in self.conn.get_all_rrsets(zone_id) if rrecord.type == 'A'], \
+            [host])
+
+    def test_cached_registration_sends_nothing(self):
+        host = 'www.' + ZONE_NAME + '.'
+        self.daemon.register(ZONE_NAME, RRSet.from_text(host, 'A', 300, ['10.0.0.1']))
+        self.daemon.register(ZONE_NAME, RRSet.from_text(host, 'AAAA', 300, ['fd00::1']))
+        self.daemon.flush()
+
+        registration = self.daemon.register(ZONE_NAME, RRSet.from_text(host, 'A', 300, ['10.0.0.1']))
+        self.assertTrue(registration.done.is_set())
+        self.assertEqual(self.daemon.flush(), 0)
+
+    def test_flusher_survives_errors(self):
+        def on_flush():
+            raise RuntimeError('on_flush failed')
+        self.daemon = UpdateDaemon(get_client(self.conn), interval=0.01, on_flush=on_flush)
+        flusher = threading.Thread(target=self.daemon.run)
+        flusher.daemon = True
+        flusher.start()
+        try:
+            for n in range(2):
+                registration = self.daemon.register(ZONE_NAME, \
+                    RRSet.from_text('host%d.%s.' % (n, ZONE_NAME), 'A', 300, ['10.0.0.1']))
+                self.assertTrue(registration.done.wait(5))
+        finally:
+            self.daemon.stop()
+            flusher.join()
+
+    def test_answers_error_when_not_flushed(self):
+        self.daemon = UpdateDaemon(get_client(self.conn), answer_timeout=0.1) #Nothing flushes
+        answers = send_registrations(self.serve(), ['%s www.%s. A 300 10.0.0.1' % (ZONE_NAME, ZONE_NAME)], 5)
+        self.assertEqual(len(answers), 1)
+        self.assertTrue(answers[0].startswith('error www.%s. not flushed' % ZONE_NAME), answers[0])
+
+    def serve(self):
+        """Take registrations for self.daemon on a unix socket in a thread, returning its address."""
+        directory = tempfile.mkdtemp()
+        address = os.path.join(directory, 'daemon.sock')
+        server = _UnixServer(address, _RegistrationHandler)
+        server.update_daemon = self.daemon
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        def stop():
+            server.shutdown()
+            server.server_close()
+            shutil.rmtree(directory)
+        self.addCleanup(stop)
+        return address
+
+    def test_refuses_zones_not_allowed(self):
+        self.daemon = UpdateDaemon(get_client(self.conn), allowed_zones=['other.example.com'])
+        registration = self.daemon.register(ZONE_NAME, RRSet.from_text('www.' + ZONE_NAME, 'A', 300, ['10.0.0.1']))
+        self.assertTrue(registration.done.is_set())
+        self.assertTrue('not one this daemon updates' in registration.error)
+        self.assertEqual(self.daemon.flush(), 0)
+
+    def test_requires_secret(self):
+        self.daemon = UpdateDaemon(get_client(self.conn), answer_timeout=0.1, secret='s3cret')
+        address = self.serve()
+        line = '%s www.%s. A 300 10.0.0.1' % (ZONE_NAME, ZONE_NAME)
+        self.assertEqual(send_registrations(address, [line], 5), ['error - not authorized'])
+        self.assertEqual(send_registrations(address, [line], 5, 'wrong'), ['error - not authorized'])
+        answers = send_registrations(address, [line], 5, 's3cret')
+        self.assertTrue(answers[0].startswith('error www.%s. not flushed' % ZONE_NAME), answers) #Nothing flushes
+
+    def test_tcp_needs_zones_or_secret(self):
+        self.assertRaises(ValueError, serve, self.daemon, '127.0.0.1:0')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+#
+"""Tests for cirrus.fileutil.atomic_write."""
+
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+from cirrus.fileutil import atomic_write
+
+class AtomicWriteTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'data')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_replaces_file(self):
+        atomic_write(self.path, 'old')
+        atomic_write(self.path, 'new', 0644)
+        self.assertEqual(open(self.path).read(), 'new')
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0644)
+        self.assertEqual(os.listdir(self.directory), ['data'])
+
+    def test_failed_write_leaves_nothing(self):
+        atomic_write(self.path, 'old')
+        self.assertRaises(TypeError, atomic_write, self.path, object())
+        self.assertEqual(open(self.path).read(), 'old')
+        self.assertEqual(os.listdir(self.directory), ['data'])
+
+    def test_failed_rename_leaves_nothing(self):
+        target = os.path.join(self.directory, 'target')
+        os.mkdir(target)
+        os.mkdir(os.path.join(target, 'full')) #Renaming a file over a non empty directory fails
+        self.assertRaises(OSError, atomic_write, target, 'new')
+        self.assertEqual(os.listdir(self.directory), ['target'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+#
+""" Tests for cirrus.r53.Zone run against the in memory route 53 of cirrus.fake.
+Run with python -m unittest discover tests
+"""
+
+import unittest
+
+try:
+    import dns.zone
+except ImportError:
+    dns = None
+
+from cirrus.r53 import Zone, _route53_order
+from cirrus.records import RecordIndex, RRSet
+from cirrus.threaded import ThreadedZone
+from tests.util import FakeZoneTestCase, ZONE_NAME
+
+class ZoneTestCase(FakeZoneTestCase):
+
+    def setUp(self):
+        FakeZoneTestCase.setUp(self)
+        self.zone = Zone(self.conn, ZONE_NAME)
+        self.zone.exists()
+
+class UpdateHostsTest(ZoneTestCase):
+
+    def test_keeps_a_when_adding_aaaa(self):
+        host = 'www.' + ZONE_NAME + '.'
+        self.conn.add_rrset(self.zone_id, host, 'A', 300, ['10.0.0.1'])
+        hosts = RecordIndex()
+        hosts.add(RRSet.from_text(host, 'A', 300, ['10.0.0.1']))
+        hosts.add(RRSet.from_text(host, 'AAAA', 300, ['fd00::1']))
+
+        self.assertEqual(self.zone.update_hosts(hosts), 1)
+        self.assertEqual(self.rrsets(), {(host, 'A'): ['10.0.0.1'], (host, 'AAAA'): ['fd00::1']})
+
+    def test_replaces_other_type_once(self):
+        host = 'www.' + ZONE_NAME + '.'
+        self.conn.add_rrset(self.zone_id, host, 'CNAME', 300, ['other.example.com.'])
+        hosts = RecordIndex()
+        hosts.add(RRSet.from_text(host, 'A', 300, ['10.0.0.1']))
+        hosts.add(RRSet.from_text(host, 'AAAA', 300, ['fd00::1']))
+
+        self.assertEqual(self.zone.update_hosts(hosts), 2)
+        self.assertEqual(self.rrsets(), {(host, 'A'): ['10.0.0.1'], (host, 'AAAA'): ['fd00::1']})
+
+class Route53OrderTest(ZoneTestCase):
+    """Route 53 lists names in ascii order of the plain name, where * and - come before digits."""
+
+    def setUp(self):
+        ZoneTestCase.setUp(self)
+        self.names = ['%s.%s.' % (label, ZONE_NAME) for label in ('*', '-a', '0', '1', 'a', 'b')]
+        for name in self.names:
+            self.conn.add_rrset(self.zone_id, name, 'A', 300, ['10.0.0.1'])
+
+    def test_order(self):
+        self.assertEqual(sorted(reversed(self.names), key=_route53_order), self.names)
+        self.assertEqual(_route53_order('\\052.' + ZONE_NAME), _route53_order('*.' + ZONE_NAME))
+
+    def test_fake_lists_in_order(self):
+        listed = [rrecord.name for rrecord in self.conn.get_all_rrsets(self.zone_id) if rrecord.type == 'A']
+        self.assertEqual(listed, ['\\052.' + ZONE_NAME + '.'] + self.names[1:])
+
+    def test_listing_between_names(self):
+        boundary = '1.' + ZONE_NAME + '.'
+        before = [name for name, rrecord in self.zone._iter_listed(between=(None, boundary)) if rrecord.type == 'A']
+        after = [name for name, rrecord in self.zone._iter_listed(between=(boundary, None))]
+        self.assertEqual(before, self.names[:3])
+        self.assertEqual(after, self.names[3:])
+
+    @unittest.skipIf(dns is None, 'dnspython is not installed')
+    def test_stream_update(self):
+        dnszone = dns.zone.from_text('\n'.join(['@ 300 IN SOA ns.example.com. root.example.com. 1 7200 900 1209600 86400',
+            '@ 300 IN NS ns.example.com.', '* 300 IN A 10.0.0.1', '0 300 IN A 10.0.0.2', '2 300 IN A 10.0.0.1']),
+            origin=ZONE_NAME, relativize=False)
+        counts = {}
+        changes = [change for group in self.zone._stream_changes(dnszone, counts) for change in group]
+        self.assertEqual(sorted((action, rrset.name) for action, rrset in changes),
+            [('CREATE', '2.' + ZONE_NAME + '.'), ('DELETE', '-a.' + ZONE_NAME + '.'),
+             ('DELETE', '1.' + ZONE_NAME + '.'), ('DELETE', 'a.' + ZONE_NAME + '.'), ('DELETE', 'b.' + ZONE_NAME + '.'),
+             ('UPSERT', '0.' + ZONE_NAME + '.')])
+
+class ThreadedZoneTest(FakeZoneTestCase):
+
+    def test_takes_zone_arguments_in_order(self):
+        parse_cache = object() #Only passed through
+        zone = ThreadedZone(self.conn, ZONE_NAME, None, None, parse_cache)
+        self.assertTrue(zone.parse_cache is parse_cache)
+        self.assertEqual(zone.concurrency, 4)
+
+if __name__ == '__main__':
+    unittest.main()
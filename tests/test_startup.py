@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+#
+""" Checks update_host.py starts within the budget of bench/bench_startup.py without loading boto or dnspython.
+The bench times fresh interpreters, so this takes a few seconds.
+"""
+
+import imp
+import os
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+bench_startup = imp.load_source('bench_startup', os.path.join(ROOT, 'bench', 'bench_startup.py'))
+
+RUNS = 9
+
+class StartupTest(unittest.TestCase):
+
+    def test_update_host_startup(self):
+        #The fastest of runs taken in turns with the bare interpreter, so other load on the machine is not counted
+        name, connect = bench_startup.PATHS[1]
+        baselines = []
+        times = []
+        for n in range(RUNS):
+            baselines.append(bench_startup.time_path(None, 1)[0])
+            seconds, modules = bench_startup.time_path(connect, 1)
+            times.append(seconds)
+        baseline = min(baselines)
+        seconds = min(times)
+
+        heavy = [module for module in modules if module.split('.')[0] in bench_startup.HEAVY_MODULES]
+        self.assertEqual(heavy, [])
+        added = (seconds - baseline) * 1000
+        self.assertTrue(added <= bench_startup.BUDGET_MS, \
+            "%s took %.1fms over the budget of %.1fms" % (name, added - bench_startup.BUDGET_MS, bench_startup.BUDGET_MS))
+
+if __name__ == '__main__':
+    unittest.main()
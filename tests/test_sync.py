@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+#
+"""Tests for cirrus.sync.sync_zones."""
+
+import logging
+import threading
+import time
+import unittest
+
+from cirrus.stats import Stats
+from cirrus.sync import sync_zones
+from tests.util import LogMessages
+
+log = logging.getLogger('cirrus')
+
+class SyncZonesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.messages = LogMessages()
+        log.addHandler(self.messages)
+        self.addCleanup(log.removeHandler, self.messages)
+
+    def test_child_thread_output_is_not_interleaved(self):
+        stats = Stats()
+
+        def child(name):
+            with stats.zone(name):
+                for n in range(3):
+                    log.warn("%s child %d" % (name, n))
+                    time.sleep(0.01)
+
+        def sync(name, zone_file):
+            with stats.zone(name):
+                log.warn("%s start" % name)
+                thread = threading.Thread(target=child, args=(name,))
+                thread.start()
+                thread.join()
+                log.warn("%s end" % name)
+
+        sync_zones({'a.example.com': None, 'b.example.com': None}, sync, 2)
+        zones = [message.split()[0] for message in self.messages.messages if message.endswith(('start', 'end')) \
+            or ' child ' in message]
+        self.assertEqual(len(zones), 10)
+        self.assertEqual(zones, sorted(zones, key=zones[0].__ne__)) #Each zone's lines together
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+#
+"""The fixture shared by the tests run against the in memory route 53 of cirrus.fake."""
+
+import logging
+import unittest
+
+from cirrus.fake import FakeRoute53Connection
+
+ZONE_NAME = 'test.example.com'
+
+class LogMessages(logging.Handler):
+    """A logging handler keeping the messages logged to it."""
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+class FakeZoneTestCase(unittest.TestCase):
+    """Sets up a fake route 53 connection, self.conn, holding one empty hosted zone, ZONE_NAME, as self.zone_id."""
+
+    def setUp(self):
+        self.conn = FakeRoute53Connection()
+        self.zone_id = self.conn.add_zone(ZONE_NAME)
+
+    def rrsets(self):
+        """Return {(name, rtype): [values, ]} for the rrsets of the fake zone other than the SOA and NS."""
+        rrsets = {}
+        for rrecord in self.conn.get_all_rrsets(self.zone_id):
+            if rrecord.type not in ('SOA', 'NS'):
+                rrsets[(rrecord.name, rrecord.type)] = list(rrecord.resource_records)
+        return rrsets